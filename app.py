@@ -1,33 +1,45 @@
 import logging
+import multiprocessing
 import os
 import sys
 from datetime import datetime
 
-import requests
-from PIL import Image
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QSettings
+from PyQt6.QtCore import Qt, QThread, QObject, QTimer, pyqtSignal, QSettings
 from PyQt6.QtGui import (
-    QColor, QTextCursor, QTextCharFormat, QPalette, QPixmap,
+    QColor, QPalette,
     QAction
 )
 from PyQt6.QtGui import QGuiApplication
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QLineEdit, QPushButton,
-    QTextEdit, QWidget, QComboBox, QHBoxLayout, QTableWidget,
-    QTableWidgetItem, QHeaderView, QLabel, QSplitter, QDialog,
-    QMessageBox, QMenu, QTreeWidget, QTreeWidgetItem, QFileDialog
+    QPlainTextEdit, QWidget, QComboBox, QHBoxLayout, QTableView,
+    QAbstractItemView, QHeaderView, QLabel, QSplitter, QDialog,
+    QMessageBox, QMenu, QTreeView, QFileDialog,
+    QProgressBar, QSpinBox, QCheckBox
 )
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler('manga_downloader.log'),
-        logging.StreamHandler()
-    ]
+from bandwidth import BACKGROUND, default_bandwidth
+from chapters_model import ChapterTreeModel
+
+from core import (
+    DEFAULT_CHAPTER_JOBS, DEFAULT_EXPORT_FORMATS, DEFAULT_PAGE_WORKERS, EXPORT_FORMATS, MAX_PAGE_WORKERS,
+    DownloadScheduler, get_chapters, parse_number_ranges, resolve_jobs, setup_logging
 )
+from covers import CoverService
+from http_client import DNS_TTL, default_client, log_trace
+from daemon import RemoteScheduler, load_token
+from image_processing import DEFAULT_PROFILE, PROFILES
+from library import LibraryIndex, sync_watchlist, watch
+from log_sink import LogSink
+from metrics import start_metrics_server
+from search_model import COVER_COLUMN, ROW_HEIGHT, SLUG_COLUMN, CoverDelegate, MangaTableModel
+
 logger = logging.getLogger(__name__)
 
+# Поиск при наборе: пауза после последней клавиши и минимальная длина запроса
+SEARCH_DEBOUNCE_MS = 350
+SEARCH_MIN_CHARS = 3
+
 # Обновлённые стили
 LIGHT_THEME = """
     QWidget {
@@ -49,7 +61,7 @@ LIGHT_THEME = """
     QPushButton:disabled {
         background-color: #CCCCCC;
     }
-    QLineEdit, QTextEdit {
+    QLineEdit, QPlainTextEdit {
         border: 1px solid #CCCCCC;
         border-radius: 4px;
         padding: 6px;
@@ -60,7 +72,7 @@ LIGHT_THEME = """
         border: 1px solid #CCCCCC;
         border-radius: 4px;
     }
-    QTableWidget {
+    QTableView {
         gridline-color: #E0E0E0;
         font-size: 13px;
         border: 1px solid #E0E0E0;
@@ -73,10 +85,10 @@ LIGHT_THEME = """
         border-bottom: 2px solid #E0E0E0;
         font-weight: 500;
     }
-    QTableWidget::item {
+    QTableView::item {
         padding: 6px;
     }
-    QTableWidget::item:selected {
+    QTableView::item:selected {
         background-color: #FF6B35;
         color: white;
     }
@@ -106,7 +118,7 @@ DARK_THEME = """
     QPushButton:disabled {
         background-color: #555555;
     }
-    QLineEdit, QTextEdit {
+    QLineEdit, QPlainTextEdit {
         border: 1px solid #555555;
         border-radius: 4px;
         padding: 6px;
@@ -121,7 +133,7 @@ DARK_THEME = """
         background-color: #404040;
         color: #CCCCCC;
     }
-    QTableWidget {
+    QTableView {
         gridline-color: #404040;
         font-size: 13px;
         border: 1px solid #404040;
@@ -134,7 +146,7 @@ DARK_THEME = """
         border-bottom: 2px solid #404040;
         font-weight: 500;
     }
-    QTableWidget::item:selected {
+    QTableView::item:selected {
         background-color: #FF6B35;
         color: white;
     }
@@ -150,159 +162,97 @@ def excepthook(exctype, value, traceback):
 
 sys.excepthook = excepthook
 
-def get_manga_pages(slug_url, volume_number, chapter_number):
-    base_url = "https://api.lib.social/api/manga"
-    endpoint = f"{base_url}/{slug_url}/chapter"
-    params = {
-        "number": chapter_number,
-        "volume": volume_number
-    }
 
-    try:
-        response = requests.get(endpoint, params=params, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            pages = data.get("data", {}).get("pages", [])
-            return [
-                f"https://img2.imglib.info{page['url']}"
-                if page["url"].startswith("//manga/") else page["url"]
-                for page in pages
-            ]
-        return []
-    except Exception as e:
-        return []
-
-
-def sanitize_folder_name(name):
-    return "".join(c if c.isalnum() else "_" for c in name)
-
-
-class DownloadThread(QThread):
-    log_signal = pyqtSignal(str, str)
-    finished_signal = pyqtSignal(str)
+class JobsResolverThread(QThread):
+    """ Превращает диапазоны томов и глав в список глав для загрузки """
+    jobs_ready = pyqtSignal(str, list)
+    error_occurred = pyqtSignal(str)
 
-    def __init__(self, slug_url, volume_number, chapter_number, save_directory, parent=None):
-        super().__init__(parent)
+    def __init__(self, slug_url, volume_spec, chapter_spec):
+        super().__init__()
         self.slug_url = slug_url
-        self.volume_number = volume_number
-        self.chapter_number = chapter_number
-        self.save_directory = save_directory
+        self.volume_spec = volume_spec
+        self.chapter_spec = chapter_spec
 
     def run(self):
         try:
-            self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Начало загрузки...", "info")
-
-            folder_name = sanitize_folder_name(self.slug_url.split("--", 1)[-1])
-            volume_folder = f"Volume_{self.volume_number}"
-            chapter_folder = f"Chapter_{self.chapter_number}"
-
-            save_dir = os.path.join(
-                self.save_directory,
-                folder_name,
-                volume_folder,
-                chapter_folder
-            )
-            os.makedirs(save_dir, exist_ok=True)
-
-            self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Поиск страниц...", "info")
-            page_urls = get_manga_pages(self.slug_url, self.volume_number, self.chapter_number)
-
-            if not page_urls:
-                self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Страницы не найдены!", "error")
-                self.finished_signal.emit("")
-                return
-
-            image_paths = []
-            for i, url in enumerate(page_urls, start=1):
-                try:
-                    response = requests.get(url, stream=True, timeout=15)
-                    if response.status_code == 200:
-                        image_path = os.path.join(save_dir, f"{i:03}.jpg")
-                        with open(image_path, "wb") as img_file:
-                            for chunk in response.iter_content(2048):
-                                img_file.write(chunk)
-                        image_paths.append(image_path)
-                        self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Страница {i} сохранена",
-                                             "success")
-                    else:
-                        self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка загрузки: {url}", "error")
-                except Exception as e:
-                    self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка: {str(e)}", "error")
-
-            if image_paths:
-                pdf_path = os.path.join(save_dir, f"Volume_{self.volume_number}_Chapter_{self.chapter_number}.pdf")
-                self.create_pdf_with_pillow(image_paths, pdf_path)
-                self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] PDF создан: {pdf_path}", "success")
-
-            self.finished_signal.emit(save_dir)
-
+            self.jobs_ready.emit(self.slug_url, resolve_jobs(self.slug_url, self.volume_spec, self.chapter_spec))
         except Exception as e:
-            self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Критическая ошибка: {str(e)}", "error")
-            self.finished_signal.emit("")
-
-    def create_pdf_with_pillow(self, image_paths, output_path):
-        try:
-            images = [Image.open(img).convert("RGB") for img in image_paths]
-            if images:
-                images[0].save(output_path, save_all=True, append_images=images[1:])
-        except Exception as e:
-            self.log_signal.emit(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка создания PDF: {str(e)}", "error")
+            self.error_occurred.emit(f"Ошибка формирования очереди: {str(e)}")
 
 
-class MangaSearchThread(QThread):
-    search_complete = pyqtSignal(list)
+class WatchTitleThread(QThread):
+    """ Добавляет тайтл в отслеживаемые и отмечает уже скачанные главы """
+    watched = pyqtSignal(str, int)
+    error_occurred = pyqtSignal(str)
 
-    def __init__(self, search_query):
+    def __init__(self, library, slug_url, save_directory):
         super().__init__()
-        self.search_query = search_query
+        self.library = library
+        self.slug_url = slug_url
+        self.save_directory = save_directory
 
     def run(self):
         try:
-            params = {
-                "site_id[]": 1,
-                "q": self.search_query,
-                "page": 1,
-                "status[]": [1, 2, 4],
-                "types[]": [1, 5]
-            }
-
-            response = requests.get("https://api.lib.social/api/manga", params=params, timeout=10)  # Добавлен таймаут
-            response.raise_for_status()  # Проверка HTTP ошибок
-            data = response.json()
-            self.search_complete.emit(data.get('data', []))
+            self.watched.emit(self.slug_url, watch(self.library, self.slug_url, self.save_directory))
         except Exception as e:
-            print(f"Search error: {str(e)}")  # Логирование ошибки
-            self.search_complete.emit([])
+            self.error_occurred.emit(f"Ошибка добавления в отслеживаемые: {str(e)}")
 
 
-class ImageLoaderThread(QThread):
-    image_loaded = pyqtSignal(str, QPixmap)
-    error_occurred = pyqtSignal(str, str)  # Новый сигнал для ошибок
+class SyncLibraryThread(QThread):
+    """ Проверяет отслеживаемые тайтлы; для каждого выдаёт главы к загрузке и папку """
+    title_synced = pyqtSignal(str, list, str)
+    error_occurred = pyqtSignal(str)
 
-    def __init__(self, url, manga_id):
+    def __init__(self, library):
         super().__init__()
-        self.url = url
-        self.manga_id = manga_id
+        self.library = library
 
     def run(self):
+        def on_title(slug_url, save_directory, result):
+            if isinstance(result, Exception):
+                self.error_occurred.emit(f"Ошибка проверки {slug_url}: {str(result)}")
+            else:
+                self.title_synced.emit(slug_url, result, save_directory)
+
         try:
-            response = requests.get(self.url, timeout=10)
-            response.raise_for_status()  # Проверка HTTP статуса
-
-            img_data = response.content
-            pixmap = QPixmap()
-            if not pixmap.loadFromData(img_data):
-                raise ValueError("Неверный формат изображения")
-
-            self.image_loaded.emit(
-                self.manga_id,
-                pixmap.scaled(100, 150, Qt.AspectRatioMode.KeepAspectRatio)
-            )
+            sync_watchlist(self.library, on_title)
         except Exception as e:
-            self.error_occurred.emit(
-                self.manga_id,
-                f"Ошибка загрузки обложки: {str(e)}"
-            )
+            self.error_occurred.emit(f"Ошибка проверки новых глав: {str(e)}")
+
+
+class DownloadQueueBridge(QObject):
+    """ Передаёт события очереди core.DownloadScheduler в сигналы Qt,
+    чтобы окно обновлялось из главного потока. Сообщения лога идут в LogSink
+    напрямую, без отдельного события Qt на каждое сообщение.
+    С переменной окружения MANGALIB_DAEMON_URL главы загружает служба (daemon.py),
+    а окно только ставит их в очередь и показывает ход загрузки """
+    # готово, всего, осталось секунд (-1 — неизвестно)
+    progress_signal = pyqtSignal(int, int, float)
+    queue_changed = pyqtSignal(int, int)
+    job_finished = pyqtSignal(str)
+    all_finished = pyqtSignal()
+
+    def __init__(self, log_sink, parent=None):
+        super().__init__(parent)
+        self.library = LibraryIndex()
+        daemon_url = os.environ.get("MANGALIB_DAEMON_URL")
+        self.remote = bool(daemon_url)
+        if daemon_url:
+            scheduler_class = RemoteScheduler
+            options = {"base_url": daemon_url, "token": load_token()}
+        else:
+            scheduler_class = DownloadScheduler
+            options = {"library": self.library}
+        self.scheduler = scheduler_class(
+            **options,
+            on_log=lambda message, msg_type, group=None: log_sink.append(message, msg_type, group or ""),
+            on_progress=lambda done, total, eta: self.progress_signal.emit(
+                done, total, -1.0 if eta is None else eta),
+            on_queue_changed=self.queue_changed.emit,
+            on_job_finished=lambda downloader, save_dir: self.job_finished.emit(save_dir),
+            on_all_finished=self.all_finished.emit
+        )
 
 
 class MangaDownloaderApp(QMainWindow):
@@ -310,12 +260,42 @@ class MangaDownloaderApp(QMainWindow):
         super().__init__()
         self.current_theme = "light"
         self.last_save_dir = ""
-        self.manga_cache = {}
+        self.save_directory = ""
+        self.resolver_threads = []
         self.chapter_threads = []  # Добавьте эту строку
-        self.loader_threads = []  # Список для хранения ссылок на потоки
+        self.cover_service = CoverService(parent=self)
+        self.manga_model = MangaTableModel(self.cover_service, parent=self)
+        self.manga_model.page_loaded.connect(self.on_search_page_loaded)
+        self.manga_model.page_failed.connect(self.on_search_page_failed)
         self.init_ui()
+        self.download_queue = DownloadQueueBridge(self.log_sink, self)
+        self.download_queue.progress_signal.connect(self.update_progress)
+        self.download_queue.queue_changed.connect(self.update_queue_status)
+        self.download_queue.job_finished.connect(self.on_download_finished)
+        self.download_queue.all_finished.connect(self.on_queue_finished)
+        self.scheduler = self.download_queue.scheduler
+        if self.download_queue.remote:
+            self.disable_local_options()
         self.apply_theme(LIGHT_THEME)
 
+    def disable_local_options(self):
+        """ С MANGALIB_DAEMON_URL параметры загрузки задаются при запуске службы (cli.py daemon ...) """
+        widgets = [self.workers_input, self.jobs_input, self.dedupe_input, self.profile_selector,
+                   self.keep_pages_input] + list(self.format_inputs.values())
+        for widget in widgets:
+            widget.setEnabled(False)
+            widget.setToolTip("Задаётся при запуске службы загрузки")
+
+    def set_rate_limit(self, value):
+        if self.download_queue.remote:
+            try:
+                self.scheduler.set_rate_limit(value * 1024)
+            except Exception as e:
+                self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка службы загрузки: {str(e)}",
+                                 "error")
+        else:
+            default_bandwidth.set_rate(value * 1024)
+
     def init_ui(self):
         self.setWindowTitle("Manga Downloader")
         self.setGeometry(100, 100, 1000, 800)
@@ -342,6 +322,13 @@ class MangaDownloaderApp(QMainWindow):
         search_control_layout = QHBoxLayout()
         self.search_input = QLineEdit()
         self.search_input.setPlaceholderText("Поиск манги по названию...")
+        # Поиск при наборе: запрос уходит после паузы в наборе, Enter ищет сразу
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DEBOUNCE_MS)
+        self.search_timer.timeout.connect(self.start_typeahead_search)
+        self.search_input.textChanged.connect(self.search_timer.start)
+        self.search_input.returnPressed.connect(self.start_search)
         search_control_layout.addWidget(self.search_input)
 
         self.search_button = QPushButton("Поиск")
@@ -350,12 +337,19 @@ class MangaDownloaderApp(QMainWindow):
         search_layout.addLayout(search_control_layout)
 
         # Таблица результатов
-        self.manga_table = QTableWidget()
-        self.manga_table.setColumnCount(5)  # Изменено с 4 на 5
-        self.manga_table.setHorizontalHeaderLabels(["Обложка", "Название", "Тип", "Статус", "Slug URL"])  # Добавлен новый столбец
+        self.manga_table = QTableView()
+        self.manga_table.setModel(self.manga_model)
+        self.manga_table.setItemDelegateForColumn(COVER_COLUMN, CoverDelegate(self.cover_service, self.manga_table))
         self.manga_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Interactive)  # Изменён режим изменения размеров
+        self.manga_table.horizontalHeader().setDefaultAlignment(Qt.AlignmentFlag.AlignLeft)
+        self.manga_table.setColumnWidth(COVER_COLUMN, 120)
         self.manga_table.verticalHeader().setVisible(False)
-        self.manga_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        # Фиксированная высота строк: представлению не нужно измерять каждую строку
+        self.manga_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.manga_table.verticalHeader().setDefaultSectionSize(ROW_HEIGHT)
+        self.manga_table.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.manga_table.setShowGrid(False)
+        self.manga_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
         self.manga_table.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)  # Включаем контекстное меню
         self.manga_table.customContextMenuRequested.connect(self.show_context_menu)
         search_layout.addWidget(self.manga_table)
@@ -381,12 +375,58 @@ class MangaDownloaderApp(QMainWindow):
         input_layout.addWidget(self.slug_input)
 
         self.volume_input = QLineEdit()
-        self.volume_input.setPlaceholderText("Номер тома")
+        self.volume_input.setPlaceholderText("Том: 3, 1-5 или пусто — все тома")
         input_layout.addWidget(self.volume_input)
 
         self.chapter_input = QLineEdit()
-        self.chapter_input.setPlaceholderText("Номер главы")
+        self.chapter_input.setPlaceholderText("Глава: 12, 10-120 или пусто — все главы")
         input_layout.addWidget(self.chapter_input)
+
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("Потоков загрузки:"))
+        self.workers_input = QSpinBox()
+        self.workers_input.setRange(1, MAX_PAGE_WORKERS)
+        self.workers_input.setValue(DEFAULT_PAGE_WORKERS)
+        workers_layout.addWidget(self.workers_input)
+        workers_layout.addWidget(QLabel("Глав одновременно:"))
+        self.jobs_input = QSpinBox()
+        self.jobs_input.setRange(1, 16)
+        self.jobs_input.setValue(DEFAULT_CHAPTER_JOBS)
+        workers_layout.addWidget(self.jobs_input)
+        workers_layout.addWidget(QLabel("Скорость, КБ/с:"))
+        self.rate_input = QSpinBox()
+        self.rate_input.setRange(0, 1024 * 1024)
+        self.rate_input.setSingleStep(256)
+        self.rate_input.setSpecialValueText("без предела")
+        self.rate_input.setToolTip("Общий предел скорости загрузки. Поиск и обложки не ждут загрузку страниц")
+        self.rate_input.valueChanged.connect(self.set_rate_limit)
+        workers_layout.addWidget(self.rate_input)
+        self.dedupe_input = QCheckBox("Не хранить одинаковые страницы дважды")
+        self.dedupe_input.setToolTip("Страницы хранятся в папке .pages и связываются с главами жёсткими ссылками")
+        workers_layout.addWidget(self.dedupe_input)
+        workers_layout.addStretch()
+        input_layout.addLayout(workers_layout)
+
+        # Обработка страниц после загрузки (в отдельных процессах)
+        profile_layout = QHBoxLayout()
+        profile_layout.addWidget(QLabel("Обработка страниц:"))
+        self.profile_selector = QComboBox()
+        for name, profile in PROFILES.items():
+            self.profile_selector.addItem(profile.label, name)
+        self.profile_selector.setCurrentIndex(self.profile_selector.findData(DEFAULT_PROFILE))
+        profile_layout.addWidget(self.profile_selector)
+        profile_layout.addWidget(QLabel("Собрать в:"))
+        self.format_inputs = {}
+        for export_format in EXPORT_FORMATS:
+            checkbox = QCheckBox(export_format.upper())
+            checkbox.setChecked(export_format in DEFAULT_EXPORT_FORMATS)
+            profile_layout.addWidget(checkbox)
+            self.format_inputs[export_format] = checkbox
+        self.keep_pages_input = QCheckBox("Сохранять страницы отдельными файлами")
+        self.keep_pages_input.setChecked(True)
+        profile_layout.addWidget(self.keep_pages_input)
+        profile_layout.addStretch()
+        input_layout.addLayout(profile_layout)
         download_layout.addLayout(input_layout)
 
         # Кнопки
@@ -395,15 +435,37 @@ class MangaDownloaderApp(QMainWindow):
         self.download_button.clicked.connect(self.start_download)
         button_layout.addWidget(self.download_button)
 
+        self.pause_button = QPushButton("Пауза")
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.pause_button.setEnabled(False)
+        button_layout.addWidget(self.pause_button)
+
+        self.cancel_button = QPushButton("Отмена")
+        self.cancel_button.clicked.connect(self.cancel_downloads)
+        self.cancel_button.setEnabled(False)
+        button_layout.addWidget(self.cancel_button)
+
         self.open_dir_button = QPushButton("Открыть папку")
         self.open_dir_button.clicked.connect(self.open_directory)
         self.open_dir_button.setEnabled(False)
         button_layout.addWidget(self.open_dir_button)
+
+        self.sync_button = QPushButton("Проверить новые главы")
+        self.sync_button.clicked.connect(self.sync_library)
+        button_layout.addWidget(self.sync_button)
         download_layout.addLayout(button_layout)
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+        download_layout.addWidget(self.progress_bar)
+
+        self.queue_label = QLabel("Очередь пуста")
+        download_layout.addWidget(self.queue_label)
+
         # Логи
-        self.log_output = QTextEdit()
+        self.log_output = QPlainTextEdit()
         self.log_output.setReadOnly(True)
+        self.log_sink = LogSink(self.log_output, self.message_color, parent=self)
         download_layout.addWidget(self.log_output)
 
         main_splitter.addWidget(search_panel)
@@ -413,6 +475,12 @@ class MangaDownloaderApp(QMainWindow):
         main_layout = QVBoxLayout(central_widget)
         main_layout.addWidget(main_splitter)
 
+    def closeEvent(self, event):
+        self.cover_service.shutdown()
+        self.scheduler.close()
+        self.download_queue.library.close()
+        super().closeEvent(event)
+
     def select_directory(self):
         directory = QFileDialog.getExistingDirectory(self, "Выберите папку для сохранения")
         if directory:
@@ -440,19 +508,16 @@ class MangaDownloaderApp(QMainWindow):
         else:
             self.apply_theme(DARK_THEME)
 
-    def log_message(self, message, msg_type="info"):
+    def message_color(self, msg_type):
         color_map = {
             "info": QColor("#333333") if self.current_theme == "light" else QColor("#CCCCCC"),
             "success": QColor("#228B22"),
             "error": QColor("#B22222")
         }
+        return color_map.get(msg_type, color_map["info"])
 
-        cursor = self.log_output.textCursor()
-        format = QTextCharFormat()
-        format.setForeground(color_map.get(msg_type, color_map["info"]))
-        cursor.setCharFormat(format)
-        cursor.insertText(message + "\n")
-        self.log_output.moveCursor(QTextCursor.MoveOperation.End)
+    def log_message(self, message, msg_type="info"):
+        self.log_sink.append(message, msg_type)
 
     def start_download(self):
         if not self.save_directory:
@@ -463,22 +528,114 @@ class MangaDownloaderApp(QMainWindow):
         volume = self.volume_input.text().strip()
         chapter = self.chapter_input.text().strip()
 
-        if not all([slug, volume, chapter]):
-            self.log_message("Заполните все поля!", "error")
+        if not slug:
+            self.log_message("Укажите Slug URL!", "error")
+            return
+
+        try:
+            parse_number_ranges(volume)
+            parse_number_ranges(chapter)
+        except ValueError as e:
+            self.log_message(str(e), "error")
             return
 
-        self.download_button.setEnabled(False)
-        self.open_dir_button.setEnabled(False)
         self.log_message(
-            f"[{datetime.now().strftime('%H:%M:%S')}] Начало загрузки: {slug} Том {volume} Глава {chapter}", "info")
+            f"[{datetime.now().strftime('%H:%M:%S')}] Формирование очереди: {slug} "
+            f"Том {volume or 'все'} Глава {chapter or 'все'}", "info")
+
+        save_directory = self.save_directory
+        resolver = JobsResolverThread(slug, volume, chapter)
+        resolver.jobs_ready.connect(lambda slug_url, jobs: self.enqueue_jobs(slug_url, jobs, save_directory))
+        resolver.error_occurred.connect(lambda e: self.log_message(e, "error"))
+        resolver.finished.connect(lambda r=resolver: r in self.resolver_threads and self.resolver_threads.remove(r))
+        self.resolver_threads.append(resolver)
+        resolver.start()
+
+    def enqueue_jobs(self, slug_url, jobs, save_directory, traffic_class=None):
+        if not jobs:
+            self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Подходящие главы не найдены", "error")
+            return
+
+        self.scheduler.max_jobs = self.jobs_input.value()
+        self.scheduler.page_workers = self.workers_input.value()
+        self.scheduler.dedupe = self.dedupe_input.isChecked()
+        self.scheduler.profile = PROFILES[self.profile_selector.currentData()]
+        self.scheduler.formats = [name for name, checkbox in self.format_inputs.items() if checkbox.isChecked()]
+        self.scheduler.keep_pages = self.keep_pages_input.isChecked()
+        added = self.scheduler.enqueue_many(
+            [(slug_url, volume, chapter, save_directory) for volume, chapter in jobs], traffic_class=traffic_class
+        )
+        self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Добавлено в очередь глав: {added}", "info")
+
+    def watch_title(self, slug_url):
+        if not self.save_directory:
+            self.log_message("Сначала выберите папку для сохранения!", "error")
+            return
+        thread = WatchTitleThread(self.download_queue.library, slug_url, self.save_directory)
+        thread.watched.connect(lambda slug, found: self.log_message(
+            f"[{datetime.now().strftime('%H:%M:%S')}] {slug} отслеживается, уже скачано глав: {found}", "success"))
+        thread.error_occurred.connect(lambda e: self.log_message(e, "error"))
+        thread.finished.connect(lambda t=thread: t in self.resolver_threads and self.resolver_threads.remove(t))
+        self.resolver_threads.append(thread)
+        thread.start()
+
+    def sync_library(self):
+        if not self.download_queue.library.titles(watched_only=True):
+            self.log_message("Нет отслеживаемых тайтлов: добавьте их через контекстное меню поиска", "error")
+            return
+        self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Проверка новых глав...", "info")
+        self.sync_button.setEnabled(False)
+        thread = SyncLibraryThread(self.download_queue.library)
+        thread.title_synced.connect(self.on_title_synced)
+        thread.error_occurred.connect(lambda e: self.log_message(e, "error"))
+        thread.finished.connect(lambda: self.sync_button.setEnabled(True))
+        thread.finished.connect(lambda t=thread: t in self.resolver_threads and self.resolver_threads.remove(t))
+        self.resolver_threads.append(thread)
+        thread.start()
 
-        self.thread = DownloadThread(slug, volume, chapter, self.save_directory)
-        self.thread.log_signal.connect(self.log_message)
-        self.thread.finished_signal.connect(self.on_download_finished)
-        self.thread.start()
+    def on_title_synced(self, slug_url, jobs, save_directory):
+        if not jobs:
+            self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] {slug_url}: новых глав нет", "info")
+            return
+        self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] {slug_url}: глав к загрузке — {len(jobs)}", "info")
+        # Новые главы отслеживаемых тайтлов качаются в фоне и уступают главам, выбранным вручную
+        self.enqueue_jobs(slug_url, jobs, save_directory, traffic_class=BACKGROUND)
+
+    def toggle_pause(self):
+        if self.scheduler.is_paused():
+            self.scheduler.resume()
+            self.pause_button.setText("Пауза")
+            self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Загрузка продолжена", "info")
+        else:
+            self.scheduler.pause()
+            self.pause_button.setText("Продолжить")
+            self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Загрузка приостановлена", "info")
+
+    def cancel_downloads(self):
+        self.scheduler.cancel()
+        self.pause_button.setText("Пауза")
+        self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Очередь отменена", "error")
+
+    def update_queue_status(self, pending, running):
+        active = bool(pending or running)
+        self.pause_button.setEnabled(active)
+        self.cancel_button.setEnabled(active)
+        if not active:
+            self.queue_label.setText("Очередь пуста")
+        else:
+            paused = " (пауза)" if self.scheduler.is_paused() else ""
+            self.queue_label.setText(f"Загружается глав: {running}, в очереди: {pending}{paused}")
+
+    def update_progress(self, done, total, eta):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        if eta < 0:
+            self.progress_bar.setFormat("%v из %m")
+        else:
+            minutes, seconds = divmod(int(eta), 60)
+            self.progress_bar.setFormat(f"%v из %m — осталось {minutes}:{seconds:02}")
 
     def on_download_finished(self, save_dir):
-        self.download_button.setEnabled(True)
         if save_dir:
             self.last_save_dir = save_dir
             self.open_dir_button.setEnabled(True)
@@ -486,6 +643,9 @@ class MangaDownloaderApp(QMainWindow):
         else:
             self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Загрузка не удалась", "error")
 
+    def on_queue_finished(self):
+        self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Очередь загрузки выполнена", "success")
+
     def open_directory(self):
         if os.path.exists(self.last_save_dir):
             os.startfile(self.last_save_dir)
@@ -493,101 +653,31 @@ class MangaDownloaderApp(QMainWindow):
             self.log_message("Директория не найдена!", "error")
 
     def start_search(self):
+        self.search_timer.stop()
         query = self.search_input.text().strip()
         if not query:
             return
 
-        self.search_thread = MangaSearchThread(query)
-        self.search_thread.search_complete.connect(self.display_results)
-        self.search_thread.start()
-
-    def update_cover(self, slug_url, pixmap):
-        """ Обновляет изображение в таблице после загрузки """
-        for row in range(self.manga_table.rowCount()):
-            item = self.manga_table.item(row, 1)  # Столбец с названием манги
-            if item and item.data(Qt.ItemDataRole.UserRole) == slug_url:
-                label = self.manga_table.cellWidget(row, 0)
-                if isinstance(label, QLabel):
-                    label.setPixmap(pixmap.scaled(label.size(), Qt.AspectRatioMode.KeepAspectRatio,
-                                                  Qt.TransformationMode.SmoothTransformation))
-
-                    # Автоматически подстраиваем размер столбца под изображение
-                    self.manga_table.setColumnWidth(0, pixmap.width())
-                break
-
-    def display_results(self, manga_list):
-        try:
-            self.manga_table.setRowCount(len(manga_list))
-            self.manga_cache.clear()
-            row_height = 160  # Высота строки = высота изображения + отступы
-
-            for row, manga in enumerate(manga_list):
-                self.manga_table.setRowHeight(row, row_height)  # Установка фиксированной высоты
-
-                # Создаем QLabel с фиксированным размером
-                image_label = QLabel()
-                image_label.setFixedSize(120, 150)  # Увеличим ширину для лучшего отображения
-                image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                image_label.setStyleSheet("""
-                    QLabel {
-                        background-color: #F8F9FA;
-                        border-radius: 4px;
-                        padding: 4px;
-                    }
-                """)
-                self.manga_table.setCellWidget(row, 0, image_label)
-
-                cover_url = ""
-                if isinstance(manga.get('cover'), dict):
-                    cover_url = manga['cover'].get('md') or manga['cover'].get('default') or ""
-
-                image_label = QLabel()
-                image_label.setFixedSize(100, 150)  # Начальный размер
-                image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                image_label.setScaledContents(True)  # Позволяет масштабировать изображение
-                self.manga_table.setCellWidget(row, 0, image_label)
-
-                if cover_url and cover_url.startswith(('http://', 'https://')):
-                    loader = ImageLoaderThread(cover_url, manga['slug_url'])
-                    loader.image_loaded.connect(self.update_cover)
-                    loader.finished.connect(lambda l=loader: self.loader_threads.remove(l))
-                    self.loader_threads.append(loader)
-                    loader.start()
-                else:
-                    placeholder = QPixmap(100, 150)
-                    placeholder.fill(QColor(200, 200, 200))
-                    image_label.setPixmap(placeholder)
-
-                name = manga.get('rus_name') or manga.get('eng_name') or manga.get('name', '')
-                name_item = QTableWidgetItem(name)
-                name_item.setData(Qt.ItemDataRole.UserRole, manga['slug_url'])
-                self.manga_table.setItem(row, 1, name_item)
-
-                type_item = QTableWidgetItem(manga['type'].get('label', 'N/A'))
-                status_item = QTableWidgetItem(manga['status'].get('label', 'N/A'))
-                self.manga_table.setItem(row, 2, type_item)
-                self.manga_table.setItem(row, 3, status_item)
-
-                slug_item = QTableWidgetItem(manga['slug_url'])
-                slug_item.setData(Qt.ItemDataRole.UserRole, manga['slug_url'])
-                self.manga_table.setItem(row, 4, slug_item)
-
-            # Настройка внешнего вида таблицы
-            self.manga_table.horizontalHeader().setDefaultAlignment(Qt.AlignmentFlag.AlignLeft)
-            self.manga_table.verticalHeader().setDefaultSectionSize(row_height)
-            self.manga_table.setShowGrid(False)
+        self.manga_model.search(query)
 
-        except Exception as e:
-            print(f"Display error: {str(e)}")
+    def start_typeahead_search(self):
+        if len(self.search_input.text().strip()) >= SEARCH_MIN_CHARS:
+            self.start_search()
+
+    def on_search_page_loaded(self, page, total_rows):
+        if page == 1 and total_rows == 0:
+            self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Ничего не найдено", "info")
+
+    def on_search_page_failed(self, page):
+        self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Не удалось загрузить страницу {page} результатов поиска", "error")
 
     def show_context_menu(self, pos):
         try:
-            item = self.manga_table.itemAt(pos)
-            if not item:
+            index = self.manga_table.indexAt(pos)
+            if not index.isValid():
                 return
 
-            row = self.manga_table.rowAt(pos.y())
-            slug_url = self.manga_table.item(row, 1).data(Qt.ItemDataRole.UserRole)
+            slug_url = index.data(Qt.ItemDataRole.UserRole)
 
             menu = QMenu()
 
@@ -596,10 +686,14 @@ class MangaDownloaderApp(QMainWindow):
             chapters_action.triggered.connect(lambda: self.load_chapters(slug_url))
             menu.addAction(chapters_action)
 
+            watch_action = QAction("Отслеживать новые главы", self)
+            watch_action.triggered.connect(lambda: self.watch_title(slug_url))
+            menu.addAction(watch_action)
+
             # Для колонки slug URL добавляем копирование
-            if self.manga_table.columnAt(pos.x()) == 4:
+            if index.column() == SLUG_COLUMN:
                 copy_action = QAction("Копировать Slug URL", self)
-                copy_action.triggered.connect(lambda: self.copy_to_clipboard(item.text()))
+                copy_action.triggered.connect(lambda: self.copy_to_clipboard(slug_url))
                 menu.addAction(copy_action)
 
             menu.exec(self.manga_table.viewport().mapToGlobal(pos))
@@ -619,27 +713,10 @@ class MangaDownloaderApp(QMainWindow):
             logging.error("Clipboard error:", exc_info=True)
             QMessageBox.critical(self, "Ошибка", f"Ошибка копирования:\n{str(e)}")
 
-    def update_cover(self, slug_url, pixmap):
-        for row in range(self.manga_table.rowCount()):
-            if self.manga_table.item(row, 1).data(Qt.ItemDataRole.UserRole) == slug_url:
-                label = self.manga_table.cellWidget(row, 0)
-                if isinstance(label, QLabel):
-                    # Масштабируем изображение с сохранением пропорций
-                    scaled_pixmap = pixmap.scaled(
-                        label.width(), label.height(),
-                        Qt.AspectRatioMode.KeepAspectRatio,
-                        Qt.TransformationMode.SmoothTransformation
-                    )
-                    label.setPixmap(scaled_pixmap)
-
-                    # Центрируем изображение
-                    label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                break
-
     # Добавим новые методы для загрузки и отображения глав
     def load_chapters(self, slug_url):
         self.log_message(f"[{datetime.now().strftime('%H:%M:%S')}] Загрузка глав...", "info")
-        thread = ChaptersLoaderThread(slug_url)
+        thread = ChaptersLoaderThread(slug_url, self.download_queue.library)
         thread.chapters_loaded.connect(self.show_chapters_dialog)
         thread.error_occurred.connect(lambda e: self.log_message(e, "error"))
 
@@ -652,45 +729,39 @@ class MangaDownloaderApp(QMainWindow):
         self.chapter_threads.append(thread)
         thread.start()
 
-    def show_chapters_dialog(self, chapters):
-        dialog = ChaptersDialog(self)
+    def show_chapters_dialog(self, slug_url, chapters, states):
+        dialog = ChaptersDialog(slug_url, ChapterTreeModel(chapters, states), self)
+        dialog.download_requested.connect(self.download_selected)
+        dialog.show()
 
-        # Группируем главы по томам
-        volumes = {}
-        for chapter in chapters:
-            vol = chapter.get('volume', 'Без тома')
-            if vol not in volumes:
-                volumes[vol] = []
-            volumes[vol].append(chapter)
-
-        # Заполняем дерево
-        for volume, chapters in volumes.items():
-            volume_item = QTreeWidgetItem(dialog.tree, [str(volume)])
-            for chap in chapters:
-                chapter_number = chap.get('number', 'N/A')
-                name = chap.get('name', 'Без названия') or 'Без названия'
-                QTreeWidgetItem(volume_item, [str(volume), chapter_number, name])
-
-        dialog.tree.expandAll()
-        dialog.exec()
+    def download_selected(self, slug_url, jobs):
+        if not self.save_directory:
+            self.log_message("Сначала выберите папку для сохранения!", "error")
+            return
+        self.enqueue_jobs(slug_url, jobs, self.save_directory)
 
 
 # Добавим новый класс потока для загрузки глав
 class ChaptersLoaderThread(QThread):
-    chapters_loaded = pyqtSignal(list)
+    # slug, главы, {(том, глава): состояние в библиотеке}
+    chapters_loaded = pyqtSignal(str, list, dict)
     error_occurred = pyqtSignal(str)
 
-    def __init__(self, slug_url):
+    def __init__(self, slug_url, library=None):
         super().__init__()
         self.slug_url = slug_url
+        self.library = library
 
     def run(self):
         try:
-            url = f"https://api.lib.social/api/manga/{self.slug_url}/chapters"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            self.chapters_loaded.emit(data.get('data', []))
+            chapters = get_chapters(self.slug_url)
+            states = {}
+            if self.library is not None:
+                try:
+                    states = {key: row["state"] for key, row in self.library.chapters(self.slug_url).items()}
+                except Exception as e:
+                    logger.warning(f"Library read error: {str(e)}")
+            self.chapters_loaded.emit(self.slug_url, chapters, states)
         except Exception as e:
             self.error_occurred.emit(f"Ошибка загрузки глав: {str(e)}")
         finally:
@@ -699,20 +770,86 @@ class ChaptersLoaderThread(QThread):
 
 # Добавим новый диалог для отображения глав
 class ChaptersDialog(QDialog):
-    def __init__(self, parent=None):
+    """ Дерево томов и глав с фильтром; выделенные тома и главы сразу ставятся в очередь """
+    download_requested = pyqtSignal(str, list)
+
+    def __init__(self, slug_url, model, parent=None):
         super().__init__(parent)
-        self.setWindowTitle("Тома и главы")
+        self.slug_url = slug_url
+        self.model = model
+        self.model.setParent(self)
+        self.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+        self.setWindowTitle(f"Тома и главы — {slug_url}")
         self.setMinimumSize(600, 400)
 
         layout = QVBoxLayout(self)
-        self.tree = QTreeWidget()
-        self.tree.setHeaderLabels(["Том", "Глава", "Название"])
-        self.tree.header().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Фильтр: номера глав (10-20, 25) или часть названия")
+        self.filter_input.textChanged.connect(self.apply_filter)
+        layout.addWidget(self.filter_input)
+
+        self.tree = QTreeView()
+        self.tree.setModel(self.model)
+        # Одинаковая высота строк и фиксированные колонки: дерево не измеряет все строки
+        self.tree.setUniformRowHeights(True)
+        self.tree.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.tree.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.tree.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.tree.header().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
+        self.tree.header().setStretchLastSection(False)
+        self.tree.setColumnWidth(0, 160)
+        self.tree.setColumnWidth(2, 110)
+        self.tree.selectionModel().selectionChanged.connect(self.update_selection)
         layout.addWidget(self.tree)
 
+        button_layout = QHBoxLayout()
+        self.count_label = QLabel()
+        button_layout.addWidget(self.count_label)
+        button_layout.addStretch()
+        self.download_button = QPushButton("Скачать выбранные")
+        self.download_button.clicked.connect(self.download_selected)
+        button_layout.addWidget(self.download_button)
+        layout.addLayout(button_layout)
+        self.update_selection()
+
+    def apply_filter(self, text):
+        self.model.set_filter(text)
+        # Отфильтрованный список обычно короткий — тома раскрываются сразу
+        if text.strip() and self.model.chapter_count() <= 200:
+            self.tree.expandAll()
+        self.update_selection()
+
+    def selected_jobs(self):
+        return self.model.jobs_for(self.tree.selectionModel().selectedRows())
+
+    def update_selection(self):
+        selected = len(self.selected_jobs())
+        self.count_label.setText(f"Глав: {self.model.chapter_count()}, выбрано: {selected}")
+        self.download_button.setEnabled(bool(selected))
+
+    def download_selected(self):
+        jobs = self.selected_jobs()
+        if jobs:
+            self.download_requested.emit(self.slug_url, jobs)
+
 
 if __name__ == "__main__":
+    # Обработка страниц идёт в пуле процессов; нужно для сборки в exe
+    multiprocessing.freeze_support()
+    log_listener = setup_logging([
+        logging.FileHandler('manga_downloader.log'),
+        logging.StreamHandler()
+    ])
+    # Метрики в формате Prometheus и JSON: http://127.0.0.1:<порт>/metrics
+    if os.environ.get("MANGALIB_METRICS_PORT"):
+        start_metrics_server(int(os.environ["MANGALIB_METRICS_PORT"]))
+    # Каждый HTTP-запрос с кодом ответа и временем — в журнал
+    if os.environ.get("MANGALIB_HTTP_TRACE"):
+        default_client.add_hook(log_trace)
+    # Адреса хостов кэшируются на MANGALIB_DNS_TTL секунд (0 — без кэша)
+    default_client.enable_dns_cache(float(os.environ.get("MANGALIB_DNS_TTL", DNS_TTL)))
     app = QApplication([])
     window = MangaDownloaderApp()
     window.show()
     app.exec()
+    log_listener.stop()
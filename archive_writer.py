@@ -0,0 +1,160 @@
+""" CBZ и EPUB (фиксированная вёрстка) из готовых страниц. Изображения кладутся в
+архив без сжатия и перекодирования, файлы копируются потоком, поэтому память не
+зависит от числа страниц, а процессор почти не нужен. Архив пишется во временный
+файл и появляется под итоговым именем только целиком """
+import hashlib
+import os
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+from image_processing import EXTENSIONS, detect_format
+
+MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp", "gif": "image/gif",
+               "bmp": "image/bmp", "avif": "image/avif"}
+# Для файла, формат которого не распознан: читатель определит его сам, а не по неверному типу
+UNKNOWN_MEDIA_TYPE = "application/octet-stream"
+
+
+def image_size(path):
+    """ Ширина и высота страницы; Pillow читает только заголовок файла """
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return image.size
+
+
+class ArchiveWriter:
+    """ Zip-архив, который пишется в .tmp и переименовывается в close() """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.tmp_path = output_path + ".tmp"
+        self.zip = zipfile.ZipFile(self.tmp_path, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_file(self, path, name):
+        # ZIP_STORED: изображения уже сжаты, ZipFile копирует файл блоками
+        self.zip.write(path, name, compress_type=zipfile.ZIP_STORED)
+
+    def add_text(self, name, text, compress=True):
+        self.zip.writestr(name, text, compress_type=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+
+    def close(self):
+        self.zip.close()
+        os.replace(self.tmp_path, self.output_path)
+
+    def abort(self):
+        self.zip.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def page_name(number, path):
+    image_format = detect_format(path)
+    return f"{number:03}{EXTENSIONS.get(image_format, os.path.splitext(path)[1])}", image_format
+
+
+def write_cbz(image_paths, output_path, info=None):
+    """ info — словарь с ключами title, series, volume, number для ComicInfo.xml """
+    info = info or {}
+    with ArchiveWriter(output_path) as archive:
+        for number, path in enumerate(image_paths, start=1):
+            archive.add_file(path, page_name(number, path)[0])
+        archive.add_text("ComicInfo.xml", (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ComicInfo xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+            f'  <Title>{escape(str(info.get("title", "")))}</Title>\n'
+            f'  <Series>{escape(str(info.get("series", "")))}</Series>\n'
+            f'  <Volume>{escape(str(info.get("volume", "")))}</Volume>\n'
+            f'  <Number>{escape(str(info.get("number", "")))}</Number>\n'
+            f'  <PageCount>{len(image_paths)}</PageCount>\n'
+            '</ComicInfo>\n'
+        ))
+
+
+CONTAINER_XML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+    '  <rootfiles>\n'
+    '    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>\n'
+    '  </rootfiles>\n'
+    '</container>\n'
+)
+
+
+def write_epub(image_paths, output_path, info=None):
+    """ EPUB 3 с фиксированной вёрсткой: одна страница — одно изображение во весь экран """
+    info = info or {}
+    title = escape(str(info.get("title") or os.path.splitext(os.path.basename(output_path))[0]))
+    # Постоянный идентификатор главы: читалки по нему узнают уже добавленную книгу
+    identity = f"{info.get('series', '')}/{info.get('volume', '')}/{info.get('number', '')}/{title}"
+    identifier = uuid.UUID(hashlib.md5(identity.encode()).hexdigest())
+    items = []
+    spine = []
+    with ArchiveWriter(output_path) as archive:
+        # mimetype должен быть первым и несжатым
+        archive.add_text("mimetype", "application/epub+zip", compress=False)
+        archive.add_text("META-INF/container.xml", CONTAINER_XML)
+
+        for number, path in enumerate(image_paths, start=1):
+            name, image_format = page_name(number, path)
+            width, height = image_size(path)
+            archive.add_file(path, f"OEBPS/images/{name}")
+            archive.add_text(f"OEBPS/pages/page-{number:03}.xhtml", (
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<!DOCTYPE html>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+                f'<head><title>{number}</title>'
+                f'<meta name="viewport" content="width={width}, height={height}"/>'
+                '<style>body{margin:0;padding:0}img{display:block;width:100%;height:100%}</style></head>\n'
+                f'<body><img src="../images/{name}" alt="{number}" width="{width}" height="{height}"/></body>\n'
+                '</html>\n'
+            ))
+            properties = ' properties="cover-image"' if number == 1 else ""
+            items.append(f'<item id="img{number:03}" href="images/{name}" '
+                         f'media-type="{MEDIA_TYPES.get(image_format, UNKNOWN_MEDIA_TYPE)}"{properties}/>')
+            items.append(f'<item id="page{number:03}" href="pages/page-{number:03}.xhtml" '
+                         f'media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="page{number:03}"/>')
+
+        archive.add_text("OEBPS/nav.xhtml", (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+            f'<head><title>{title}</title></head>\n'
+            '<body><nav epub:type="toc"><ol>'
+            f'<li><a href="pages/page-001.xhtml">{title}</a></li>'
+            '</ol></nav></body>\n'
+            '</html>\n'
+        ))
+        modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        archive.add_text("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+            '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            f'    <dc:identifier id="book-id">urn:uuid:{identifier}</dc:identifier>\n'
+            f'    <dc:title>{title}</dc:title>\n'
+            '    <dc:language>ru</dc:language>\n'
+            f'    <meta property="dcterms:modified">{modified}</meta>\n'
+            '    <meta property="rendition:layout">pre-paginated</meta>\n'
+            '    <meta property="rendition:spread">none</meta>\n'
+            '  </metadata>\n'
+            '  <manifest>\n'
+            '    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+            + "".join(f"    {item}\n" for item in items) +
+            '  </manifest>\n'
+            '  <spine>\n'
+            + "".join(f"    {itemref}\n" for itemref in spine) +
+            '  </spine>\n'
+            '</package>\n'
+        ))
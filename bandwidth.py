@@ -0,0 +1,237 @@
+""" Распределение скорости между передачами одного процесса. Каждая передача
+относится к классу: interactive (поиск, обложки, список глав в окне) важнее
+foreground (главы, которые пользователь поставил в очередь сам), а foreground —
+background (новые главы отслеживаемых тайтлов, массовая архивация). Пока идёт
+запрос более высокого класса, блоки низших классов ждут — но не дольше MAX_YIELD
+на блок, чтобы их соединения не оборвались по таймауту. Поэтому поиск отзывчив
+во время большой загрузки, а в остальное время архив качается на всей скорости.
+
+С общим ограничением скорости (rate, байт в секунду) байты выдаются из одного
+token bucket, а главы одного класса делят его по весу (взвешенная справедливая
+очередь по виртуальному времени) — независимо от того, сколько потоков качает
+каждую главу. Без ограничения узкое место — канал, которого процесс не видит,
+и веса не действуют.
+
+Планировщик работает внутри процесса: служба и окно программы, а также
+процессы архивации распределяют скорость каждый сам по себе """
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import default_metrics
+
+INTERACTIVE = 0
+FOREGROUND = 1
+BACKGROUND = 2
+TRAFFIC_CLASSES = {"interactive": INTERACTIVE, "foreground": FOREGROUND, "background": BACKGROUND}
+CLASS_NAMES = {value: name for name, value in TRAFFIC_CLASSES.items()}
+
+# Сколько блок низшего класса уступает высшим, секунд
+MAX_YIELD = 1.0
+# Запас token bucket — столько секунд скорости
+BURST_SECONDS = 0.25
+MIN_CHUNK_SIZE = 16 * 1024
+MIN_WEIGHT = 0.01
+# Как часто ждущий блок проверяет отмену
+WAIT_STEP = 0.1
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+local = threading.local()
+
+
+def parse_rate(text):
+    """ "500K", "2M", "1.5m" -> байт в секунду; "0" — без ограничения """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgKMG]?)[bB]?\s*", str(text))
+    if match is None:
+        raise ValueError(f"Неверная скорость: {text!r} (например 500K или 2M)")
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).upper()])
+
+
+def format_rate(rate):
+    if not rate:
+        return "без ограничения"
+    for unit in ("G", "M", "K"):
+        if rate >= RATE_UNITS[unit]:
+            return f"{rate / RATE_UNITS[unit]:g} {unit}Б/с"
+    return f"{rate} Б/с"
+
+
+def priority_weight(priority):
+    """ Вес главы по приоритету службы: 0 — 1, каждый шаг вверх добавляет единицу,
+    отрицательный приоритет уменьшает долю """
+    return 1.0 + priority if priority >= 0 else 1.0 / (1 - priority)
+
+
+def weight_priority(weight):
+    """ Обратное к priority_weight, с округлением до целого приоритета """
+    return round(weight - 1) if weight >= 1 else round(1 - 1 / max(weight, MIN_WEIGHT))
+
+
+@contextmanager
+def traffic(traffic_class):
+    """ Запросы этого потока внутри блока, у которых нет своего Flow, относятся к traffic_class """
+    previous = getattr(local, "traffic_class", INTERACTIVE)
+    local.traffic_class = traffic_class
+    try:
+        yield
+    finally:
+        local.traffic_class = previous
+
+
+class Flow:
+    """ Поток байт одной главы или одного запроса. Все потоки загрузки главы пишут
+    в один Flow, поэтому глава получает долю по весу, а не по числу соединений """
+
+    def __init__(self, scheduler, traffic_class, weight=1.0):
+        self.scheduler = scheduler
+        self.traffic_class = traffic_class
+        self.weight = max(weight, MIN_WEIGHT)
+        # Виртуальное время, до которого поток уже получил свою долю
+        self.finish = 0.0
+        # Сколько запросов потока сейчас идёт
+        self.transfers = 0
+
+    def set_weight(self, weight):
+        self.weight = max(weight, MIN_WEIGHT)
+
+    def consume(self, count, cancel_event=None):
+        self.scheduler.acquire(self, count, cancel_event)
+
+    def close(self):
+        self.scheduler.close_flow(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class BandwidthScheduler:
+    """ Все методы потокобезопасны; rate = 0 — без общего ограничения """
+
+    def __init__(self, rate=0, metrics=None):
+        self.metrics = metrics or default_metrics
+        self.condition = threading.Condition()
+        self.rate = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.virtual_time = 0.0
+        self.flows = set()
+        # Блоки, ждущие выдачи: [класс, виртуальное время начала, до какого момента уступать]
+        self.waiting = []
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.condition:
+            rate = max(0, int(rate or 0))
+            self.tokens = min(self.tokens, rate * BURST_SECONDS) if self.rate else rate * BURST_SECONDS
+            self.rate = rate
+            self.updated = time.monotonic()
+            self.condition.notify_all()
+
+    def chunk_size(self, size):
+        """ С ограничением скорости блок не больше её четверти: крупный блок уводит
+        token bucket в долг, и соседние главы ждут его целиком """
+        if not self.rate:
+            return size
+        return max(MIN_CHUNK_SIZE, min(size, int(self.rate * BURST_SECONDS)))
+
+    def open(self, traffic_class=None, weight=1.0):
+        """ Без класса — класс, заданный traffic() для этого потока, иначе interactive """
+        if traffic_class is None:
+            traffic_class = getattr(local, "traffic_class", INTERACTIVE)
+        flow = Flow(self, traffic_class, weight)
+        with self.condition:
+            self.flows.add(flow)
+        return flow
+
+    def close_flow(self, flow):
+        with self.condition:
+            self.flows.discard(flow)
+            self.condition.notify_all()
+
+    @contextmanager
+    def transfer(self, flow=None):
+        """ Один запрос: пока он идёт, передачи низших классов уступают.
+        Без flow запрос получает собственный Flow """
+        own = flow is None
+        if own:
+            flow = self.open()
+        with self.condition:
+            flow.transfers += 1
+        try:
+            yield flow
+        finally:
+            with self.condition:
+                flow.transfers -= 1
+                if own:
+                    self.flows.discard(flow)
+                self.condition.notify_all()
+
+    def preempted(self, traffic_class):
+        """ Идёт ли сейчас запрос более высокого класса. Вызывается под self.condition """
+        return any(flow.traffic_class < traffic_class and flow.transfers for flow in self.flows)
+
+    def refill(self, now):
+        self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, request, now):
+        """ Сколько ещё ждать блоку; 0 — можно пропускать. Вызывается под self.condition """
+        traffic_class, start, yield_until = request
+        if now < yield_until and self.preempted(traffic_class):
+            return yield_until - now
+        if not self.rate:
+            return 0.0
+        # Токены получает первый блок очереди: высший класс, внутри класса — меньшее виртуальное время
+        for other in self.waiting:
+            if other is not request and other[:2] < request[:2] and not (
+                    now < other[2] and self.preempted(other[0])):
+                return WAIT_STEP
+        self.refill(now)
+        if self.tokens > 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def acquire(self, flow, count, cancel_event=None):
+        """ Ждёт, пока блок из count байт можно пропустить """
+        with self.condition:
+            if not self.rate and not self.preempted(flow.traffic_class):
+                return
+            started = time.monotonic()
+            start = max(self.virtual_time, flow.finish)
+            flow.finish = start + count / flow.weight
+            request = [flow.traffic_class, start, started + MAX_YIELD]
+            self.waiting.append(request)
+            try:
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise InterruptedError("Загрузка отменена")
+                    delay = self.delay(request, time.monotonic())
+                    if delay <= 0:
+                        break
+                    self.condition.wait(min(delay, WAIT_STEP))
+            finally:
+                self.waiting.remove(request)
+                self.condition.notify_all()
+            if self.rate:
+                self.tokens -= count
+            self.virtual_time = max(self.virtual_time, start)
+            waited = time.monotonic() - started
+        self.metrics.observe("bandwidth_wait_seconds", waited, traffic=CLASS_NAMES.get(flow.traffic_class, ""))
+
+    def status(self):
+        with self.condition:
+            active = {}
+            for flow in self.flows:
+                if flow.transfers:
+                    name = CLASS_NAMES.get(flow.traffic_class, "")
+                    active[name] = active.get(name, 0) + 1
+            return {"rate": self.rate, "active": active, "waiting": len(self.waiting)}
+
+
+# Общий планировщик для всех запросов процесса
+default_bandwidth = BandwidthScheduler()
@@ -0,0 +1,222 @@
+""" Замеры производительности на локальном stub_server.py: скорость загрузки
+страниц, время на главу, время сборки PDF, поиск с обложками и пиковая память.
+
+    python benchmark.py
+    python benchmark.py --latency 0.05 --bandwidth 1024 --error-rate 0.02 --json result.json
+
+Числа из --json удобно сравнивать между версиями, чтобы замечать регрессии """
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import core
+from core import DEFAULT_CHAPTER_JOBS, DEFAULT_PAGE_WORKERS, DownloadScheduler, resolve_jobs, search_manga
+from pdf_writer import write_pdf
+from stub_server import StubConfig, start_stub_server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """ Пиковая память процесса и дочерних процессов (обработка страниц), МБ """
+    if resource is None:
+        return None
+    # ru_maxrss: килобайты на Linux, байты на macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return round(max(own, children), 1)
+
+
+def download_chapters(slug, jobs, directory, max_jobs, page_workers):
+    """ Скачивает главы без сборки; возвращает (секунд, страниц, [секунд на главу], ошибок) """
+    chapter_times = []
+    failed = []
+
+    def on_job_finished(downloader, save_dir):
+        chapter_times.append(time.monotonic() - downloader.started_at)
+        if not save_dir:
+            failed.append(downloader.label)
+
+    scheduler = DownloadScheduler(max_jobs=max_jobs, page_workers=page_workers, formats=(),
+                                  on_job_finished=on_job_finished)
+    started = time.monotonic()
+    for volume, chapter in jobs:
+        scheduler.enqueue(slug, volume, chapter, directory)
+    scheduler.wait()
+    elapsed = time.monotonic() - started
+    scheduler.close()
+    pages = sum(
+        1 for root, _, files in os.walk(directory)
+        for name in files if name[:3].isdigit() and not name.endswith((".part", ".tmp"))
+    )
+    return elapsed, pages, chapter_times, len(failed)
+
+
+def chapter_result(elapsed, pages, chapter_times, failed):
+    return {
+        "seconds": round(elapsed, 3),
+        "pages": pages,
+        "pages_per_sec": round(pages / elapsed, 1) if elapsed else None,
+        "chapter_seconds_avg": round(sum(chapter_times) / len(chapter_times), 3) if chapter_times else None,
+        "chapter_seconds_max": round(max(chapter_times), 3) if chapter_times else None,
+        "failed_chapters": failed,
+    }
+
+
+def bench_single(slug, directory, page_workers):
+    elapsed, pages, chapter_times, failed = download_chapters(slug, [("1", "1")], directory, 1, page_workers)
+    result = chapter_result(elapsed, pages, chapter_times, failed)
+
+    chapter_dir = os.path.join(directory, core.sanitize_folder_name(slug.split("--", 1)[-1]), "Volume_1", "Chapter_1")
+    image_paths = sorted(
+        os.path.join(chapter_dir, name) for name in os.listdir(chapter_dir) if name[:3].isdigit()
+    )
+    started = time.monotonic()
+    write_pdf(image_paths, os.path.join(chapter_dir, "benchmark.pdf"))
+    result["pdf_seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+
+def bench_bulk(slug, directory, max_jobs, page_workers):
+    jobs = resolve_jobs(slug, "", "")
+    return chapter_result(*download_chapters(slug, jobs, directory, max_jobs, page_workers))
+
+
+def bench_mirrors(slug, directory, max_jobs, page_workers, config, fast_url):
+    """ Массовая загрузка, когда основной сервер изображений медленный и часто
+    отвечает ошибкой, а зеркало исправно: скорость должна остаться близкой к bulk """
+    slow_config = StubConfig(**dict(vars(config), latency=config.latency + 1.0, error_rate=0.3))
+    slow = start_stub_server(slow_config)
+    core.set_image_hosts([slow.base_url, fast_url])
+    try:
+        result = bench_bulk(slug, directory, max_jobs, page_workers)
+    finally:
+        core.set_image_hosts([fast_url])
+        slow.shutdown()
+        slow.server_close()
+    result["slow_host_requests"] = slow.requests
+    return result
+
+
+def bench_search(query, pages):
+    """ Поиск по страницам и загрузка обложек через CoverService (Qt без окна) """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PyQt6.QtGui import QGuiApplication
+        from covers import CoverService
+    except ImportError as e:
+        return {"skipped": f"PyQt6 недоступен: {e}"}
+
+    app = QGuiApplication.instance() or QGuiApplication([])
+    started = time.monotonic()
+    results = []
+    for page in range(1, pages + 1):
+        results.extend(search_manga(query, page=page))
+    search_seconds = time.monotonic() - started
+
+    cover_urls = {manga["cover"]["default"] for manga in results if manga.get("cover")}
+    ready = set()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        service = CoverService(cache_dir=cache_dir)
+        service.cover_ready.connect(lambda url, pixmap: ready.add(url))
+        service.error_occurred.connect(lambda url, message: ready.add(url))
+        started = time.monotonic()
+        for url in cover_urls:
+            service.request(url)
+        deadline = started + 60
+        while len(ready) < len(cover_urls) and time.monotonic() < deadline:
+            app.processEvents()
+            time.sleep(0.005)
+        cover_seconds = time.monotonic() - started
+        service.shutdown()
+    return {
+        "search_seconds": round(search_seconds, 3),
+        "results": len(results),
+        "covers": len(ready),
+        "cover_seconds": round(cover_seconds, 3),
+        "covers_per_sec": round(len(ready) / cover_seconds, 1) if cover_seconds else None,
+    }
+
+
+def print_report(report):
+    print(f"Python {report['python']}, {report['platform']}")
+    for name, result in report["scenarios"].items():
+        print(f"\n{name}:")
+        for key, value in result.items():
+            print(f"  {key:22} {value}")
+    print(f"\npeak_rss_mb            {report['peak_rss_mb']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры загрузки на локальном сервере-заглушке")
+    parser.add_argument("--scenario", action="append", choices=["single", "bulk", "mirrors", "search"],
+                        help="какие замеры выполнить; по умолчанию все")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа сервера, секунд")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--bandwidth", type=int, default=0, help="КБ/с на соединение; 0 — без ограничения")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=300, help="размер страницы, КБ")
+    parser.add_argument("--pages", type=int, default=30, help="страниц в главе")
+    parser.add_argument("--volumes", type=int, default=2)
+    parser.add_argument("--chapters", type=int, default=5, help="глав в томе")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_CHAPTER_JOBS)
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_PAGE_WORKERS)
+    parser.add_argument("--json", help="сохранить результаты в файл JSON")
+    args = parser.parse_args(argv)
+
+    config = StubConfig(
+        latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth * 1024, error_rate=args.error_rate,
+        page_size=args.page_size * 1024, pages=args.pages, volumes=args.volumes, chapters=args.chapters
+    )
+    server = start_stub_server(config)
+    core.API_BASE_URL = f"{server.base_url}/api/manga"
+    core.set_image_hosts([server.base_url])
+    # Замеряется сеть и диск, а не кэш ответов API
+    core.metadata_cache.enabled = False
+
+    scenarios = args.scenario or ["single", "bulk", "mirrors", "search"]
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stub": vars(config),
+        "jobs": args.jobs,
+        "workers": args.workers,
+        "scenarios": {},
+    }
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            if "single" in scenarios:
+                report["scenarios"]["single"] = bench_single(
+                    "1--bench-single", os.path.join(directory, "single"), args.workers)
+            if "bulk" in scenarios:
+                report["scenarios"]["bulk"] = bench_bulk(
+                    "2--bench-bulk", os.path.join(directory, "bulk"), args.jobs, args.workers)
+            if "mirrors" in scenarios:
+                report["scenarios"]["mirrors"] = bench_mirrors(
+                    "3--bench-mirrors", os.path.join(directory, "mirrors"), args.jobs, args.workers,
+                    config, server.base_url)
+        if "search" in scenarios:
+            report["scenarios"]["search"] = bench_search("bench", config.search_pages)
+    finally:
+        server.shutdown()
+        server.server_close()
+    report["requests"] = server.requests
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+""" Модель дерева томов и глав для QTreeView. Тома видны сразу, главы тома
+добавляются порциями при раскрытии (canFetchMore/fetchMore), поэтому тайтл
+с тысячами глав открывается так же быстро, как короткий. Фильтр применяется
+к данным модели, а не через прокси, чтобы не загружать все главы ради поиска """
+from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex
+
+from core import number_in_ranges, parse_number_ranges
+
+# Сколько глав тома добавляется в дерево за один fetchMore
+FETCH_BATCH = 200
+NO_VOLUME = "Без тома"
+
+
+class VolumeNode:
+    def __init__(self, row, volume, chapters):
+        # Строка тома в дереве: parent() вызывается при каждой отрисовке, поиск по списку был бы O(n)
+        self.row = row
+        self.volume = volume
+        self.chapters = chapters
+        # Сколько глав уже добавлено в модель
+        self.loaded = 0
+
+
+def chapter_matches(chapter, ranges, text):
+    """ Фильтр: диапазоны номеров ("10-20, 25") или часть названия """
+    if ranges is not None:
+        return number_in_ranges(chapter.get('number'), ranges)
+    return text in (chapter.get('name') or '').casefold()
+
+
+class ChapterTreeModel(QAbstractItemModel):
+    HEADERS = ["Том / глава", "Название", "В библиотеке"]
+    STATE_LABELS = {"complete": "скачана", "incomplete": "не докачана"}
+
+    def __init__(self, chapters, states=None, parent=None):
+        super().__init__(parent)
+        self.chapters = chapters
+        # (том, глава) -> состояние из библиотеки
+        self.states = states or {}
+        self.volumes = []
+        self.build()
+
+    def build(self, ranges=None, text=""):
+        groups = {}
+        for chapter in self.chapters:
+            if ranges is None and not text or chapter_matches(chapter, ranges, text):
+                groups.setdefault(str(chapter.get('volume', NO_VOLUME)), []).append(chapter)
+        self.volumes = [VolumeNode(row, volume, chapters) for row, (volume, chapters) in enumerate(groups.items())]
+
+    def set_filter(self, text):
+        """ Оставляет главы с подходящим номером или названием; пустая строка — все главы """
+        text = text.strip()
+        try:
+            ranges = parse_number_ranges(text)
+        except ValueError:
+            ranges = None
+        self.beginResetModel()
+        self.build(ranges, text.casefold())
+        self.endResetModel()
+
+    def chapter_count(self):
+        return sum(len(node.chapters) for node in self.volumes)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column)
+        # Внутренний указатель главы — узел её тома
+        return self.createIndex(row, column, self.volumes[parent.row()])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        node = index.internalPointer()
+        if node is None:
+            return QModelIndex()
+        return self.createIndex(node.row, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.volumes)
+        if parent.internalPointer() is None and parent.column() == 0:
+            return self.volumes[parent.row()].loaded
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return bool(self.volumes)
+        return parent.internalPointer() is None and parent.column() == 0 and bool(
+            self.volumes[parent.row()].chapters)
+
+    def canFetchMore(self, parent):
+        if not parent.isValid() or parent.internalPointer() is not None:
+            return False
+        node = self.volumes[parent.row()]
+        return node.loaded < len(node.chapters)
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = self.volumes[parent.row()]
+        count = min(FETCH_BATCH, len(node.chapters) - node.loaded)
+        self.beginInsertRows(parent, node.loaded, node.loaded + count - 1)
+        node.loaded += count
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        node = index.internalPointer()
+        if node is None:
+            volume = self.volumes[index.row()]
+            if index.column() == 0:
+                # Глава без тома приходит из API с volume = None
+                if volume.volume in (NO_VOLUME, "None", ""):
+                    return f"{NO_VOLUME} ({len(volume.chapters)})"
+                return f"Том {volume.volume} ({len(volume.chapters)})"
+            if index.column() == 2:
+                done = sum(self.state_of(volume.volume, chapter) == "complete" for chapter in volume.chapters)
+                return f"{done} из {len(volume.chapters)}" if done else ""
+            return None
+        chapter = node.chapters[index.row()]
+        if index.column() == 0:
+            return f"Глава {chapter.get('number', 'N/A')}"
+        if index.column() == 1:
+            return chapter.get('name') or 'Без названия'
+        return self.STATE_LABELS.get(self.state_of(node.volume, chapter), "")
+
+    def state_of(self, volume, chapter):
+        return self.states.get((volume, str(chapter.get('number'))))
+
+    def jobs_for(self, indexes):
+        """ Пары (том, глава) для выделенных строк: выделенный том — все его главы
+        с учётом фильтра, в том числе ещё не показанные. Порядок — как в дереве """
+        selected = set()
+        for index in indexes:
+            if index.column() != 0:
+                continue
+            node = index.internalPointer()
+            if node is None:
+                selected.update((self.volumes[index.row()].volume, i)
+                                for i in range(len(self.volumes[index.row()].chapters)))
+            else:
+                selected.add((node.volume, index.row()))
+        return [
+            (node.volume, str(chapter.get('number')))
+            for node in self.volumes
+            for i, chapter in enumerate(node.chapters)
+            if (node.volume, i) in selected
+        ]
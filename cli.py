@@ -0,0 +1,495 @@
+""" Загрузка манги из командной строки, без PyQt6.
+
+Примеры:
+    python cli.py download 4852--domestic-na-kanojo --volumes 1-5 --jobs 4
+    python cli.py download 118--hellsing --volumes 2 --chapters 10-12 -o ~/manga
+    python cli.py chapters 118--hellsing
+    python cli.py search Hellsing
+    python cli.py watch add 118--hellsing -o ~/manga
+    python cli.py sync
+    python cli.py daemon --port 8790
+    python cli.py archive submit /mnt/share/queue.sqlite3 118--hellsing -o /mnt/share/manga
+    python cli.py archive work /mnt/share/queue.sqlite3 --processes 4
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import core
+from bandwidth import parse_rate
+from core import (
+    DEFAULT_CHAPTER_JOBS, DEFAULT_EXPORT_FORMATS, DEFAULT_HOST_CONNECTIONS, DEFAULT_PAGE_WORKERS, EXPORT_FORMATS,
+    MAX_PAGE_WORKERS, DownloadScheduler, get_chapters, parse_number_ranges, resolve_jobs, search_manga
+)
+from daemon import (
+    DEFAULT_PORT, DownloadService, JobStore, create_token, default_token_path, load_token, start_service
+)
+from http_client import DNS_TTL, default_client
+from image_processing import DEFAULT_PROFILE, PROFILES
+from library import LibraryIndex, sync_watchlist, watch
+from metrics import default_metrics, start_metrics_server
+from page_store import STORE_DIRNAME, store_for
+from page_writer import FSYNC_NONE, FSYNC_POLICIES
+from work_queue import DEFAULT_LEASE, ShardWorker, WorkQueue
+
+logger = logging.getLogger(__name__)
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("значение должно быть больше нуля")
+    return number
+
+
+def jpeg_quality(value):
+    number = int(value)
+    if not 1 <= number <= 95:
+        raise argparse.ArgumentTypeError("качество JPEG должно быть от 1 до 95")
+    return number
+
+
+def non_negative_float(value):
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("значение не может быть отрицательным")
+    return number
+
+
+def rate_limit(value):
+    try:
+        return parse_rate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def print_trace(event):
+    result = event["status"] if event["error"] is None else f"ошибка: {event['error']}"
+    print(f"GET {event['url']} {result} {event['seconds']:.3f} с", file=sys.stderr, flush=True)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Загрузка манги с mangalib без графического интерфейса")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный журнал в stderr")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать дисковый кэш ответов API")
+    parser.add_argument("--api-url", help=f"адрес API (по умолчанию {core.API_BASE_URL})")
+    parser.add_argument("--image-url", action="append",
+                        help=f"адрес сервера изображений (по умолчанию {core.IMAGE_BASE_URL}); "
+                             f"если указан несколько раз, остальные адреса — зеркала")
+    parser.add_argument("--metrics-port", type=int,
+                        help="отдавать метрики по HTTP: /metrics (Prometheus) и /metrics.json")
+    parser.add_argument("--trace-http", action="store_true",
+                        help="выводить в stderr каждый HTTP-запрос с кодом ответа и временем")
+    parser.add_argument("--dns-ttl", type=non_negative_float, default=DNS_TTL,
+                        help=f"сколько секунд помнить адреса хостов (по умолчанию {DNS_TTL:g}, 0 — не кэшировать)")
+    parser.add_argument("--library", help="файл библиотеки скачанных глав (по умолчанию в папке данных пользователя)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    download = commands.add_parser("download", help="скачать главы")
+    download.add_argument("slug", help="slug URL манги, например 118--hellsing")
+    download.add_argument("--volumes", default="", help="тома: 3, 1-5, 1,3,7-9; пусто — все")
+    download.add_argument("--chapters", default="", help="главы: 12, 10-120; пусто — все")
+    download.add_argument("-o", "--output", default=".", help="папка для сохранения (по умолчанию текущая)")
+    add_download_options(download)
+
+    sync = commands.add_parser("sync", help="скачать новые и недокачанные главы отслеживаемых тайтлов")
+    add_download_options(sync)
+
+    watch_command = commands.add_parser("watch", help="список отслеживаемых тайтлов")
+    watch_actions = watch_command.add_subparsers(dest="action", required=True)
+    watch_add = watch_actions.add_parser("add", help="отслеживать новые главы тайтла")
+    watch_add.add_argument("slug")
+    watch_add.add_argument("-o", "--output", default=".", help="куда скачивать главы (по умолчанию текущая папка)")
+    watch_remove = watch_actions.add_parser("remove", help="перестать отслеживать тайтл")
+    watch_remove.add_argument("slug")
+    watch_actions.add_parser("list", help="показать тайтлы библиотеки")
+
+    daemon = commands.add_parser("daemon", help="служба загрузки с постоянной очередью и HTTP API")
+    daemon.add_argument("--host", default="127.0.0.1", help="адрес HTTP API (по умолчанию только локальный)")
+    daemon.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"порт HTTP API (по умолчанию {DEFAULT_PORT})")
+    daemon.add_argument("--queue", help="файл очереди заданий (по умолчанию в папке данных пользователя)")
+    daemon.add_argument("--token", default=os.environ.get("MANGALIB_DAEMON_TOKEN"),
+                        help="требовать заголовок Authorization: Bearer <token> (по умолчанию из "
+                             "MANGALIB_DAEMON_TOKEN или файла daemon.token, который создаётся при первом запуске)")
+    daemon.add_argument("--allow-host", action="append", default=[],
+                        help="имя, под которым к службе обращаются по сети (проверяется заголовок Host); "
+                             "можно указать несколько раз")
+    add_download_options(daemon)
+
+    archive = commands.add_parser("archive", help="массовая загрузка несколькими процессами или машинами "
+                                                   "через общую очередь")
+    archive_actions = archive.add_subparsers(dest="action", required=True)
+    archive_submit = archive_actions.add_parser("submit", help="добавить главы тайтла в общую очередь")
+    archive_submit.add_argument("queue", help="файл очереди (SQLite), доступный всем рабочим")
+    archive_submit.add_argument("slug")
+    archive_submit.add_argument("--volumes", default="")
+    archive_submit.add_argument("--chapters", default="")
+    archive_submit.add_argument("-o", "--output", default=".", help="папка сохранения, общая для всех рабочих")
+    archive_work = archive_actions.add_parser("work", help="брать главы из общей очереди и скачивать")
+    archive_work.add_argument("queue")
+    archive_work.add_argument("-p", "--processes", type=positive_int, default=1,
+                              help="рабочих процессов на этой машине")
+    archive_work.add_argument("--lease", type=float, default=DEFAULT_LEASE,
+                              help=f"срок аренды главы, секунд (по умолчанию {DEFAULT_LEASE:.0f})")
+    archive_work.add_argument("--follow", action="store_true",
+                              help="не завершаться, когда очередь опустела, а ждать новых глав")
+    add_download_options(archive_work)
+    archive_status = archive_actions.add_parser("status", help="состояние общей очереди")
+    archive_status.add_argument("queue")
+    archive_status.add_argument("--retry-failed", action="store_true", help="вернуть главы с ошибкой в очередь")
+
+    chapters = commands.add_parser("chapters", help="показать список глав")
+    chapters.add_argument("slug")
+
+    gc = commands.add_parser("gc", help="удалить из хранилища .pages страницы, на которые не ссылается ни одна глава")
+    gc.add_argument("directory", nargs="?", default=".", help="папка сохранения (по умолчанию текущая)")
+
+    search = commands.add_parser("search", help="найти мангу по названию")
+    search.add_argument("query")
+    search.add_argument("--page", type=positive_int, default=1)
+    return parser
+
+
+def add_download_options(download):
+    """ Параметры загрузки, общие для download и sync """
+    download.add_argument("-j", "--jobs", type=positive_int, default=DEFAULT_CHAPTER_JOBS,
+                          help=f"глав одновременно (по умолчанию {DEFAULT_CHAPTER_JOBS})")
+    download.add_argument("-w", "--workers", type=positive_int, default=DEFAULT_PAGE_WORKERS,
+                          help=f"страниц одновременно в главе (по умолчанию {DEFAULT_PAGE_WORKERS}, "
+                               f"максимум {MAX_PAGE_WORKERS})")
+    download.add_argument("--per-host", type=positive_int, default=DEFAULT_HOST_CONNECTIONS,
+                          help=f"соединений к одному хосту (по умолчанию {DEFAULT_HOST_CONNECTIONS})")
+    download.add_argument("--limit-rate", type=rate_limit, metavar="RATE",
+                          help="общий предел скорости, например 500K или 2M (по умолчанию без предела); "
+                               "запросы поиска и списков глав при этом не ждут загрузку страниц")
+    download.add_argument("--dedupe", action="store_true",
+                          help="хранить одинаковые страницы один раз (в папке .pages, жёсткими ссылками)")
+    download.add_argument("--profile", choices=sorted(PROFILES), default=DEFAULT_PROFILE,
+                          help="обработка страниц: " + ", ".join(f"{name} — {profile.label}"
+                                                                  for name, profile in PROFILES.items()))
+    download.add_argument("--max-width", type=positive_int, help="уменьшать страницы до этой ширины")
+    download.add_argument("--max-height", type=positive_int, help="уменьшать страницы до этой высоты")
+    download.add_argument("--quality", type=jpeg_quality, help="пережимать страницы в JPEG с этим качеством (1-95)")
+    download.add_argument("--grayscale", action="store_true", help="переводить страницы в оттенки серого")
+    download.add_argument("--strip-metadata", action="store_true", help="удалять EXIF, XMP и ICC")
+    download.add_argument("--image-workers", type=positive_int,
+                          help="процессов обработки страниц (по умолчанию по числу ядер)")
+    download.add_argument("-f", "--format", action="append", choices=sorted(EXPORT_FORMATS), dest="formats",
+                          help="во что собирать главу: pdf, cbz, epub; можно указать несколько раз "
+                               "(по умолчанию pdf)")
+    download.add_argument("--no-pages", action="store_true",
+                          help="не оставлять отдельные файлы страниц после сборки главы")
+    download.add_argument("--fsync", choices=FSYNC_POLICIES, default=FSYNC_NONE,
+                          help="сбрасывать страницы на диск: none — на усмотрение ОС, file — каждый файл, "
+                               "full — файл и папку (медленнее, но переживает сбой питания)")
+    download.add_argument("--metrics-json", help="после загрузки сохранить снимок метрик в файл JSON")
+    download.add_argument("-q", "--quiet", action="store_true", help="выводить только ошибки и итог")
+
+
+def download(args):
+    try:
+        parse_number_ranges(args.volumes)
+        parse_number_ranges(args.chapters)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    jobs = resolve_jobs(args.slug, args.volumes, args.chapters)
+    if not jobs:
+        print("Подходящие главы не найдены", file=sys.stderr)
+        return 1
+
+    output = os.path.abspath(os.path.expanduser(args.output))
+    return run_jobs(args, [(args.slug, volume, chapter, output) for volume, chapter in jobs])
+
+
+def log_printer(args, with_group=True):
+    def on_log(message, msg_type, group=None):
+        if group and with_group:
+            message = f"{message} — {group}"
+        if msg_type == "error":
+            print(message, file=sys.stderr, flush=True)
+        elif not args.quiet:
+            print(message, flush=True)
+    return on_log
+
+
+def scheduler_options(args):
+    """ Параметры DownloadScheduler из общих ключей загрузки """
+    return {
+        "max_jobs": args.jobs,
+        "per_host": args.per_host,
+        "page_workers": args.workers,
+        "dedupe": args.dedupe,
+        "profile": PROFILES[args.profile].customized(
+            args.max_width, args.max_height, args.quality, args.grayscale, args.strip_metadata
+        ),
+        "image_workers": args.image_workers,
+        "formats": args.formats or DEFAULT_EXPORT_FORMATS,
+        "keep_pages": not args.no_pages,
+        "fsync": args.fsync,
+        "rate_limit": args.limit_rate,
+    }
+
+
+def run_jobs(args, jobs):
+    """ Скачивает главы [(slug, том, глава, папка)] и ждёт окончания; возвращает код выхода """
+    failed = []
+
+    def on_job_finished(downloader, save_dir):
+        if not save_dir or downloader.failed_pages:
+            failed.append(downloader.label)
+
+    library = open_library(args)
+    scheduler = DownloadScheduler(
+        library=library,
+        on_log=log_printer(args, with_group=len(jobs) > 1),
+        on_job_finished=on_job_finished,
+        **scheduler_options(args)
+    )
+    for slug_url, volume, chapter, output in jobs:
+        scheduler.enqueue(slug_url, volume, chapter, output)
+
+    try:
+        # Ожидание с таймаутом, чтобы Ctrl+C срабатывал сразу
+        while not scheduler.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        print("Отмена загрузки...", file=sys.stderr)
+        scheduler.cancel()
+        scheduler.wait()
+        return 130
+    finally:
+        scheduler.close()
+        library.close()
+        if args.metrics_json:
+            with open(args.metrics_json, "w", encoding="utf-8") as f:
+                json.dump(default_metrics.snapshot(), f, ensure_ascii=False, indent=1)
+
+    print(f"Глав загружено: {len(jobs) - len(failed)} из {len(jobs)}")
+    for name in failed:
+        print(f"Не полностью загружено: {name}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def run_daemon(args):
+    store = JobStore(os.path.abspath(os.path.expanduser(args.queue)) if args.queue else None)
+    library = open_library(args)
+    token = args.token or load_token()
+    if token is None:
+        token = create_token()
+        print(f"Создан токен доступа: {default_token_path()}", flush=True)
+    service = DownloadService(store, token=token, on_log=log_printer(args), library=library,
+                              **scheduler_options(args))
+    server = start_service(service, args.port, args.host, args.allow_host)
+    print(f"Служба загрузки: http://{args.host}:{server.server_address[1]}, очередь {store.path}", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Остановка службы...", file=sys.stderr)
+    finally:
+        server.shutdown()
+        service.close()
+        store.close()
+        library.close()
+    return 0
+
+
+def archive(args):
+    work_queue = WorkQueue(os.path.abspath(os.path.expanduser(args.queue)))
+    try:
+        if args.action == "submit":
+            return archive_submit(args, work_queue)
+        if args.action == "work":
+            return archive_work(args, work_queue)
+        if args.retry_failed:
+            print(f"Возвращено в очередь: {work_queue.retry_failed()}")
+        counts = work_queue.counts()
+        print(", ".join(f"{state}: {count}" for state, count in sorted(counts.items())) or "Очередь пуста")
+        for owner, count in sorted(work_queue.workers().items()):
+            print(f"  {owner}\tглав: {count}")
+        for unit in work_queue.failed():
+            print(f"Ошибка: {unit['slug_url']} Том {unit['volume']} Глава {unit['number']}: {unit['error']}",
+                  file=sys.stderr)
+        return 0
+    finally:
+        work_queue.close()
+
+
+def archive_submit(args, work_queue):
+    jobs = resolve_jobs(args.slug, args.volumes, args.chapters)
+    if not jobs:
+        print("Подходящие главы не найдены", file=sys.stderr)
+        return 1
+    output = os.path.abspath(os.path.expanduser(args.output))
+    added = work_queue.submit([(args.slug, volume, chapter, output) for volume, chapter in jobs])
+    print(f"Добавлено глав: {added} из {len(jobs)}")
+    return 0
+
+
+def without_option(argv, option):
+    """ argv без ключа option и его значения (в виде "--ключ значение" и "--ключ=значение") """
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            result.append(arg)
+    return result
+
+
+def archive_work(args, work_queue):
+    if args.processes > 1:
+        # Каждый процесс — отдельный рабочий со своим интерпретатором и соединениями;
+        # общий предел скорости делится между ними поровну. Порт метрик уже занят
+        # родителем, поэтому рабочие сервер метрик не запускают
+        argv = without_option(args.argv, "--metrics-port") + ["--processes", "1"]
+        if args.limit_rate:
+            argv += ["--limit-rate", str(max(1, args.limit_rate // args.processes))]
+        processes = [
+            multiprocessing.Process(target=main, args=(argv,))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
+            return 130
+        return 1 if any(process.exitcode for process in processes) else 0
+
+    library = open_library(args)
+    worker = ShardWorker(work_queue, lease=args.lease, follow=args.follow, on_log=log_printer(args),
+                         library=library, **scheduler_options(args))
+    try:
+        finished, failed = worker.run()
+    except KeyboardInterrupt:
+        print(f"{worker.owner}: остановка, незаконченные главы возвращены в очередь", file=sys.stderr)
+        return 130
+    finally:
+        library.close()
+    print(f"{worker.owner}: глав загружено {finished}, с ошибкой {failed}")
+    return 1 if failed else 0
+
+
+def open_library(args):
+    return LibraryIndex(os.path.abspath(os.path.expanduser(args.library)) if args.library else None)
+
+
+def sync(args):
+    library = open_library(args)
+    jobs = []
+
+    def on_title(slug_url, save_directory, result):
+        if isinstance(result, Exception):
+            print(f"{slug_url}: ошибка проверки: {result}", file=sys.stderr)
+            return
+        if not args.quiet:
+            print(f"{slug_url}: глав к загрузке — {len(result)}")
+        jobs.extend((slug_url, volume, chapter, save_directory) for volume, chapter in result)
+
+    try:
+        if not library.titles(watched_only=True):
+            print("Нет отслеживаемых тайтлов: добавьте их командой watch add", file=sys.stderr)
+            return 1
+        sync_watchlist(library, on_title)
+    finally:
+        library.close()
+    if not jobs:
+        print("Новых глав нет")
+        return 0
+    return run_jobs(args, jobs)
+
+
+def watch_titles(args):
+    library = open_library(args)
+    try:
+        if args.action == "add":
+            output = os.path.abspath(os.path.expanduser(args.output))
+            found = watch(library, args.slug, output)
+            print(f"{args.slug} отслеживается, папка {output}; уже скачано глав: {found}")
+        elif args.action == "remove":
+            if not library.unwatch(args.slug):
+                print(f"{args.slug} нет в библиотеке", file=sys.stderr)
+                return 1
+        else:
+            for title in library.titles():
+                mark = "*" if title["watched"] else " "
+                print(f"{mark} {title['slug_url']}\t{title['complete'] or 0}/{title['chapters']}"
+                      f"\t{title['save_directory']}")
+    finally:
+        library.close()
+    return 0
+
+
+def list_chapters(args):
+    for chapter in get_chapters(args.slug):
+        name = chapter.get('name') or ''
+        print(f"{chapter.get('volume')}\t{chapter.get('number')}\t{name}")
+    return 0
+
+
+def collect_garbage(args):
+    directory = os.path.abspath(os.path.expanduser(args.directory))
+    if not os.path.isdir(os.path.join(directory, STORE_DIRNAME)):
+        print(f"Хранилище страниц не найдено: {os.path.join(directory, STORE_DIRNAME)}", file=sys.stderr)
+        return 1
+    store = store_for(directory)
+    try:
+        removed, freed = store.gc()
+    finally:
+        store.close()
+    print(f"Удалено страниц: {removed}, освобождено {freed / 1024 / 1024:.1f} МБ")
+    return 0
+
+
+def search(args):
+    for manga in search_manga(args.query, page=args.page):
+        name = manga.get('rus_name') or manga.get('eng_name') or manga.get('name', '')
+        print(f"{manga.get('slug_url')}\t{name}")
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Рабочие процессы archive work запускаются с теми же аргументами
+    args.argv = list(argv if argv is not None else sys.argv[1:])
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format=core.LOG_FORMAT
+    )
+    if args.no_cache:
+        core.metadata_cache.enabled = False
+    if args.api_url:
+        core.API_BASE_URL = args.api_url.rstrip("/")
+    if args.image_url:
+        core.set_image_hosts(args.image_url)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    default_client.enable_dns_cache(args.dns_ttl)
+    if args.trace_http:
+        default_client.add_hook(print_trace)
+    commands = {"download": download, "sync": sync, "watch": watch_titles, "daemon": run_daemon,
+                "archive": archive, "chapters": list_chapters, "search": search, "gc": collect_garbage}
+    try:
+        return commands[args.command](args)
+    except Exception as e:
+        logger.debug("Command failed", exc_info=True)
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
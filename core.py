@@ -0,0 +1,991 @@
+""" Загрузка глав без графического интерфейса: API mangalib, скачивание страниц,
+PDF и очередь глав. Используется и окном приложения (app.py), и командной строкой (cli.py) """
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+
+from archive_writer import write_cbz, write_epub
+from bandwidth import FOREGROUND, default_bandwidth, traffic
+from http_client import NO_COMPRESSION
+from image_hosts import ImageHostPool
+from image_processing import DEFAULT_PROFILE, PROFILES, fix_extension, process_image
+from metadata_cache import MetadataCache
+from metrics import DURATION_BUCKETS, default_metrics
+from page_store import store_for
+from page_writer import FSYNC_NONE, PartWriter, chunk_size_for, commit
+from pdf_writer import write_pdf
+from request_policy import (
+    DEFAULT_MAX_CONCURRENCY, RETRY_EXCEPTIONS, RequestCancelled, RetryableHTTPError, default_policy
+)
+
+logger = logging.getLogger(__name__)
+
+# Адреса API и сервера изображений; переменные окружения позволяют направить
+# приложение на локальный stub_server.py для замеров
+API_BASE_URL = os.environ.get("MANGALIB_API_URL", "https://api.lib.social/api/manga")
+IMAGE_BASE_URL = os.environ.get("MANGALIB_IMAGE_URL", "https://img2.imglib.info")
+# Зеркала сервера изображений через запятую. Страницы записываются в manifest.json
+# по адресу на IMAGE_BASE_URL, а скачиваются с самого быстрого исправного зеркала
+IMAGE_MIRRORS = [url.strip() for url in os.environ.get("MANGALIB_IMAGE_MIRRORS", "").split(",") if url.strip()]
+image_host_pool = ImageHostPool([IMAGE_BASE_URL] + IMAGE_MIRRORS)
+
+# Общий дисковый кэш ответов API; cli.py --no-cache отключает его
+metadata_cache = MetadataCache()
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+
+
+def setup_logging(handlers, level=logging.DEBUG):
+    """ Настраивает корневой логгер так, чтобы запись в файл и консоль шла в
+    отдельном потоке и не тормозила вызывающий. Возвращает QueueListener,
+    который нужно остановить (stop()) перед выходом """
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+def set_image_hosts(urls):
+    """ Первый адрес — основной, остальные — зеркала """
+    global IMAGE_BASE_URL
+    IMAGE_BASE_URL = urls[0].rstrip("/")
+    image_host_pool.set_hosts(urls)
+
+
+def get_manga_pages(slug_url, volume_number, chapter_number):
+    endpoint = f"{API_BASE_URL}/{slug_url}/chapter"
+    params = {
+        "number": chapter_number,
+        "volume": volume_number
+    }
+
+    data = metadata_cache.get_json(endpoint, params=params, endpoint="chapter")
+    pages = (data.get("data") or {}).get("pages", [])
+    return [
+        f"{IMAGE_BASE_URL}{page['url']}"
+        if page["url"].startswith("//manga/") else page["url"]
+        for page in pages
+    ]
+
+
+def sanitize_folder_name(name):
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+
+def chapter_dir(save_directory, slug_url, volume_number, chapter_number):
+    """ Папка главы: <папка сохранения>/<тайтл>/Volume_N/Chapter_M """
+    return os.path.join(
+        save_directory,
+        sanitize_folder_name(slug_url.split("--", 1)[-1]),
+        f"Volume_{volume_number}",
+        f"Chapter_{chapter_number}"
+    )
+
+
+def get_chapters(slug_url, refresh=False):
+    url = f"{API_BASE_URL}/{slug_url}/chapters"
+    return metadata_cache.get_json(url, endpoint="chapters", refresh=refresh).get('data', [])
+
+
+def search_manga(query, page=1):
+    params = {
+        "site_id[]": 1,
+        "q": query,
+        "page": page,
+        "status[]": [1, 2, 4],
+        "types[]": [1, 5]
+    }
+    return metadata_cache.get_json(API_BASE_URL, params=params, endpoint="search").get('data', [])
+
+
+def parse_number_ranges(text):
+    """ Разбирает строку вида "1-5, 7, 10.5" в список диапазонов.
+    Пустая строка, "*" или "все" означают все номера (возвращается None) """
+    text = text.strip().lower()
+    if text in ("", "*", "все", "all"):
+        return None
+    text = re.sub(r"\s*([-–—])\s*", r"\1", text)
+    ranges = []
+    for part in re.split(r"[,;\s]+", text):
+        if not part:
+            continue
+        bounds = re.split(r"[-–—]", part, maxsplit=1)
+        try:
+            low = float(bounds[0])
+            high = float(bounds[1]) if len(bounds) > 1 else low
+        except ValueError:
+            raise ValueError(f"Неверный диапазон: {part}")
+        ranges.append((min(low, high), max(low, high)))
+    return ranges
+
+
+def is_single_number(ranges):
+    return ranges is not None and len(ranges) == 1 and ranges[0][0] == ranges[0][1]
+
+
+def number_in_ranges(value, ranges):
+    if ranges is None:
+        return True
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return False
+    return any(low <= number <= high for low, high in ranges)
+
+
+def resolve_jobs(slug_url, volume_spec, chapter_spec):
+    """ Превращает диапазоны томов и глав в список пар (том, глава) для загрузки """
+    volumes = parse_number_ranges(volume_spec)
+    chapters = parse_number_ranges(chapter_spec)
+
+    # Одна конкретная глава — список глав запрашивать не нужно
+    if is_single_number(volumes) and is_single_number(chapters):
+        return [(volume_spec.strip(), chapter_spec.strip())]
+
+    return [
+        (str(chapter.get('volume')), str(chapter.get('number')))
+        for chapter in get_chapters(slug_url)
+        if number_in_ranges(chapter.get('volume'), volumes)
+        and number_in_ranges(chapter.get('number'), chapters)
+    ]
+
+
+# Сколько соединений одновременно допускается к одному хосту для всех загрузок
+DEFAULT_HOST_CONNECTIONS = DEFAULT_MAX_CONCURRENCY
+
+
+class ChapterManifest:
+    """ manifest.json в папке главы: URL, размер и SHA-256 каждой загруженной страницы.
+    Позволяет при повторном запуске пропускать готовые страницы и не пересобирать PDF.
+    Ключ страницы — всегда NNN.jpg; настоящее имя файла (NNN.png после исправления
+    расширения) хранится в поле file, профиль обработки — в поле profile """
+    FILENAME = "manifest.json"
+    # Как часто manifest.json переписывается во время загрузки, секунд
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, self.FILENAME)
+        self.lock = threading.Lock()
+        self.data = {"pages": {}, "exports": {}}
+        self.dirty = False
+        self.saved_at = 0.0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            if isinstance(loaded.get("pages"), dict):
+                exports = loaded.get("exports") or {}
+                # Старые manifest.json хранили только PDF
+                if loaded.get("pdf") and "pdf" not in exports:
+                    exports["pdf"] = loaded["pdf"]
+                self.data = {"pages": loaded["pages"], "exports": exports}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def changed(self):
+        """ Вызывается под self.lock после изменения страниц. Файл переписывается не чаще
+        раза в SAVE_INTERVAL секунд: в главе из сотен страниц запись целого manifest.json
+        на каждую страницу стоила больше самой записи страниц. Отстающий manifest
+        безопасен — страница без записи в нём просто скачивается заново """
+        self.dirty = True
+        if time.monotonic() - self.saved_at >= self.SAVE_INTERVAL:
+            self.save()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def entry(self, filename):
+        with self.lock:
+            return dict(self.data["pages"].get(filename) or {})
+
+    def page_path(self, filename):
+        return os.path.join(self.save_dir, self.entry(filename).get("file", filename))
+
+    def is_complete(self, filename, url, profile=""):
+        """ Страница загружена и либо ещё не обработана, либо обработана тем же профилем """
+        entry = self.entry(filename)
+        if entry.get("url") != url or "sha256" not in entry or entry.get("profile", "") not in ("", profile):
+            return False
+        path = self.page_path(filename)
+        try:
+            if os.path.getsize(path) != entry["size"]:
+                return False
+            return file_sha256(path) == entry["sha256"]
+        except OSError:
+            return False
+
+    def start_page(self, filename, url):
+        """ Запоминает URL страницы до загрузки, чтобы докачка .part-файла
+        была возможна только для того же URL """
+        with self.lock:
+            self.data["pages"][filename] = {"url": url}
+            self.changed()
+
+    def complete_page(self, filename, url, size, sha256, file=None, profile=""):
+        entry = {"url": url, "size": size, "sha256": sha256}
+        if file and file != filename:
+            entry["file"] = file
+        if profile:
+            entry["profile"] = profile
+        with self.lock:
+            self.data["pages"][filename] = entry
+            self.changed()
+
+    def set_processed(self, filename, file, size, sha256, profile):
+        url = self.entry(filename).get("url")
+        self.complete_page(filename, url, size, sha256, file, profile)
+
+    def pages_digest(self, filenames):
+        digest = hashlib.sha256()
+        with self.lock:
+            for filename in filenames:
+                entry = self.data["pages"].get(filename) or {}
+                digest.update(f"{filename}:{entry.get('sha256', '')}\n".encode())
+        return digest.hexdigest()
+
+    def is_export_current(self, export_format, name, digest):
+        export = self.data["exports"].get(export_format) or {}
+        return (export.get("name") == name and export.get("pages_digest") == digest
+                and os.path.exists(os.path.join(self.save_dir, name)))
+
+    def built_exports(self):
+        """ Имена собранных файлов главы, которые есть на диске """
+        return [export["name"] for export in self.data["exports"].values()
+                if export.get("name") and os.path.exists(os.path.join(self.save_dir, export["name"]))]
+
+    def set_export(self, export_format, name, digest):
+        with self.lock:
+            self.data["exports"][export_format] = {"name": name, "pages_digest": digest}
+            self.save()
+
+    def exports_current(self, page_urls, profile, exports):
+        """ Все страницы с этими URL уже были загружены, а файлы exports [(формат, имя)]
+        собраны из них. Нужна, когда отдельные страницы после сборки удаляются """
+        filenames = [f"{i:03}.jpg" for i in range(1, len(page_urls) + 1)]
+        for filename, url in zip(filenames, page_urls):
+            entry = self.entry(filename)
+            if entry.get("url") != url or "sha256" not in entry or entry.get("profile", "") != profile:
+                return False
+        digest = self.pages_digest(filenames)
+        return all(self.is_export_current(export_format, name, digest) for export_format, name in exports)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Форматы сборки главы: функция (страницы, путь, сведения о главе)
+EXPORT_FORMATS = {
+    "pdf": lambda image_paths, output_path, info: write_pdf(image_paths, output_path),
+    "cbz": write_cbz,
+    "epub": write_epub,
+}
+DEFAULT_EXPORT_FORMATS = ("pdf",)
+
+# Сколько страниц главы скачивается одновременно
+DEFAULT_PAGE_WORKERS = 6
+MAX_PAGE_WORKERS = 32
+
+
+class ChapterDownloader:
+    """ Загрузка одной главы: список страниц, параллельное скачивание и PDF.
+    on_log(сообщение, тип, группа) и on_progress(готово, всего) вызываются из рабочих потоков.
+    Группа — название главы; сообщения о сохранённых страницах имеют тип "page" """
+
+    def __init__(self, slug_url, volume_number, chapter_number, save_directory,
+                 max_workers=DEFAULT_PAGE_WORKERS, policy=None, resume_event=None,
+                 cancel_event=None, on_log=None, on_progress=None, page_store=None, profile=None,
+                 image_pool=None, formats=DEFAULT_EXPORT_FORMATS, keep_pages=True, metrics=None,
+                 image_hosts=None, page_list=None, fsync=FSYNC_NONE, bandwidth=None, traffic_class=FOREGROUND,
+                 weight=1.0):
+        self.slug_url = slug_url
+        self.volume_number = volume_number
+        self.chapter_number = chapter_number
+        self.save_directory = save_directory
+        self.max_workers = max(1, min(int(max_workers), MAX_PAGE_WORKERS))
+        self.policy = policy or default_policy
+        self.metrics = metrics or default_metrics
+        self.image_hosts = image_hosts or image_host_pool
+        # Класс передачи и вес главы в планировщике скорости (bandwidth.py);
+        # flow открыт, пока скачиваются страницы
+        self.bandwidth = bandwidth or default_bandwidth
+        self.traffic_class = traffic_class
+        self.weight = weight
+        self.flow = None
+        self.page_store = page_store
+        # Политика fsync при записи страниц (page_writer.FSYNC_POLICIES)
+        self.fsync = fsync
+        # Future со списком страниц, если очередь запросила его заранее
+        self.page_list = page_list
+        # Обработка страниц профилем; без image_pool выполняется в потоке главы
+        self.profile = profile or PROFILES[DEFAULT_PROFILE]
+        self.image_pool = image_pool
+        # Во что собирается глава; keep_pages=False — отдельные страницы удаляются после сборки
+        self.formats = [export_format for export_format in EXPORT_FORMATS if export_format in formats]
+        self.keep_pages = keep_pages or not self.formats
+        # resume_event сброшен — загрузка на паузе; cancel_event установлен — отменена
+        self.resume_event = resume_event or threading.Event()
+        if resume_event is None:
+            self.resume_event.set()
+        self.cancel_event = cancel_event or threading.Event()
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.failed_pages = 0
+        self.total_pages = 0
+        self.started_at = None
+        self.label = f"{slug_url} Том {volume_number} Глава {chapter_number}"
+
+    def log(self, message, msg_type="info"):
+        if self.on_log is not None:
+            self.on_log(message, msg_type, self.label)
+
+    def progress(self, done, total):
+        if self.on_progress is not None:
+            self.on_progress(done, total)
+
+    def wait_if_paused(self):
+        while not self.resume_event.wait(0.2):
+            if self.cancel_event.is_set():
+                break
+        if self.cancel_event.is_set():
+            raise InterruptedError("Загрузка отменена")
+
+    def download_page(self, index, url, save_dir, manifest):
+        """ Возвращает (путь, True), если страница уже была загружена и проверена """
+        filename = f"{index:03}.jpg"
+        image_path = os.path.join(save_dir, filename)
+        if manifest.is_complete(filename, url, self.profile.key):
+            self.metrics.inc("pages_total", source="manifest")
+            return manifest.page_path(filename), True
+
+        # Страница с этим URL уже есть в общем хранилище — сеть не нужна
+        if self.page_store is not None and not self.profile.is_identity:
+            # Та же страница, уже обработанная этим профилем, — не нужна и обработка
+            sha256 = self.page_store.lookup_url(url, self.profile.key)
+            size = self.page_store.link(sha256, image_path) if sha256 else None
+            if size is not None:
+                image_path = fix_extension(image_path)
+                manifest.complete_page(filename, url, size, sha256, os.path.basename(image_path),
+                                       self.profile.key)
+                self.metrics.inc("pages_total", source="store")
+                return image_path, True
+        if self.page_store is not None:
+            sha256 = self.page_store.lookup_url(url)
+            size = self.page_store.link(sha256, image_path) if sha256 else None
+            if size is not None:
+                image_path = fix_extension(image_path)
+                manifest.complete_page(filename, url, size, sha256, os.path.basename(image_path))
+                self.metrics.inc("pages_total", source="store")
+                return image_path, True
+
+        part_path = image_path + ".part"
+        if manifest.entry(filename).get("url") != url and os.path.exists(part_path):
+            os.remove(part_path)
+        manifest.start_page(filename, url)
+
+        size, sha256 = self.fetch_with_failover(url, part_path)
+        self.metrics.inc("pages_total", source="network")
+
+        commit(part_path, image_path, self.fsync)
+        if self.page_store is not None:
+            self.page_store.add(image_path, sha256, url)
+        # Сервер отдаёт WebP и PNG под именем .jpg — расширение исправляется сразу
+        image_path = fix_extension(image_path)
+        manifest.complete_page(filename, url, size, sha256, os.path.basename(image_path))
+        return image_path, False
+
+    def fetch_with_failover(self, url, part_path):
+        """ Если у сервера изображений есть зеркала, каждое пробуется по одному разу
+        от быстрого к медленному; если не ответило ни одно, самое быстрое получает
+        обычные повторы с задержкой """
+        candidates = self.image_hosts.candidates(url)
+        if len(candidates) > 1:
+            for candidate in candidates:
+                try:
+                    return self.fetch_once(candidate, part_path)
+                except (RequestCancelled, InterruptedError):
+                    raise
+                except Exception as e:
+                    logger.debug("Mirror %s failed, trying next: %s", candidate, e)
+        candidate = self.image_hosts.candidates(url)[0]
+        return self.policy.call(
+            candidate, lambda: self.fetch_once(candidate, part_path), self.cancel_event
+        )
+
+    def fetch_once(self, url, part_path):
+        started = time.monotonic()
+        try:
+            size, sha256, latency = self.fetch_to_part(url, part_path)
+        except RETRY_EXCEPTIONS + (RetryableHTTPError,):
+            # Здоровье зеркала портят только сбои сети и 429/5xx, а не 404 отдельной страницы
+            self.image_hosts.report(url, False)
+            raise
+        seconds = time.monotonic() - started
+        self.image_hosts.report(url, True, latency, seconds, size)
+        self.metrics.observe("page_seconds", seconds, host=urlparse(url).netloc)
+        return size, sha256
+
+    def fetch_to_part(self, url, part_path):
+        """ Скачивает страницу в .part-файл, докачивая его через HTTP Range, если сервер это позволяет """
+        self.wait_if_paused()
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = dict(NO_COMPRESSION, Range=f"bytes={offset}-") if offset else NO_COMPRESSION
+        with self.policy.stream(url, cancel_event=self.cancel_event, flow=self.flow,
+                                stream=True, headers=headers) as response:
+            if not (offset and response.status_code == 416):
+                return self.write_part(response, url, part_path, offset) + (response.elapsed.total_seconds(),)
+
+        # Сохранённый кусок не подходит к файлу на сервере — качаем заново
+        os.remove(part_path)
+        return self.fetch_to_part(url, part_path)
+
+    def write_part(self, response, url, part_path, offset):
+        resumed = (offset and response.status_code == 206
+                   and response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"))
+        if response.status_code not in (200, 206) or (response.status_code == 206 and not resumed):
+            raise IOError(f"HTTP {response.status_code}: {url}")
+
+        digest = hashlib.sha256()
+        if resumed:
+            with open(part_path, "rb") as part_file:
+                for block in iter(lambda: part_file.read(1024 * 1024), b""):
+                    digest.update(block)
+        else:
+            offset = 0
+
+        expected = response.headers.get("Content-Length")
+        expected = int(expected) if expected is not None else None
+        writer = PartWriter(part_path, offset, offset + expected if expected else None, self.fsync)
+        try:
+            with writer:
+                for chunk in response.iter_content(self.bandwidth.chunk_size(chunk_size_for(expected))):
+                    self.flow.consume(len(chunk), self.cancel_event)
+                    writer.write(chunk)
+                    digest.update(chunk)
+        finally:
+            self.metrics.add_bytes(urlparse(url).netloc, writer.written)
+        written = writer.written
+
+        if expected is not None and written != expected:
+            # Обрыв соединения: повтор докачает файл с текущего места
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Страница загружена не полностью ({written} из {expected} байт): {url}")
+        return offset + written, digest.hexdigest()
+
+    def run(self):
+        """ Возвращает папку главы или пустую строку при ошибке """
+        self.started_at = time.monotonic()
+        try:
+            self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Начало загрузки...", "info")
+
+            save_dir = chapter_dir(self.save_directory, self.slug_url, self.volume_number, self.chapter_number)
+            os.makedirs(save_dir, exist_ok=True)
+
+            self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Поиск страниц...", "info")
+            try:
+                page_urls = self.resolve_page_urls()
+            except Exception as e:
+                self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка получения списка страниц: {str(e)}",
+                         "error")
+                return ""
+
+            if not page_urls:
+                self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Страницы не найдены!", "error")
+                return ""
+            self.total_pages = len(page_urls)
+
+            export_base = f"Volume_{self.volume_number}_Chapter_{self.chapter_number}"
+            exports = [(export_format, f"{export_base}.{export_format}") for export_format in self.formats]
+            manifest = ChapterManifest(save_dir)
+            if not self.keep_pages and manifest.exports_current(page_urls, self.profile.key, exports):
+                self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Глава уже собрана: "
+                         f"{', '.join(name for _, name in exports)}", "info")
+                return save_dir
+
+            total = len(page_urls)
+            workers = min(self.max_workers, total)
+            self.progress(0, total)
+
+            # Страницы качаются параллельно, имена файлов задаются по номеру,
+            # поэтому порядок страниц не зависит от порядка завершения
+            saved = {}
+            processing = {}
+            self.flow = self.bandwidth.open(self.traffic_class, self.weight)
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = {
+                        pool.submit(self.download_page, i, url, save_dir, manifest): (i, url)
+                        for i, url in enumerate(page_urls, start=1)
+                    }
+                    for done, future in enumerate(as_completed(futures), start=1):
+                        if self.cancel_event.is_set():
+                            pool.shutdown(wait=True, cancel_futures=True)
+                            break
+                        i, url = futures[future]
+                        try:
+                            saved[i], skipped = future.result()
+                            if skipped:
+                                self.log(
+                                    f"[{datetime.now().strftime('%H:%M:%S')}] Страница {i} уже загружена", "page")
+                            else:
+                                self.log(
+                                    f"[{datetime.now().strftime('%H:%M:%S')}] Страница {i} сохранена", "page")
+                            if self.needs_processing(manifest, i):
+                                processing[i] = self.submit_processing(saved[i])
+                        except Exception as e:
+                            self.failed_pages += 1
+                            self.log(
+                                f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка загрузки страницы {i}: {str(e)}",
+                                "error")
+                        self.progress(done, total)
+            finally:
+                self.flow.close()
+                manifest.flush()
+            self.finish_processing(processing, saved, manifest)
+            manifest.flush()
+
+            if self.cancel_event.is_set():
+                self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Загрузка отменена", "error")
+                return ""
+
+            if self.failed_pages:
+                # PDF с пропущенными страницами не создаётся; повторный запуск докачает только их
+                self.log(
+                    f"[{datetime.now().strftime('%H:%M:%S')}] Глава загружена не полностью: страниц с ошибкой "
+                    f"{self.failed_pages} из {total}. Запустите загрузку ещё раз", "error")
+                return ""
+
+            image_paths = [saved[i] for i in sorted(saved)]
+            if not image_paths:
+                return save_dir
+
+            pages_digest = manifest.pages_digest(f"{i:03}.jpg" for i in sorted(saved))
+            exported = True
+            for export_format, name in exports:
+                path = os.path.join(save_dir, name)
+                label = export_format.upper()
+                if len(image_paths) == total and manifest.is_export_current(export_format, name, pages_digest):
+                    self.log(f"[{datetime.now().strftime('%H:%M:%S')}] {label} актуален: {path}", "info")
+                elif self.timed_export(export_format, image_paths, path):
+                    if len(image_paths) == total:
+                        manifest.set_export(export_format, name, pages_digest)
+                    self.log(f"[{datetime.now().strftime('%H:%M:%S')}] {label} создан: {path}", "success")
+                else:
+                    exported = False
+
+            if exported and not self.keep_pages:
+                # Страницы нужны только для сборки; manifest остаётся, чтобы не собирать главу заново
+                for path in image_paths:
+                    os.remove(path)
+
+            return save_dir
+
+        except Exception as e:
+            self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Критическая ошибка: {str(e)}", "error")
+            return ""
+
+    def resolve_page_urls(self):
+        """ Список страниц, заранее запрошенный очередью, или запрос к API сейчас """
+        if self.page_list is not None and not self.page_list.cancelled():
+            return self.page_list.result()
+        with traffic(self.traffic_class):
+            return get_manga_pages(self.slug_url, self.volume_number, self.chapter_number)
+
+    def set_weight(self, weight):
+        self.weight = weight
+        if self.flow is not None:
+            self.flow.set_weight(weight)
+
+    def needs_processing(self, manifest, index):
+        return not self.profile.is_identity and manifest.entry(f"{index:03}.jpg").get("profile") != self.profile.key
+
+    def submit_processing(self, path):
+        if self.image_pool is None:
+            future = Future()
+            try:
+                future.set_result(process_image(path, self.profile))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.image_pool.submit(process_image, path, self.profile)
+
+    def finish_processing(self, processing, saved, manifest):
+        """ Ждёт обработки страниц главы в пуле процессов. Пока страницы обрабатываются,
+        остальные страницы и другие главы продолжают скачиваться """
+        for i, future in sorted(processing.items()):
+            if self.cancel_event.is_set():
+                future.cancel()
+                continue
+            try:
+                path, size, sha256, seconds = future.result()
+                self.metrics.observe("processing_seconds", seconds, buckets=DURATION_BUCKETS)
+            except Exception as e:
+                self.failed_pages += 1
+                saved.pop(i, None)
+                self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка обработки страницы {i}: {str(e)}",
+                         "error")
+                continue
+            saved[i] = path
+            manifest.set_processed(f"{i:03}.jpg", os.path.basename(path), size, sha256, self.profile.key)
+            if self.page_store is not None:
+                # Обработка заменила ссылку на исходный объект новым файлом — без этого
+                # gc удалил бы исходный объект, а одинаковые страницы хранились бы в каждой главе
+                self.page_store.add(path, sha256, manifest.entry(f"{i:03}.jpg").get("url"), self.profile.key)
+
+    def timed_export(self, export_format, image_paths, output_path):
+        started = time.monotonic()
+        created = self.create_export(export_format, image_paths, output_path)
+        if created:
+            self.metrics.observe("export_seconds", time.monotonic() - started, buckets=DURATION_BUCKETS,
+                                 format=export_format)
+        return created
+
+    def create_export(self, export_format, image_paths, output_path):
+        info = {
+            "title": f"Том {self.volume_number} Глава {self.chapter_number}",
+            "series": self.slug_url.split("--", 1)[-1],
+            "volume": self.volume_number,
+            "number": self.chapter_number,
+        }
+        try:
+            EXPORT_FORMATS[export_format](image_paths, output_path, info)
+            return True
+        except Exception as e:
+            self.log(f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка создания {export_format.upper()}: {str(e)}",
+                     "error")
+            return False
+
+
+# Сколько глав может скачиваться одновременно
+DEFAULT_CHAPTER_JOBS = 2
+# За сколько последних секунд скорость учитывается в оценке оставшегося времени
+PROGRESS_WINDOW = 30.0
+# Для скольких глав из очереди список страниц запрашивается заранее (не меньше max_jobs)
+PAGE_LIST_LOOKAHEAD = 4
+PAGE_LIST_WORKERS = 2
+
+
+class DownloadScheduler:
+    """ Очередь загрузки глав с общим ограничением числа одновременных глав,
+    ограничением соединений на хост, паузой и отменой.
+    Все обработчики on_* вызываются из рабочих потоков очереди;
+    on_progress(готово, всего, осталось секунд или None) """
+
+    def __init__(self, max_jobs=DEFAULT_CHAPTER_JOBS, per_host=DEFAULT_HOST_CONNECTIONS,
+                 page_workers=DEFAULT_PAGE_WORKERS, policy=None, dedupe=False, profile=None, image_workers=None,
+                 formats=DEFAULT_EXPORT_FORMATS, keep_pages=True, metrics=None, library=None, fsync=FSYNC_NONE,
+                 traffic_class=FOREGROUND, rate_limit=None, bandwidth=None, on_log=None, on_progress=None,
+                 on_queue_changed=None, on_job_finished=None, on_all_finished=None, on_job_progress=None):
+        self.max_jobs = max_jobs
+        # Локальная библиотека (library.LibraryIndex): отмечает скачанные и недокачанные главы
+        self.library = library
+        # Общее хранилище страниц (page_store) для каждой папки сохранения
+        self.dedupe = dedupe
+        self.page_stores = {}
+        # Обработка страниц идёт в общем пуле процессов, параллельно с загрузкой всех глав
+        self.profile = profile or PROFILES[DEFAULT_PROFILE]
+        self.image_workers = image_workers or os.cpu_count() or 1
+        self.image_pool = None
+        self.formats = formats
+        self.keep_pages = keep_pages
+        self.fsync = fsync
+        self.page_workers = page_workers
+        self.policy = policy or default_policy
+        self.policy.set_max_concurrency(per_host)
+        self.metrics = metrics or default_metrics
+        # Общий предел скорости процесса (байт в секунду, 0 — без предела) и класс глав по умолчанию
+        self.bandwidth = bandwidth or default_bandwidth
+        if rate_limit is not None:
+            self.bandwidth.set_rate(rate_limit)
+        self.traffic_class = traffic_class
+        # (slug, том, глава) -> (класс передачи, вес) для глав в очереди
+        self.job_traffic = {}
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.running = {}
+        # Списки страниц глав из начала очереди запрашиваются заранее, пока идут загрузки
+        # текущих глав: (slug, том, глава) -> Future
+        self.page_lists = {}
+        self.resolver_pool = None
+        self.progress = {}
+        # (время, готово страниц) за последние PROGRESS_WINDOW секунд — для оценки ETA
+        self.progress_samples = deque()
+        self.workers = []
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.on_queue_changed = on_queue_changed
+        self.on_job_finished = on_job_finished
+        self.on_all_finished = on_all_finished
+        # on_job_progress((slug, том, глава), готово, всего) — прогресс отдельной главы
+        self.on_job_progress = on_job_progress
+
+    def log(self, message, msg_type="info", group=None):
+        if self.on_log is not None:
+            self.on_log(message, msg_type, group)
+
+    def enqueue(self, slug_url, volume_number, chapter_number, save_directory, traffic_class=None, weight=1.0):
+        """ traffic_class и weight — класс передачи и доля главы в планировщике скорости """
+        key = (slug_url, volume_number, chapter_number)
+        with self.condition:
+            if key in self.running or any(job[:3] == key for job in self.pending):
+                return False
+            self.pending.append((slug_url, volume_number, chapter_number, save_directory))
+            self.job_traffic[key] = (self.traffic_class if traffic_class is None else traffic_class, weight)
+            self.prefetch_page_lists()
+            self.start_workers()
+            self.condition.notify()
+        self.queue_changed()
+        return True
+
+    def enqueue_many(self, jobs, traffic_class=None, weight=1.0):
+        """ jobs — [(slug, том, глава, папка)]; возвращает число добавленных глав """
+        return sum(self.enqueue(*job, traffic_class=traffic_class, weight=weight) for job in jobs)
+
+    def set_weight(self, slug_url, volume_number, chapter_number, weight):
+        """ Меняет долю главы в общей скорости, в том числе уже загружаемой """
+        key = (slug_url, volume_number, chapter_number)
+        with self.condition:
+            if key in self.job_traffic:
+                self.job_traffic[key] = (self.job_traffic[key][0], weight)
+            downloader = self.running.get(key)
+        if downloader is not None:
+            downloader.set_weight(weight)
+
+    def start_workers(self):
+        self.workers = [worker for worker in self.workers if worker.is_alive()]
+        while len(self.workers) < min(self.max_jobs, len(self.pending) + len(self.running)):
+            worker = threading.Thread(target=self.worker_loop, daemon=True)
+            self.workers.append(worker)
+            worker.start()
+
+    def prefetch_page_lists(self):
+        """ Вызывается под self.condition """
+        lookahead = max(PAGE_LIST_LOOKAHEAD, self.max_jobs)
+        for slug_url, volume_number, chapter_number, _ in list(self.pending)[:lookahead]:
+            key = (slug_url, volume_number, chapter_number)
+            if key in self.page_lists:
+                continue
+            if self.resolver_pool is None:
+                self.resolver_pool = ThreadPoolExecutor(max_workers=PAGE_LIST_WORKERS,
+                                                        thread_name_prefix="page-lists")
+            traffic_class = self.job_traffic.get(key, (self.traffic_class, 1.0))[0]
+            self.page_lists[key] = self.resolver_pool.submit(self.fetch_page_list, traffic_class, slug_url,
+                                                             volume_number, chapter_number)
+
+    def fetch_page_list(self, traffic_class, slug_url, volume_number, chapter_number):
+        with traffic(traffic_class):
+            return get_manga_pages(slug_url, volume_number, chapter_number)
+
+    def page_store(self, save_directory):
+        if not self.dedupe:
+            return None
+        if save_directory not in self.page_stores:
+            self.page_stores[save_directory] = store_for(save_directory)
+        return self.page_stores[save_directory]
+
+    def processing_pool(self):
+        if self.profile.is_identity:
+            return None
+        if self.image_pool is None:
+            self.image_pool = ProcessPoolExecutor(max_workers=self.image_workers)
+        return self.image_pool
+
+    def close(self):
+        """ Завершает процессы обработки страниц и запросы списков страниц """
+        with self.condition:
+            pool, self.image_pool = self.image_pool, None
+            resolver_pool, self.resolver_pool = self.resolver_pool, None
+            self.page_lists.clear()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if resolver_pool is not None:
+            resolver_pool.shutdown(wait=False, cancel_futures=True)
+
+    def is_paused(self):
+        return not self.resume_event.is_set()
+
+    def is_idle(self):
+        with self.condition:
+            return not self.pending and not self.running
+
+    def pause(self):
+        self.resume_event.clear()
+        self.queue_changed()
+
+    def resume(self):
+        with self.condition:
+            self.resume_event.set()
+            self.condition.notify_all()
+        self.queue_changed()
+
+    def cancel(self):
+        """ Отменяет все главы и снимает паузу. Возвращает ключи (slug, том, глава) глав
+        из очереди: для них, как и в cancel_job, on_job_finished не вызывается """
+        with self.condition:
+            removed = [job[:3] for job in self.pending]
+            self.pending.clear()
+            self.job_traffic.clear()
+            for future in self.page_lists.values():
+                future.cancel()
+            self.page_lists.clear()
+            for downloader in self.running.values():
+                downloader.cancel_event.set()
+            self.resume_event.set()
+            self.condition.notify_all()
+        self.queue_changed()
+        return removed
+
+    def cancel_job(self, slug_url, volume_number, chapter_number):
+        """ Отменяет одну главу. Глава из очереди просто удаляется (on_job_finished
+        для неё не вызывается); загружаемая глава завершается с ошибкой отмены """
+        key = (slug_url, volume_number, chapter_number)
+        with self.condition:
+            pending = len(self.pending)
+            self.pending = deque(job for job in self.pending if job[:3] != key)
+            removed = len(self.pending) != pending
+            if removed:
+                self.job_traffic.pop(key, None)
+            future = self.page_lists.pop(key, None)
+            if future is not None:
+                future.cancel()
+            downloader = self.running.get(key)
+            if downloader is not None:
+                downloader.cancel_event.set()
+            self.condition.notify_all()
+        self.queue_changed()
+        return removed
+
+    def wait(self, timeout=None):
+        """ Ждёт опустошения очереди; с таймаутом возвращает False, если очередь ещё не пуста """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.running, timeout)
+
+    def queue_changed(self):
+        with self.condition:
+            pending, running = len(self.pending), len(self.running)
+        self.metrics.set("queue_pending", pending)
+        self.metrics.set("queue_running", running)
+        if self.on_queue_changed is not None:
+            self.on_queue_changed(pending, running)
+
+    def record_chapter(self, downloader, save_dir):
+        if self.library is None:
+            return
+        state = "complete" if save_dir else "incomplete"
+        try:
+            self.library.record_chapter(
+                downloader.slug_url, downloader.volume_number, downloader.chapter_number, state,
+                downloader.total_pages or None, save_dir, downloader.save_directory
+            )
+        except Exception as e:
+            logger.warning("Library update failed for %s: %s", downloader.label, e)
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                while self.is_paused() and self.pending:
+                    self.condition.wait()
+                if not self.pending or len(self.running) >= self.max_jobs:
+                    return
+                slug_url, volume_number, chapter_number, save_directory = self.pending.popleft()
+                key = (slug_url, volume_number, chapter_number)
+                page_list = self.page_lists.pop(key, None)
+                traffic_class, weight = self.job_traffic.pop(key, (self.traffic_class, 1.0))
+                self.prefetch_page_lists()
+                downloader = ChapterDownloader(
+                    slug_url, volume_number, chapter_number, save_directory,
+                    max_workers=self.page_workers,
+                    policy=self.policy,
+                    page_store=self.page_store(save_directory),
+                    profile=self.profile,
+                    image_pool=self.processing_pool(),
+                    page_list=page_list,
+                    formats=self.formats,
+                    keep_pages=self.keep_pages,
+                    fsync=self.fsync,
+                    bandwidth=self.bandwidth,
+                    traffic_class=traffic_class,
+                    weight=weight,
+                    metrics=self.metrics,
+                    resume_event=self.resume_event,
+                    cancel_event=threading.Event(),
+                    on_log=self.on_log,
+                    on_progress=lambda done, total, k=key: self.update_progress(k, done, total)
+                )
+                self.running[key] = downloader
+            self.queue_changed()
+
+            save_dir = downloader.run()
+            self.metrics.inc("chapters_total", result="ok" if save_dir else "failed")
+            self.record_chapter(downloader, save_dir)
+            if self.on_job_finished is not None:
+                self.on_job_finished(downloader, save_dir)
+
+            with self.condition:
+                self.running.pop(key, None)
+                idle = not self.pending and not self.running
+                if idle:
+                    self.progress.clear()
+                    self.progress_samples.clear()
+                self.condition.notify_all()
+            self.queue_changed()
+            if idle and self.on_all_finished is not None:
+                self.on_all_finished()
+
+    def update_progress(self, key, done, total):
+        now = time.monotonic()
+        with self.condition:
+            self.progress[key] = (done, total)
+            done_sum = sum(done for done, _ in self.progress.values())
+            total_sum = sum(total for _, total in self.progress.values())
+            # Для глав в очереди число страниц ещё неизвестно — считаем по среднему
+            estimated_total = total_sum + len(self.pending) * total_sum / len(self.progress)
+            samples = self.progress_samples
+            samples.append((now, done_sum))
+            while len(samples) > 2 and samples[0][0] < now - PROGRESS_WINDOW:
+                samples.popleft()
+            eta = None
+            elapsed = now - samples[0][0]
+            if elapsed > 0 and done_sum > samples[0][1]:
+                eta = (estimated_total - done_sum) * elapsed / (done_sum - samples[0][1])
+        self.metrics.set("progress_pages_done", done_sum)
+        self.metrics.set("progress_pages_total", round(estimated_total))
+        self.metrics.set("progress_eta_seconds", round(eta, 1) if eta is not None else -1)
+        if self.on_job_progress is not None:
+            self.on_job_progress(key, done, total)
+        if self.on_progress is not None:
+            self.on_progress(done_sum, total_sum, eta)
@@ -0,0 +1,119 @@
+""" Загрузка обложек для таблицы поиска: небольшой пул потоков вместо QThread на каждую
+строку, LRU готовых миниатюр в памяти и кэш миниатюр на диске по URL обложки """
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import Qt, QObject, pyqtSignal
+from PyQt6.QtGui import QImage, QPixmap
+
+from metadata_cache import default_cache_dir
+from request_policy import default_policy
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTH = 100
+THUMBNAIL_HEIGHT = 150
+COVER_WORKERS = 4
+MEMORY_CACHE_SIZE = 300
+DISK_CACHE_FILES = 3000
+# Через сколько секунд обложку, которая не загрузилась, можно запросить снова
+FAILED_RETRY_SECONDS = 60.0
+
+
+class CoverService(QObject):
+    """ request(url) сразу возвращает QPixmap, если миниатюра уже в памяти;
+    иначе ставит загрузку в пул и позже испускает cover_ready(url, QPixmap) """
+    cover_ready = pyqtSignal(str, QPixmap)
+    error_occurred = pyqtSignal(str, str)
+    # Внутренний сигнал: QImage можно создавать в рабочем потоке, QPixmap — только в главном
+    image_loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, cache_dir=None, parent=None):
+        super().__init__(parent)
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), "covers")
+        self.memory = OrderedDict()
+        self.in_flight = set()
+        # URL -> время неудачной загрузки
+        self.failed = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=COVER_WORKERS, thread_name_prefix="cover")
+        self.image_loaded.connect(self.on_image_loaded)
+        self.pool.submit(self.prune_disk_cache)
+
+    def request(self, url):
+        pixmap = self.memory.get(url)
+        if pixmap is not None:
+            self.memory.move_to_end(url)
+            return pixmap
+        with self.lock:
+            if url in self.in_flight:
+                return None
+            failed_at = self.failed.get(url)
+            if failed_at is not None:
+                if time.monotonic() - failed_at < FAILED_RETRY_SECONDS:
+                    return None
+                del self.failed[url]
+            self.in_flight.add(url)
+        self.pool.submit(self.load, url)
+        return None
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".jpg")
+
+    def load(self, url):
+        try:
+            path = self.cache_path(url)
+            image = QImage(path) if os.path.exists(path) else QImage()
+            if image.isNull():
+                response = default_policy.get(url)
+                response.raise_for_status()
+                image = QImage()
+                if not image.loadFromData(response.content):
+                    raise ValueError("Неверный формат изображения")
+                image = image.scaled(
+                    THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT,
+                    Qt.AspectRatioMode.KeepAspectRatio,
+                    Qt.TransformationMode.SmoothTransformation
+                )
+                os.makedirs(self.cache_dir, exist_ok=True)
+                image.save(path + ".tmp", "JPG", 90)
+                os.replace(path + ".tmp", path)
+            self.image_loaded.emit(url, image)
+        except Exception as e:
+            with self.lock:
+                self.in_flight.discard(url)
+                self.failed[url] = time.monotonic()
+            self.error_occurred.emit(url, f"Ошибка загрузки обложки: {str(e)}")
+
+    def on_image_loaded(self, url, image):
+        with self.lock:
+            self.in_flight.discard(url)
+        pixmap = QPixmap.fromImage(image)
+        self.memory[url] = pixmap
+        self.memory.move_to_end(url)
+        while len(self.memory) > MEMORY_CACHE_SIZE:
+            self.memory.popitem(last=False)
+        self.cover_ready.emit(url, pixmap)
+
+    def prune_disk_cache(self):
+        """ Оставляет на диске не больше DISK_CACHE_FILES самых свежих миниатюр """
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        except OSError:
+            return
+        if len(entries) <= DISK_CACHE_FILES:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - DISK_CACHE_FILES]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,775 @@
+""" Служба загрузки: долгоживущий процесс с очередью глав в SQLite (WAL) и
+HTTP/JSON API на локальном адресе. Очередь переживает перезапуск и падение
+процесса: главы, которые загружались в момент падения, снова ставятся в очередь
+и докачиваются по manifest.json. Окно программы подключается к службе как
+клиент (RemoteScheduler), автоматизация — через HTTP:
+
+    GET  /status                  состояние очереди
+    GET  /jobs?state=queued       список заданий
+    POST /jobs                    {"slug_url", "volumes", "chapters", "save_directory", "priority"}
+                                  или {"jobs": [{"slug_url", "volume", "number", "save_directory", "priority"}]}
+    GET  /jobs/<id>
+    POST /jobs/<id>/priority      {"priority": 10}
+    POST /jobs/<id>/cancel
+    POST /pause, /resume
+    POST /cancel                  отменить все задания (пауза при этом сохраняется)
+    POST /bandwidth               {"limit": "2M"} — общий предел скорости, "0" — без предела
+    GET  /events                  поток событий (text/event-stream)
+    GET  /metrics, /metrics.json
+
+Задания с большим priority выполняются раньше; в DownloadScheduler передаётся
+не больше глав, чем он загружает одновременно, поэтому новый приоритет
+учитывается сразу, а не после уже набранной очереди. При ограничении скорости
+(--limit-rate) приоритет задаёт и долю главы в общей скорости.
+
+Каждый запрос несёт заголовок Authorization: Bearer <токен>. Если токен не задан,
+служба создаёт его сама и сохраняет в daemon.token в папке данных пользователя
+(файл доступен только владельцу, окно программы читает его оттуда). POST
+принимает только Content-Type: application/json, а заголовок Host должен быть
+локальным адресом или адресом службы: иначе любая открытая в браузере страница
+могла бы отправить запрос на 127.0.0.1 без проверки CORS """
+import json
+import logging
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse, urlsplit
+
+import requests
+
+from bandwidth import BACKGROUND, parse_rate, priority_weight, weight_priority
+from core import DownloadScheduler, resolve_jobs
+from library import default_data_dir
+from metrics import default_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8790
+# Состояния задания
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATES = (QUEUED, RUNNING)
+# Значения заголовка Host, которые принимаются всегда
+LOOPBACK_HOSTS = {"localhost", "127.0.0.1", "::1"}
+# Как часто поток событий шлёт комментарий, чтобы соединение не закрылось по таймауту
+EVENTS_KEEPALIVE = 15.0
+# Как часто RemoteScheduler.wait сверяет состояние очереди со службой, секунд
+WAIT_POLL = 1.0
+# Сколько событий ждёт отправки одному клиенту; медленный клиент теряет лишние
+EVENTS_BACKLOG = 2000
+
+
+def default_queue_path():
+    return os.path.join(default_data_dir(), "jobs.sqlite3")
+
+
+def default_token_path():
+    return os.path.join(default_data_dir(), "daemon.token")
+
+
+def load_token(path=None):
+    """ Токен из MANGALIB_DAEMON_TOKEN или из файла, который записала служба """
+    if os.environ.get("MANGALIB_DAEMON_TOKEN"):
+        return os.environ["MANGALIB_DAEMON_TOKEN"]
+    try:
+        with open(path or default_token_path(), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def create_token(path=None):
+    """ Случайный токен в файле, доступном только владельцу """
+    path = path or default_token_path()
+    token = secrets.token_urlsafe(32)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    if os.name != "nt":
+        os.chmod(path, 0o600)
+    return token
+
+
+class JobStore:
+    """ Очередь заданий в SQLite. Все методы потокобезопасны """
+
+    def __init__(self, path=None):
+        self.path = path or default_queue_path()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, slug_url TEXT, volume TEXT, number TEXT,"
+            " save_directory TEXT, priority INTEGER DEFAULT 0, state TEXT, pages_done INTEGER DEFAULT 0,"
+            " pages_total INTEGER DEFAULT 0, save_dir TEXT DEFAULT '', error TEXT DEFAULT '',"
+            " created_at REAL, updated_at REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority DESC, id)")
+        self.connection.commit()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.connection.execute(sql, params)
+            rows = cursor.fetchall()
+            self.connection.commit()
+        return rows
+
+    def recover(self):
+        """ После падения процесса прерванные задания снова ставятся в очередь """
+        with self.lock:
+            count = self.connection.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE state = ?", (QUEUED, time.time(), RUNNING)
+            ).rowcount
+            self.connection.commit()
+        return count
+
+    def add(self, slug_url, volume, number, save_directory, priority=0):
+        """ Возвращает (id, добавлено). Глава, которая уже в очереди или загружается,
+        не добавляется второй раз — у существующего задания только повышается приоритет """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id FROM jobs WHERE slug_url = ? AND volume = ? AND number = ? AND state IN (?, ?)",
+                (slug_url, str(volume), str(number)) + ACTIVE_STATES
+            ).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE jobs SET priority = MAX(priority, ?) WHERE id = ?",
+                                        (priority, row["id"]))
+                self.connection.commit()
+                return row["id"], False
+            job_id = self.connection.execute(
+                "INSERT INTO jobs (slug_url, volume, number, save_directory, priority, state, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (slug_url, str(volume), str(number), save_directory, priority, QUEUED, now, now)
+            ).lastrowid
+            self.connection.commit()
+        return job_id, True
+
+    def get(self, job_id):
+        rows = self.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def list(self, state=None, limit=1000):
+        if state:
+            rows = self.execute("SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT ?",
+                                (state, limit))
+        else:
+            rows = self.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows]
+
+    def counts(self):
+        return {row["state"]: row["count"]
+                for row in self.execute("SELECT state, COUNT(*) AS count FROM jobs GROUP BY state")}
+
+    def claim_next(self):
+        """ Забирает задание с наибольшим приоритетом и отмечает его выполняемым """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?",
+                                    (RUNNING, time.time(), row["id"]))
+            self.connection.commit()
+        return dict(row, state=RUNNING)
+
+    def set_priority(self, job_id, priority):
+        return self.update(job_id, "priority = ?", (priority,))
+
+    def set_state(self, job_id, state, only_from=None, **fields):
+        """ Меняет состояние; с only_from — только если задание сейчас в одном из этих состояний """
+        assignments = "".join(f", {name} = ?" for name in fields)
+        sql = f"state = ?, updated_at = ?{assignments}"
+        params = (state, time.time()) + tuple(fields.values())
+        return self.update(job_id, sql, params, only_from)
+
+    def update(self, job_id, assignments, params, only_from=None):
+        sql = f"UPDATE jobs SET {assignments} WHERE id = ?"
+        params = tuple(params) + (job_id,)
+        if only_from:
+            sql += f" AND state IN ({', '.join('?' * len(only_from))})"
+            params += tuple(only_from)
+        with self.lock:
+            changed = self.connection.execute(sql, params).rowcount
+            self.connection.commit()
+        return bool(changed)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class EventBus:
+    """ Рассылает события всем подписчикам; у каждого своя ограниченная очередь """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=EVENTS_BACKLOG)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, event, data):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                pass
+
+
+class DownloadService:
+    """ Очередь заданий в JobStore, которую выполняет DownloadScheduler.
+    scheduler_options передаются в DownloadScheduler (profile, formats, dedupe и т.д.);
+    on_log получает сообщения загрузки вдобавок к потоку событий """
+
+    def __init__(self, store, token=None, on_log=None, **scheduler_options):
+        self.store = store
+        self.token = token
+        self.on_log = on_log
+        self.events = EventBus()
+        self.lock = threading.Lock()
+        # (slug, том, глава) -> id задания, переданного в DownloadScheduler
+        self.active = {}
+        self.cancelled = set()
+        self.progress = {}
+        self.stopping = threading.Event()
+        self.scheduler = DownloadScheduler(
+            on_log=self.log,
+            on_progress=lambda done, total, eta: self.events.publish(
+                "progress", {"done": done, "total": total, "eta": eta}),
+            on_queue_changed=lambda pending, running: self.publish_queue(),
+            on_job_finished=self.on_job_finished,
+            on_job_progress=self.on_job_progress,
+            **scheduler_options
+        )
+
+    def log(self, message, msg_type="info", group=None):
+        self.events.publish("log", {"message": message, "type": msg_type, "group": group or ""})
+        if self.on_log is not None:
+            self.on_log(message, msg_type, group)
+
+    def start(self):
+        recovered = self.store.recover()
+        if recovered:
+            logger.info("Requeued %d interrupted jobs", recovered)
+        self.dispatch()
+
+    def dispatch(self):
+        """ Передаёт в DownloadScheduler задания с наибольшим приоритетом, пока у него есть место """
+        while not self.stopping.is_set():
+            with self.lock:
+                if len(self.active) >= self.scheduler.max_jobs:
+                    return
+                job = self.store.claim_next()
+                if job is None:
+                    return
+                key = (job["slug_url"], job["volume"], job["number"])
+                self.active[key] = job["id"]
+            self.events.publish("job", job)
+            if not self.scheduler.enqueue(job["slug_url"], job["volume"], job["number"], job["save_directory"],
+                                          weight=priority_weight(job["priority"])):
+                # Та же глава уже в DownloadScheduler — например, из прошлого запуска службы
+                with self.lock:
+                    self.active.pop(key, None)
+                self.finish(job["id"], FAILED, error="глава уже загружается")
+
+    def add(self, jobs):
+        """ jobs — [(slug, том, глава, папка, приоритет)]; возвращает id добавленных заданий """
+        added = []
+        for slug_url, volume, number, save_directory, priority in jobs:
+            job_id, created = self.store.add(slug_url, volume, number, save_directory, priority)
+            if created:
+                added.append(job_id)
+                self.events.publish("job", self.store.get(job_id))
+        self.dispatch()
+        self.publish_queue()
+        return added
+
+    def cancel(self, job_id):
+        job = self.store.get(job_id)
+        if job is None or job["state"] not in ACTIVE_STATES:
+            return False
+        if self.store.set_state(job_id, CANCELLED, only_from=(QUEUED,)):
+            self.events.publish("job", self.store.get(job_id))
+            self.publish_queue()
+            return True
+        key = (job["slug_url"], job["volume"], job["number"])
+        with self.lock:
+            if self.active.get(key) != job_id:
+                return False
+            self.cancelled.add(job_id)
+        if self.scheduler.cancel_job(*key):
+            # Глава не успела начаться — on_job_finished для неё не будет
+            with self.lock:
+                self.active.pop(key, None)
+            self.finish(job_id, CANCELLED)
+            self.dispatch()
+        return True
+
+    def cancel_all(self):
+        """ Отменяет все задания; пауза службы сохраняется """
+        for job in self.store.list(QUEUED, limit=1000000):
+            self.store.set_state(job["id"], CANCELLED, only_from=(QUEUED,))
+        with self.lock:
+            self.cancelled.update(self.active.values())
+        paused = self.scheduler.is_paused()
+        removed = self.scheduler.cancel()
+        if paused:
+            self.scheduler.pause()
+        # Главы, которые не успели начаться, — on_job_finished для них не будет
+        for key in removed:
+            with self.lock:
+                job_id = self.active.pop(key, None)
+                self.cancelled.discard(job_id)
+            if job_id is not None:
+                self.finish(job_id, CANCELLED)
+        self.dispatch()
+        self.publish_queue()
+
+    def set_priority(self, job_id, priority):
+        changed = self.store.set_priority(job_id, priority)
+        if changed:
+            job = self.store.get(job_id)
+            self.scheduler.set_weight(job["slug_url"], job["volume"], job["number"], priority_weight(priority))
+            self.events.publish("job", job)
+        return changed
+
+    def on_job_progress(self, key, done, total):
+        with self.lock:
+            job_id = self.active.get(key)
+            if job_id is None:
+                return
+            self.progress[job_id] = (done, total)
+        self.events.publish("job_progress", {"id": job_id, "done": done, "total": total})
+
+    def on_job_finished(self, downloader, save_dir):
+        key = (downloader.slug_url, downloader.volume_number, downloader.chapter_number)
+        with self.lock:
+            job_id = self.active.pop(key, None)
+            cancelled = job_id in self.cancelled
+            self.cancelled.discard(job_id)
+            done, total = self.progress.pop(job_id, (0, downloader.total_pages))
+        if job_id is not None:
+            if save_dir:
+                state = DONE
+            else:
+                state = CANCELLED if cancelled else FAILED
+            self.finish(job_id, state, save_dir=save_dir, pages_done=done, pages_total=total,
+                        error="" if save_dir or cancelled else f"страниц с ошибкой: {downloader.failed_pages}")
+        self.dispatch()
+        # DownloadScheduler сообщил об очереди до того, как задание ушло из active
+        self.publish_queue()
+        if self.is_idle():
+            self.events.publish("idle", {})
+
+    def finish(self, job_id, state, **fields):
+        self.store.set_state(job_id, state, **fields)
+        self.events.publish("job", self.store.get(job_id))
+
+    def is_idle(self):
+        with self.lock:
+            return not self.active and not self.store.counts().get(QUEUED)
+
+    def status(self):
+        counts = self.store.counts()
+        with self.lock:
+            running = len(self.active)
+        return {
+            "paused": self.scheduler.is_paused(),
+            "pending": counts.get(QUEUED, 0),
+            "running": running,
+            "jobs": counts,
+            "bandwidth": self.scheduler.bandwidth.status(),
+        }
+
+    def publish_queue(self):
+        self.events.publish("queue", self.status())
+
+    def set_rate_limit(self, rate):
+        self.scheduler.bandwidth.set_rate(rate)
+        self.publish_queue()
+
+    def pause(self):
+        self.scheduler.pause()
+
+    def resume(self):
+        self.scheduler.resume()
+
+    def close(self):
+        self.stopping.set()
+        self.scheduler.close()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def host_allowed(self):
+        """ Защита от DNS rebinding: страница с чужого домена, который указывает
+        на 127.0.0.1, пришлёт в Host своё имя """
+        host = urlsplit("//" + self.headers.get("Host", "")).hostname
+        if host in self.server.allowed_hosts:
+            return True
+        self.send_json({"error": "host not allowed"}, 403)
+        return False
+
+    def authorized(self):
+        if not self.host_allowed():
+            return False
+        if not self.service.token:
+            return True
+        if self.headers.get("Authorization") == f"Bearer {self.service.token}":
+            return True
+        self.send_json({"error": "unauthorized"}, 401)
+        return False
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, content_type):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(body, dict):
+            raise ValueError("body must be a JSON object")
+        return body
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if url.path == "/status":
+            self.send_json(self.service.status())
+        elif url.path == "/jobs":
+            state = parse_qs(url.query).get("state", [None])[0]
+            self.send_json({"jobs": self.service.store.list(state)})
+        elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            job = self.service.store.get(int(parts[1]))
+            self.send_json(job if job else {"error": "not found"}, 200 if job else 404)
+        elif url.path == "/events":
+            self.stream_events()
+        elif url.path == "/metrics.json":
+            self.send_json(default_metrics.snapshot())
+        elif url.path == "/metrics":
+            self.send_text(default_metrics.prometheus_text(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        # Браузер шлёт text/plain и формы без предварительного запроса CORS, а JSON — только после него
+        if self.headers.get_content_type() != "application/json":
+            self.send_json({"error": "Content-Type must be application/json"}, 415)
+            return
+        try:
+            body = self.read_json()
+        except ValueError as e:
+            self.send_json({"error": f"invalid JSON: {e}"}, 400)
+            return
+        parts = urlparse(self.path).path.strip("/").split("/")
+        try:
+            if parts == ["jobs"]:
+                self.send_json({"added": self.service.add(jobs_from_request(body))})
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "cancel":
+                self.send_json({"cancelled": self.service.cancel(int(parts[1]))})
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "priority":
+                priority = body_field(body, "priority", int)
+                self.send_json({"updated": self.service.set_priority(int(parts[1]), priority)})
+            elif parts == ["pause"]:
+                self.service.pause()
+                self.send_json(self.service.status())
+            elif parts == ["resume"]:
+                self.service.resume()
+                self.send_json(self.service.status())
+            elif parts == ["cancel"]:
+                self.service.cancel_all()
+                self.send_json(self.service.status())
+            elif parts == ["bandwidth"]:
+                self.service.set_rate_limit(body_field(body, "limit", parse_rate))
+                self.send_json(self.service.status())
+            else:
+                self.send_json({"error": "not found"}, 404)
+        except KeyError as e:
+            self.send_json({"error": f"missing field {e}"}, 400)
+        except (TypeError, ValueError) as e:
+            self.send_json({"error": str(e)}, 400)
+
+    def stream_events(self):
+        """ Server-sent events: "event: <тип>" и "data: <JSON>" на каждое событие """
+        subscriber = self.service.events.subscribe()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.write_event("queue", self.service.status())
+            while not self.service.stopping.is_set():
+                try:
+                    event, data = subscriber.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                self.write_event(event, data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.service.events.unsubscribe(subscriber)
+
+    def write_event(self, event, data):
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+        self.wfile.flush()
+
+
+def body_field(body, name, convert):
+    """ Обязательное поле тела запроса, приведённое convert; ValueError — ответ 400 с понятным текстом """
+    if name not in body:
+        raise ValueError(f'missing field "{name}"')
+    try:
+        return convert(body[name])
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid field "{name}": {body[name]!r}')
+
+
+def jobs_from_request(body):
+    """ Задания из тела POST /jobs: явный список глав или диапазоны томов и глав """
+    if "jobs" in body:
+        return [
+            (job["slug_url"], job["volume"], job["number"], job["save_directory"], int(job.get("priority", 0)))
+            for job in body["jobs"]
+        ]
+    slug_url = body["slug_url"]
+    save_directory = body["save_directory"]
+    priority = int(body.get("priority", 0))
+    return [
+        (slug_url, volume, number, save_directory, priority)
+        for volume, number in resolve_jobs(slug_url, body.get("volumes", ""), body.get("chapters", ""))
+    ]
+
+
+def start_service(service, port=DEFAULT_PORT, host="127.0.0.1", allowed_hosts=()):
+    """ Запускает очередь и HTTP API в фоновом потоке; возвращает сервер.
+    allowed_hosts — имена, под которыми к службе обращаются по сети (заголовок Host) """
+    service.start()
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.allowed_hosts = LOOPBACK_HOSTS | {host} - {"", "0.0.0.0", "::"} | set(allowed_hosts)
+    threading.Thread(target=server.serve_forever, name="download-service", daemon=True).start()
+    return server
+
+
+class DaemonClient:
+    """ Клиент HTTP API службы загрузки """
+
+    def __init__(self, base_url, token=None, timeout=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def request(self, method, path, **kwargs):
+        if method == "POST" and "json" not in kwargs:
+            kwargs["json"] = {}
+        response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def status(self):
+        return self.request("GET", "/status")
+
+    def jobs(self, state=None):
+        return self.request("GET", "/jobs", params={"state": state} if state else None)["jobs"]
+
+    def add(self, jobs, priority=0):
+        """ jobs — [(slug, том, глава, папка)] """
+        body = {"jobs": [
+            {"slug_url": slug_url, "volume": volume, "number": number, "save_directory": save_directory,
+             "priority": priority}
+            for slug_url, volume, number, save_directory in jobs
+        ]}
+        return self.request("POST", "/jobs", json=body)["added"]
+
+    def cancel(self, job_id=None):
+        return self.request("POST", f"/jobs/{job_id}/cancel" if job_id is not None else "/cancel")
+
+    def set_priority(self, job_id, priority):
+        return self.request("POST", f"/jobs/{job_id}/priority", json={"priority": priority})
+
+    def set_bandwidth(self, rate):
+        return self.request("POST", "/bandwidth", json={"limit": str(rate)})
+
+    def pause(self):
+        return self.request("POST", "/pause")
+
+    def resume(self):
+        return self.request("POST", "/resume")
+
+    def events(self):
+        """ Генератор событий (тип, данные); завершается, когда соединение закрыто """
+        with self.session.get(self.base_url + "/events", stream=True, timeout=(self.timeout, None)) as response:
+            response.raise_for_status()
+            event = None
+            # chunk_size=1: иначе iter_lines ждёт 512 байт, и последнее событие
+            # (например, опустевшая очередь) приходило бы только с keepalive
+            for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: ") and event:
+                    yield event, json.loads(line[len("data: "):])
+                    event = None
+
+    def close(self):
+        self.session.close()
+
+
+class RemoteScheduler:
+    """ Замена DownloadScheduler для окна программы, подключённого к службе:
+    те же методы и обработчики on_*, но главы загружает служба. Параметры загрузки
+    (max_jobs, profile, formats и т.д.) задаются при запуске службы и здесь не действуют —
+    окно отключает их поля; предел скорости передаётся службе """
+
+    def __init__(self, base_url, token=None, on_log=None, on_progress=None, on_queue_changed=None,
+                 on_job_finished=None, on_all_finished=None, **ignored):
+        self.client = DaemonClient(base_url, token)
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.on_queue_changed = on_queue_changed
+        self.on_job_finished = on_job_finished
+        self.on_all_finished = on_all_finished
+        self.max_jobs = self.page_workers = self.dedupe = self.profile = self.formats = self.keep_pages = None
+        self.paused = False
+        # Состояние очереди службы из событий "queue"; None — событий ещё не было
+        self.pending = self.running = None
+        self.idle = threading.Condition()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.events_loop, name="download-service-events", daemon=True)
+        self.thread.start()
+
+    def events_loop(self):
+        while not self.closed.is_set():
+            try:
+                for event, data in self.client.events():
+                    if self.closed.is_set():
+                        return
+                    self.handle_event(event, data)
+            except Exception as e:
+                logger.debug("Download service events interrupted: %s", e)
+            self.closed.wait(2.0)
+
+    def handle_event(self, event, data):
+        if event == "log" and self.on_log is not None:
+            self.on_log(data["message"], data["type"], data["group"])
+        elif event == "progress" and self.on_progress is not None:
+            self.on_progress(data["done"], data["total"], data["eta"])
+        elif event == "queue":
+            self.update_queue(data)
+            if self.on_queue_changed is not None:
+                self.on_queue_changed(data["pending"], data["running"])
+        elif event == "job" and data["state"] in (DONE, FAILED) and self.on_job_finished is not None:
+            self.on_job_finished(data, data["save_dir"] if data["state"] == DONE else "")
+        elif event == "idle" and self.on_all_finished is not None:
+            self.on_all_finished()
+
+    def update_queue(self, status):
+        self.paused = status["paused"]
+        with self.idle:
+            self.pending, self.running = status["pending"], status["running"]
+            self.idle.notify_all()
+
+    def enqueue(self, slug_url, volume_number, chapter_number, save_directory):
+        return bool(self.enqueue_many([(slug_url, volume_number, chapter_number, save_directory)]))
+
+    def enqueue_many(self, jobs, traffic_class=None, weight=1.0):
+        """ Фоновые главы (новые главы отслеживаемых тайтлов) получают пониженный приоритет """
+        added = self.client.add(jobs, priority=-1 if traffic_class == BACKGROUND else 0)
+        # Событие об изменении очереди может прийти позже — wait() не должен увидеть старое состояние
+        self.update_queue(self.client.status())
+        return len(added)
+
+    def set_weight(self, slug_url, volume_number, chapter_number, weight):
+        """ Доля главы задаётся приоритетом задания в службе """
+        key = (slug_url, str(volume_number), str(chapter_number))
+        for job in self.client.jobs():
+            if (job["slug_url"], job["volume"], job["number"]) == key and job["state"] in (QUEUED, RUNNING):
+                self.client.set_priority(job["id"], weight_priority(weight))
+
+    def set_rate_limit(self, rate):
+        self.client.set_bandwidth(rate)
+
+    def wait(self, timeout=None):
+        """ Ждёт, пока очередь службы опустеет; с таймаутом возвращает False, если не опустела.
+        Событие может прийти раньше ответа на enqueue, поэтому состояние ещё и запрашивается
+        у службы раз в WAIT_POLL секунд """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.idle:
+                step = WAIT_POLL if deadline is None else min(WAIT_POLL, deadline - time.monotonic())
+                if self.idle.wait_for(lambda: self.pending == 0 and self.running == 0, max(step, 0)):
+                    return True
+                if step <= 0:
+                    return False
+            self.update_queue(self.client.status())
+
+    def is_paused(self):
+        return self.paused
+
+    def pause(self):
+        self.paused = self.client.pause()["paused"]
+
+    def resume(self):
+        self.paused = self.client.resume()["paused"]
+
+    def cancel(self):
+        self.client.cancel()
+
+    def close(self):
+        self.closed.set()
+        self.client.close()
@@ -0,0 +1,213 @@
+""" Общий HTTP-клиент для всех запросов приложения: API, обложек и страниц.
+У каждого хоста своя requests.Session с пулом keep-alive соединений нужного
+размера, поэтому TLS-рукопожатие делается один раз на соединение, а не на
+каждый запрос. Адреса хостов кэшируются (DNS, см. enable_dns_cache), ответы API
+запрашиваются сжатыми (gzip и deflate, br — если установлен пакет brotli),
+таймауты общие, а обработчики трассировки получают каждый запрос.
+
+Повторы, ограничение частоты и распределение скорости остаются в request_policy
+и bandwidth: клиент только выполняет запрос """
+import logging
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+from metrics import default_metrics
+
+logger = logging.getLogger(__name__)
+
+# Таймауты соединения и чтения, секунд
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 15.0
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+DEFAULT_POOL_SIZE = 8
+# Сколько секунд помнится адрес хоста (getaddrinfo не сообщает TTL записи)
+DNS_TTL = 300.0
+# Сжатие, которое умеет распаковывать urllib3 в этом окружении
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+# Для страниц: изображения уже сжаты, а со сжатием Content-Length и Range
+# относятся к сжатому телу и докачка .part-файла ломается
+NO_COMPRESSION = {"Accept-Encoding": "identity"}
+
+
+def pool_key(url):
+    """ Ключ сессии и пула соединений: (схема, хост) """
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.netloc
+
+
+class DnsCache:
+    """ Кэш socket.getaddrinfo. Ставится на весь процесс: urllib3 ищет адрес хоста
+    через socket.getaddrinfo при каждом новом соединении. Каждый вызов — новое
+    соединение, поэтому здесь же считается connections_total. ttl = 0 — адреса
+    не кэшируются, только считаются соединения """
+
+    def __init__(self, ttl=DNS_TTL, metrics=None):
+        self.ttl = ttl
+        self.metrics = metrics or default_metrics
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.original = None
+
+    def install(self):
+        with self.lock:
+            if self.original is None:
+                self.original = socket.getaddrinfo
+                socket.getaddrinfo = self.getaddrinfo
+
+    def getaddrinfo(self, host, port, *args, **kwargs):
+        self.metrics.inc("connections_total", host=host)
+        key = (host, port, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        result = self.original(host, port, *args, **kwargs)
+        if self.ttl <= 0:
+            return result
+        with self.lock:
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+    def forget(self, host):
+        """ После ошибки соединения адрес ищется заново: хост мог переехать """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == host]:
+                del self.entries[key]
+
+
+class HttpClient:
+    """ Потокобезопасен: сессии создаются под блокировкой, а соединения между
+    потоками раздаёт пул urllib3. hooks и trace получают словарь с методом, адресом,
+    хостом, кодом ответа (или ошибкой) и временем до заголовков ответа """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        # Размер пула по умолчанию и (схема, хост) -> свой размер пула
+        self.pool_size = pool_size
+        self.pool_sizes = {}
+        self.timeout = timeout
+        # Ставится enable_dns_cache
+        self.dns_cache = None
+        # (схема, хост) -> requests.Session
+        self.sessions = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def enable_dns_cache(self, ttl=DNS_TTL):
+        """ Кэширует адреса хостов на ttl секунд. Подменяет socket.getaddrinfo во всём
+        процессе, поэтому вызывается из точки входа программы, а не при импорте """
+        with self.lock:
+            if self.dns_cache is None:
+                self.dns_cache = DnsCache(ttl)
+                self.dns_cache.install()
+            else:
+                self.dns_cache.ttl = ttl
+
+    def adapter(self, key):
+        return HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_sizes.get(key, self.pool_size))
+
+    def session(self, url):
+        key = pool_key(url)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+                adapter = self.adapter(key)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[key] = session
+        return session
+
+    def set_pool_size(self, size, url=None):
+        """ Соединений к хосту url; без url — к каждому хосту, у которого нет своего
+        размера. Пул меньше числа одновременных запросов к хосту закрывал бы лишние соединения """
+        with self.lock:
+            if url is None:
+                if size == self.pool_size:
+                    return
+                self.pool_size = size
+                keys = [key for key in self.sessions if key not in self.pool_sizes]
+            else:
+                key = pool_key(url)
+                if size == self.pool_sizes.get(key):
+                    return
+                self.pool_sizes[key] = size
+                keys = [key] if key in self.sessions else []
+            for key in keys:
+                session = self.sessions[key]
+                old = session.get_adapter("http://")
+                adapter = self.adapter(key)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                # Занятые соединения старого пула закроются, когда вернутся в него
+                old.close()
+
+    def add_hook(self, hook):
+        with self.lock:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self.lock:
+            if hook in self.hooks:
+                self.hooks.remove(hook)
+
+    def trace(self, trace, url, response, seconds, error):
+        with self.lock:
+            hooks = list(self.hooks)
+        if trace is not None:
+            hooks.append(trace)
+        if not hooks:
+            return
+        event = {
+            "method": "GET",
+            "url": url,
+            "host": pool_key(url)[1],
+            "status": response.status_code if response is not None else None,
+            "seconds": seconds,
+            "error": error,
+        }
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("HTTP trace hook failed")
+
+    def get(self, url, trace=None, **kwargs):
+        """ GET через сессию хоста; trace(событие) вызывается вместе с общими hooks """
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.monotonic()
+        try:
+            response = self.session(url).get(url, **kwargs)
+        except requests.RequestException as e:
+            if isinstance(e, requests.ConnectionError) and self.dns_cache is not None:
+                self.dns_cache.forget(urlparse(url).hostname)
+            self.trace(trace, url, None, time.monotonic() - started, e)
+            raise
+        self.trace(trace, url, response, time.monotonic() - started, None)
+        return response
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+def log_trace(event):
+    """ Обработчик для add_hook: пишет каждый запрос в журнал """
+    if event["error"] is not None:
+        logger.info("GET %s failed after %.3fs: %s", event["url"], event["seconds"], event["error"])
+    else:
+        logger.info("GET %s %s %.3fs", event["url"], event["status"], event["seconds"])
+
+
+# Общий клиент для всех запросов процесса
+default_client = HttpClient()
@@ -0,0 +1,168 @@
+""" Выбор сервера изображений. Страница доступна на нескольких зеркалах по
+одному и тому же пути; пул хранит для каждого зеркала оценку задержки и скорости
+(по настоящим загрузкам и фоновым пробам), отправляет страницы на самое быстрое
+исправное и при ошибке переходит к следующему. Зеркало, которое несколько раз
+подряд не ответило, на время исключается, пока проба не покажет, что оно ожило """
+import logging
+import threading
+import time
+
+from bandwidth import BACKGROUND, traffic
+from http_client import NO_COMPRESSION
+from metrics import default_metrics
+from request_policy import default_policy
+
+logger = logging.getLogger(__name__)
+
+# Вес нового замера в скользящих средних
+EWMA_ALPHA = 0.3
+# Типичный размер страницы до первых замеров, байт
+DEFAULT_PAGE_SIZE = 500 * 1024
+# После стольких ошибок подряд зеркало исключается
+FAILURES_TO_DISABLE = 3
+COOLDOWN_BASE = 10.0
+COOLDOWN_MAX = 300.0
+# Как часто проверять зеркала и сколько байт читать при проверке
+PROBE_INTERVAL = 30.0
+PROBE_BYTES = 256 * 1024
+
+
+class HostStats:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.down_until = 0.0
+
+    def is_healthy(self, now):
+        return now >= self.down_until
+
+    def expected_seconds(self, page_size):
+        """ Ожидаемое время загрузки страницы; неизвестное зеркало считается
+        самым быстрым, чтобы на него сразу попали страницы и появился замер """
+        if self.latency is None or not self.throughput:
+            return 0.0
+        return self.latency + page_size / self.throughput
+
+
+def ewma(current, value):
+    return value if current is None else current + EWMA_ALPHA * (value - current)
+
+
+class ImageHostPool:
+    def __init__(self, hosts, policy=None, metrics=None):
+        self.policy = policy or default_policy
+        self.metrics = metrics or default_metrics
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.page_size = DEFAULT_PAGE_SIZE
+        # Путь последней загруженной страницы — по нему зеркала проверяются в фоне
+        self.probe_path = None
+        self.probe_thread = None
+        self.set_hosts(hosts)
+
+    def set_hosts(self, hosts):
+        with self.lock:
+            hosts = [host.rstrip("/") for host in hosts if host]
+            self.stats = {host: self.stats.get(host) or HostStats(host) for host in dict.fromkeys(hosts)}
+
+    @property
+    def hosts(self):
+        with self.lock:
+            return list(self.stats)
+
+    def split(self, url):
+        """ (зеркало, путь), если URL указывает на одно из зеркал, иначе (None, url) """
+        for host in self.hosts:
+            if url.startswith(host + "/"):
+                return host, url[len(host):]
+        return None, url
+
+    def ranked(self):
+        """ Исправные зеркала от быстрого к медленному, затем исключённые — как крайний случай """
+        now = time.monotonic()
+        with self.lock:
+            stats = list(self.stats.values())
+            page_size = self.page_size
+        healthy = sorted((s for s in stats if s.is_healthy(now)), key=lambda s: s.expected_seconds(page_size))
+        disabled = sorted((s for s in stats if not s.is_healthy(now)), key=lambda s: s.down_until)
+        return [s.base_url for s in healthy + disabled]
+
+    def candidates(self, url):
+        """ Адреса страницы на всех зеркалах в порядке предпочтения """
+        host, path = self.split(url)
+        if host is None:
+            return [url]
+        self.start_probing()
+        return [mirror + path for mirror in self.ranked()]
+
+    def report(self, url, ok, latency=None, seconds=None, size=None, probe=False):
+        """ Результат загрузки с зеркала: задержка до ответа, полное время и размер.
+        Пробы читают только начало страницы и не влияют на типичный размер страницы """
+        host, path = self.split(url)
+        if host is None:
+            return
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats is None:
+                return
+            if ok:
+                stats.failures = 0
+                stats.down_until = 0.0
+                if latency is not None:
+                    stats.latency = ewma(stats.latency, latency)
+                if size and seconds and seconds > (latency or 0):
+                    stats.throughput = ewma(stats.throughput, size / (seconds - (latency or 0)))
+                    if not probe:
+                        self.page_size = ewma(self.page_size, size)
+                        self.probe_path = path
+            else:
+                stats.failures += 1
+                if stats.failures >= FAILURES_TO_DISABLE:
+                    cooldown = min(COOLDOWN_MAX, COOLDOWN_BASE * 2 ** (stats.failures - FAILURES_TO_DISABLE))
+                    stats.down_until = time.monotonic() + cooldown
+                    logger.warning("Image host %s disabled for %.0fs after %d failures",
+                                   host, cooldown, stats.failures)
+            expected = stats.expected_seconds(self.page_size)
+        self.metrics.set("image_host_expected_seconds", round(expected, 4), host=host)
+        self.metrics.set("image_host_healthy", int(stats.is_healthy(time.monotonic())), host=host)
+
+    def start_probing(self):
+        with self.lock:
+            if self.probe_thread is not None or len(self.stats) < 2:
+                return
+            self.probe_thread = threading.Thread(target=self.probe_loop, name="image-host-probe", daemon=True)
+        self.probe_thread.start()
+
+    def probe_loop(self):
+        while True:
+            time.sleep(PROBE_INTERVAL)
+            with self.lock:
+                path = self.probe_path
+            if path is None:
+                continue
+            # Пробы — фоновые запросы и не должны останавливать загрузку страниц
+            with traffic(BACKGROUND):
+                for host in self.hosts:
+                    self.probe(host + path)
+
+    def probe(self, url):
+        """ Читает начало страницы и обновляет оценку зеркала """
+        started = time.monotonic()
+        try:
+            with self.policy.stream(url, stream=True,
+                                    headers=dict(NO_COMPRESSION, Range=f"bytes=0-{PROBE_BYTES - 1}")) as response:
+                if response.status_code not in (200, 206):
+                    raise IOError(f"HTTP {response.status_code}")
+                latency = response.elapsed.total_seconds()
+                size = 0
+                for chunk in response.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size >= PROBE_BYTES:
+                        break
+        except Exception as e:
+            logger.debug("Probe of %s failed: %s", url, e)
+            self.report(url, False)
+            return
+        self.report(url, True, latency, time.monotonic() - started, size, probe=True)
@@ -0,0 +1,234 @@
+""" Обработка страниц после загрузки: определение настоящего формата по содержимому
+(сервер отдаёт WebP и PNG под именем .jpg), уменьшение и пережатие под устройство,
+оттенки серого и удаление метаданных.
+
+process_image() выполняется в пуле процессов, поэтому модуль не импортирует Qt,
+а Pillow загружается только внутри рабочих процессов. Результат всегда пишется
+во временный файл и переносится через os.replace: исходный файл может быть
+жёсткой ссылкой на объект общего хранилища страниц """
+import hashlib
+import os
+import time
+
+# Расширение файла для каждого распознаваемого формата
+EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "gif": ".gif", "bmp": ".bmp", "avif": ".avif"}
+# Сегменты JPEG, которые нужны для отображения: JFIF (APP0) и Adobe (APP14, цветовое пространство)
+KEPT_JPEG_SEGMENTS = {0xE0, 0xEE}
+# Чанки PNG и WebP с метаданными: текст, EXIF, XMP, ICC и время изменения
+PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"iCCP", b"tIME"}
+WEBP_METADATA_CHUNKS = {b"ICCP", b"EXIF", b"XMP "}
+# Флаги ICC, EXIF и XMP в заголовке VP8X
+WEBP_METADATA_FLAGS = 0x20 | 0x08 | 0x04
+
+
+def detect_format(path):
+    """ Формат изображения по первым байтам файла или None """
+    with open(path, "rb") as f:
+        head = f.read(16)
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"):
+        return "avif"
+    return None
+
+
+def with_extension(path, image_format):
+    extension = EXTENSIONS.get(image_format)
+    if extension is None:
+        return path
+    return os.path.splitext(path)[0] + extension
+
+
+class ImageProfile:
+    """ Параметры обработки. Профиль без параметров только исправляет расширение """
+
+    def __init__(self, label="", max_width=None, max_height=None, quality=None, grayscale=False,
+                 strip_metadata=False):
+        self.label = label
+        self.max_width = max_width
+        self.max_height = max_height
+        self.quality = quality
+        self.grayscale = grayscale
+        self.strip_metadata = strip_metadata
+
+    @property
+    def key(self):
+        """ Строка для manifest.json: по ней видно, обработана ли страница этим профилем """
+        if self.is_identity:
+            return ""
+        return (f"w{self.max_width or 0}h{self.max_height or 0}q{self.quality or 0}"
+                f"g{int(self.grayscale)}m{int(self.strip_metadata)}")
+
+    @property
+    def is_identity(self):
+        return not (self.max_width or self.max_height or self.quality or self.grayscale or self.strip_metadata)
+
+    @property
+    def needs_pixels(self):
+        """ Нужно ли декодировать изображение; иначе метаданные JPEG удаляются без пережатия """
+        return bool(self.max_width or self.max_height or self.quality or self.grayscale)
+
+    def customized(self, max_width=None, max_height=None, quality=None, grayscale=False, strip_metadata=False):
+        """ Копия профиля с переопределёнными параметрами (для ключей командной строки) """
+        return ImageProfile(
+            self.label,
+            max_width or self.max_width,
+            max_height or self.max_height,
+            quality or self.quality,
+            grayscale or self.grayscale,
+            strip_metadata or self.strip_metadata
+        )
+
+
+PROFILES = {
+    "original": ImageProfile("Без обработки"),
+    "compact": ImageProfile("Сжатие (JPEG 80)", quality=80, strip_metadata=True),
+    "tablet": ImageProfile("Планшет (ширина 1600)", max_width=1600, quality=85, strip_metadata=True),
+    # Экран 6" электронных книг (Kindle Paperwhite, Kobo Clara)
+    "ereader": ImageProfile("Электронная книга (1072×1448, ч/б)", max_width=1072, max_height=1448, quality=75,
+                            grayscale=True, strip_metadata=True),
+}
+DEFAULT_PROFILE = "original"
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fix_extension(path):
+    """ Переименовывает файл под настоящий формат; возвращает новый путь """
+    target = with_extension(path, detect_format(path))
+    if target != path:
+        os.replace(path, target)
+    return target
+
+
+def strip_jpeg_metadata(data):
+    """ Удаляет из JPEG EXIF, XMP, ICC и комментарии без пережатия изображения """
+    output = bytearray(data[:2])
+    position = 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        if marker == 0xDA:
+            break
+        length = int.from_bytes(data[position + 2:position + 4], "big")
+        segment = data[position:position + 2 + length]
+        if not (0xE0 <= marker <= 0xEF or marker == 0xFE) or marker in KEPT_JPEG_SEGMENTS:
+            output += segment
+        position += 2 + length
+    output += data[position:]
+    return bytes(output)
+
+
+def strip_png_metadata(data):
+    """ Удаляет из PNG текстовые чанки, EXIF, ICC и время без пережатия изображения """
+    output = bytearray(data[:8])
+    position = 8
+    while position + 12 <= len(data):
+        length = int.from_bytes(data[position:position + 4], "big")
+        chunk_type = data[position + 4:position + 8]
+        end = position + 12 + length
+        if chunk_type not in PNG_METADATA_CHUNKS:
+            output += data[position:end]
+        position = end
+        if chunk_type == b"IEND":
+            break
+    return bytes(output)
+
+
+def strip_webp_metadata(data):
+    """ Удаляет из WebP EXIF, XMP и ICC без пережатия изображения """
+    output = bytearray(data[:12])
+    position = 12
+    while position + 8 <= len(data):
+        chunk_type = data[position:position + 4]
+        length = int.from_bytes(data[position + 4:position + 8], "little")
+        end = position + 8 + length + (length & 1)
+        chunk = bytearray(data[position:end])
+        if chunk_type == b"VP8X" and len(chunk) > 8:
+            chunk[8] &= ~WEBP_METADATA_FLAGS & 0xFF
+        if chunk_type not in WEBP_METADATA_CHUNKS:
+            output += chunk
+        position = end
+    output[4:8] = (len(output) - 8).to_bytes(4, "little")
+    return bytes(output)
+
+
+# Форматы, из которых метаданные удаляются без декодирования; остальные (GIF, BMP, AVIF) не меняются
+METADATA_STRIPPERS = {"jpeg": strip_jpeg_metadata, "png": strip_png_metadata, "webp": strip_webp_metadata}
+
+
+def flatten_alpha(image):
+    """ Прозрачность накладывается на белый фон страницы: convert("RGB") сделал бы её чёрной """
+    from PIL import Image
+
+    if image.mode not in ("RGBA", "LA", "PA", "RGBa", "La") and not (
+            image.mode == "P" and "transparency" in image.info):
+        return image
+    mode = "L" if image.mode in ("LA", "La") else "RGB"
+    rgba = image.convert("RGBA")
+    background = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+    return Image.alpha_composite(background, rgba).convert(mode)
+
+
+def process_image(path, profile):
+    """ Обрабатывает страницу профилем; возвращает (новый путь, размер, SHA-256, секунд).
+    Выполняется в отдельном процессе """
+    started = time.perf_counter()
+    image_format = detect_format(path)
+    if not profile.needs_pixels:
+        # Только удаление метаданных: формат и пиксели страницы остаются прежними
+        target = with_extension(path, image_format)
+        strip = METADATA_STRIPPERS.get(image_format)
+        with open(path, "rb") as f:
+            data = strip(f.read()) if strip is not None else f.read()
+        write_replacing(path, target, data)
+        return target, len(data), hashlib.sha256(data).hexdigest(), time.perf_counter() - started
+
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.load()
+        image = flatten_alpha(image)
+        if profile.grayscale:
+            image = image.convert("L")
+        elif image.mode not in ("L", "RGB"):
+            image = image.convert("L" if image.mode in ("1", "LA", "I", "I;16", "F") else "RGB")
+        max_width = profile.max_width or image.width
+        max_height = profile.max_height or image.height
+        if image.width > max_width or image.height > max_height:
+            # thumbnail() сохраняет пропорции и не увеличивает изображение
+            image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+
+        # Без quality страница не пережималась бы, но декодирование уже нужно — берём высокое качество
+        target = os.path.splitext(path)[0] + EXTENSIONS["jpeg"]
+        tmp_path = target + ".processing"
+        image.save(tmp_path, "JPEG", quality=profile.quality or 95, optimize=True)
+    move_replacing(path, target, tmp_path)
+    return target, os.path.getsize(target), file_digest(target), time.perf_counter() - started
+
+
+def write_replacing(source, target, data):
+    tmp_path = target + ".processing"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    move_replacing(source, target, tmp_path)
+
+
+def move_replacing(source, target, tmp_path):
+    """ Переносит tmp_path в target и удаляет source, если имя файла изменилось """
+    os.replace(tmp_path, target)
+    if source != target and os.path.exists(source):
+        os.remove(source)
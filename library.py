@@ -0,0 +1,195 @@
+""" Локальная библиотека в SQLite: какие тайтлы и главы уже скачаны, сколько в них
+страниц и закончена ли загрузка. Тайтлы из списка отслеживаемых синхронизируются
+одним запросом списка глав: в очередь попадают только новые и недокачанные главы """
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from bandwidth import BACKGROUND, traffic
+from core import ChapterManifest, chapter_dir, get_chapters
+
+logger = logging.getLogger(__name__)
+
+# Состояния главы
+NEW = "new"
+COMPLETE = "complete"
+INCOMPLETE = "incomplete"
+
+
+def default_data_dir():
+    """ Библиотека — не кэш: хранится там, где её не удалят вместе с кэшем """
+    if os.environ.get("MANGALIB_DATA_DIR"):
+        return os.environ["MANGALIB_DATA_DIR"]
+    if os.name == "nt":
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "mangalib_downloader")
+
+
+class LibraryIndex:
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_data_dir(), "library.sqlite3")
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS titles ("
+                " slug_url TEXT PRIMARY KEY, name TEXT, save_directory TEXT, watched INTEGER DEFAULT 0,"
+                " added_at REAL, synced_at REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chapters ("
+                " slug_url TEXT, volume TEXT, number TEXT, name TEXT, pages INTEGER, state TEXT,"
+                " save_dir TEXT, updated_at REAL, PRIMARY KEY (slug_url, volume, number))"
+            )
+            connection.commit()
+            self.connection = connection
+        return self.connection
+
+    def execute(self, sql, params=(), many=False):
+        with self.lock:
+            connection = self.connect()
+            if many:
+                cursor = connection.executemany(sql, params)
+            else:
+                cursor = connection.execute(sql, params)
+            rows = cursor.fetchall()
+            connection.commit()
+        return rows
+
+    def add_title(self, slug_url, save_directory, name="", watched=True):
+        self.execute(
+            "INSERT INTO titles (slug_url, name, save_directory, watched, added_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(slug_url) DO UPDATE SET save_directory = excluded.save_directory,"
+            " watched = MAX(titles.watched, excluded.watched), name = COALESCE(NULLIF(excluded.name, ''), titles.name)",
+            (slug_url, name, save_directory, int(watched), time.time())
+        )
+
+    def unwatch(self, slug_url):
+        with self.lock:
+            connection = self.connect()
+            changed = connection.execute("UPDATE titles SET watched = 0 WHERE slug_url = ?", (slug_url,)).rowcount
+            connection.commit()
+        return bool(changed)
+
+    def titles(self, watched_only=False):
+        sql = ("SELECT t.*, COUNT(c.number) AS chapters, SUM(c.state = ?) AS complete"
+               " FROM titles t LEFT JOIN chapters c ON c.slug_url = t.slug_url")
+        if watched_only:
+            sql += " WHERE t.watched = 1"
+        sql += " GROUP BY t.slug_url ORDER BY t.slug_url"
+        return [dict(row) for row in self.execute(sql, (COMPLETE,))]
+
+    def chapters(self, slug_url):
+        rows = self.execute("SELECT * FROM chapters WHERE slug_url = ?", (slug_url,))
+        return {(row["volume"], row["number"]): dict(row) for row in rows}
+
+    def record_chapter(self, slug_url, volume, number, state, pages=None, save_dir="", save_directory=""):
+        """ Вызывается очередью загрузки после каждой главы """
+        now = time.time()
+        if save_directory:
+            self.execute(
+                "INSERT INTO titles (slug_url, name, save_directory, watched, added_at) VALUES (?, '', ?, 0, ?)"
+                " ON CONFLICT(slug_url) DO NOTHING",
+                (slug_url, save_directory, now)
+            )
+        self.execute(
+            "INSERT INTO chapters (slug_url, volume, number, name, pages, state, save_dir, updated_at)"
+            " VALUES (?, ?, ?, '', ?, ?, ?, ?)"
+            " ON CONFLICT(slug_url, volume, number) DO UPDATE SET state = excluded.state,"
+            " pages = COALESCE(excluded.pages, chapters.pages),"
+            " save_dir = COALESCE(NULLIF(excluded.save_dir, ''), chapters.save_dir), updated_at = excluded.updated_at",
+            (slug_url, str(volume), str(number), pages, state, save_dir, now)
+        )
+
+    def merge_remote(self, slug_url, remote_chapters):
+        """ Добавляет главы из списка API, которых ещё нет в библиотеке, как новые """
+        now = time.time()
+        self.execute(
+            "INSERT INTO chapters (slug_url, volume, number, name, state, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(slug_url, volume, number) DO UPDATE SET name = excluded.name",
+            [(slug_url, str(chapter.get("volume")), str(chapter.get("number")), chapter.get("name") or "", NEW, now)
+             for chapter in remote_chapters],
+            many=True
+        )
+        self.execute("UPDATE titles SET synced_at = ? WHERE slug_url = ?", (now, slug_url))
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+def import_existing(library, slug_url, save_directory, remote_chapters):
+    """ Отмечает готовыми главы, которые уже лежат на диске и собраны целиком
+    (manifest.json с хотя бы одним собранным файлом). Возвращает число таких глав """
+    found = 0
+    known = library.chapters(slug_url)
+    for chapter in remote_chapters:
+        volume, number = str(chapter.get("volume")), str(chapter.get("number"))
+        if known.get((volume, number), {}).get("state") == COMPLETE:
+            continue
+        directory = chapter_dir(save_directory, slug_url, volume, number)
+        manifest_path = os.path.join(directory, ChapterManifest.FILENAME)
+        if not os.path.exists(manifest_path):
+            continue
+        manifest = ChapterManifest(directory)
+        if manifest.built_exports():
+            library.record_chapter(slug_url, volume, number, COMPLETE, len(manifest.data["pages"]), directory)
+            found += 1
+    return found
+
+
+def watch(library, slug_url, save_directory, name=""):
+    """ Добавляет тайтл в отслеживаемые и находит уже скачанные главы """
+    library.add_title(slug_url, save_directory, name, watched=True)
+    remote = get_chapters(slug_url)
+    library.merge_remote(slug_url, remote)
+    return import_existing(library, slug_url, save_directory, remote)
+
+
+def sync_title(library, slug_url, refresh=True):
+    """ Сверяет список глав из API с библиотекой; возвращает [(том, глава)], которые
+    нужно скачать: новые и недокачанные. Список глав проверяется условным
+    запросом (ETag), поэтому для тайтла без изменений это один дешёвый запрос """
+    remote = get_chapters(slug_url, refresh=refresh)
+    library.merge_remote(slug_url, remote)
+    known = library.chapters(slug_url)
+    jobs = []
+    for chapter in remote:
+        key = (str(chapter.get("volume")), str(chapter.get("number")))
+        if known.get(key, {}).get("state") != COMPLETE:
+            jobs.append(key)
+    return jobs
+
+
+def sync_watchlist(library, on_title=None):
+    """ Синхронизирует все отслеживаемые тайтлы; on_title(slug, папка, главы или исключение)
+    вызывается для каждого. Ошибка одного тайтла не останавливает остальные.
+    Запросы списков глав — фоновые и уступают поиску и загрузке выбранных глав """
+    total = 0
+    for title in library.titles(watched_only=True):
+        slug_url = title["slug_url"]
+        try:
+            with traffic(BACKGROUND):
+                jobs = sync_title(library, slug_url)
+        except Exception as e:
+            logger.warning("Sync of %s failed: %s", slug_url, e)
+            if on_title is not None:
+                on_title(slug_url, title["save_directory"], e)
+            continue
+        total += len(jobs)
+        if on_title is not None:
+            on_title(slug_url, title["save_directory"], jobs)
+    return total
@@ -0,0 +1,82 @@
+""" Окно логов, которое не перегружает цикл событий: сообщения из любых потоков
+складываются в ограниченный буфер и по таймеру выводятся одной пачкой """
+import threading
+from collections import deque
+from datetime import datetime
+
+from PyQt6.QtCore import QObject, QTimer
+from PyQt6.QtGui import QTextCharFormat, QTextCursor
+
+# Сколько строк хранит окно логов; старые строки удаляются
+LOG_CAPACITY = 5000
+FLUSH_INTERVAL_MS = 250
+
+
+class LogSink(QObject):
+    """ append() можно вызывать из любого потока. Сообщения типа "page" одной
+    главы, пришедшие за один интервал, сворачиваются в одну строку """
+
+    def __init__(self, view, color_for, capacity=LOG_CAPACITY, flush_interval=FLUSH_INTERVAL_MS, parent=None):
+        super().__init__(parent)
+        self.view = view
+        self.view.setMaximumBlockCount(capacity)
+        self.color_for = color_for
+        self.pending = deque(maxlen=capacity)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.timer = QTimer(self)
+        self.timer.setInterval(flush_interval)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def append(self, message, msg_type="info", group=""):
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append((message, msg_type, group))
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            batch = list(self.pending)
+            self.pending.clear()
+            dropped, self.dropped = self.dropped, 0
+
+        lines = collapse_pages(batch)
+        if dropped:
+            lines.insert(0, (f"[{datetime.now().strftime('%H:%M:%S')}] Пропущено сообщений: {dropped}", "error"))
+
+        scrollbar = self.view.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        cursor = QTextCursor(self.view.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.beginEditBlock()
+        text_format = QTextCharFormat()
+        for text, msg_type in lines:
+            text_format.setForeground(self.color_for(msg_type))
+            cursor.setCharFormat(text_format)
+            cursor.insertText(text + "\n")
+        cursor.endEditBlock()
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+
+
+def collapse_pages(batch):
+    """ Превращает пачку (сообщение, тип, группа) в строки (текст, тип) """
+    lines = []
+    pages = {}  # группа -> (номер строки, число страниц)
+    for message, msg_type, group in batch:
+        if msg_type != "page" or not group:
+            lines.append((message, "success" if msg_type == "page" else msg_type))
+            continue
+        if group not in pages:
+            pages[group] = (len(lines), 1)
+            lines.append((f"{message} — {group}", "success"))
+            continue
+        position, count = pages[group]
+        pages[group] = (position, count + 1)
+        lines[position] = (
+            f"[{datetime.now().strftime('%H:%M:%S')}] {group}: готово страниц: {count + 1}", "success"
+        )
+    return lines
@@ -0,0 +1,166 @@
+""" Дисковый кэш ответов API (поиск, списки глав, списки страниц) в SQLite.
+Свежие записи отдаются без запроса, устаревшие перепроверяются через
+ETag / If-Modified-Since, при превышении размера удаляются давно не использованные """
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+from request_policy import RETRY_EXCEPTIONS, RetryableHTTPError, default_policy
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд ответ считается свежим для каждого вида запросов
+DEFAULT_TTLS = {
+    "search": 10 * 60,
+    "chapters": 30 * 60,
+    "chapter": 24 * 60 * 60,
+}
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Недоступная база или каталог кэша (нет прав, диск только для чтения) — запросы идут мимо кэша
+CACHE_ERRORS = (sqlite3.Error, OSError)
+
+
+def default_cache_dir():
+    if os.environ.get("MANGALIB_CACHE_DIR"):
+        return os.environ["MANGALIB_CACHE_DIR"]
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "mangalib_downloader")
+
+
+def request_key(url, params):
+    if not params:
+        return url
+    return f"{url}?{urlencode(sorted(params.items()), doseq=True)}"
+
+
+class MetadataCache:
+    def __init__(self, path=None, ttls=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path or os.path.join(default_cache_dir(), "metadata.sqlite3")
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        # База открывается при первом запросе, чтобы импорт оставался быстрым
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, endpoint TEXT, body BLOB, etag TEXT, last_modified TEXT,"
+                " fetched_at REAL, accessed_at REAL, size INTEGER)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            self.connection = connection
+        return self.connection
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT body, etag, last_modified, fetched_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+            return row
+
+    def store(self, key, endpoint, body, etag, last_modified):
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, endpoint, body, etag, last_modified, now, now, len(body))
+            )
+            self.evict()
+            connection.commit()
+
+    def touch(self, key):
+        now = time.time()
+        with self.lock:
+            self.connect().execute(
+                "UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?", (now, now, key)
+            )
+            self.connection.commit()
+
+    def evict(self):
+        """ Удаляет давно не использованные записи, пока кэш не станет меньше 90% лимита """
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= target:
+                break
+            stale.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        with self.lock:
+            self.connect().execute("DELETE FROM responses")
+            self.connection.commit()
+
+    def get_json(self, url, params=None, endpoint="api", refresh=False):
+        """ GET-запрос с кэшированием и повторами по правилам request_policy.
+        Поднимает исключение requests, если ответа нет ни в сети, ни в кэше """
+        if not self.enabled:
+            response = default_policy.get(url, params=params)
+            response.raise_for_status()
+            return response.json()
+
+        key = request_key(url, params)
+        try:
+            cached = self.lookup(key)
+        except CACHE_ERRORS:
+            logger.warning("Metadata cache is unavailable", exc_info=True)
+            self.enabled = False
+            return self.get_json(url, params, endpoint)
+
+        ttl = self.ttls.get(endpoint, 0)
+        if cached is not None and not refresh and time.time() - cached[3] < ttl:
+            return json.loads(cached[0])
+
+        headers = {}
+        if cached is not None:
+            if cached[1]:
+                headers["If-None-Match"] = cached[1]
+            if cached[2]:
+                headers["If-Modified-Since"] = cached[2]
+
+        try:
+            response = default_policy.get(url, params=params, headers=headers)
+            if response.status_code == 304 and cached is not None:
+                try:
+                    self.touch(key)
+                except CACHE_ERRORS:
+                    logger.warning("Failed to update metadata cache entry", exc_info=True)
+                return json.loads(cached[0])
+            response.raise_for_status()
+        except RETRY_EXCEPTIONS + (RetryableHTTPError,):
+            # Сеть недоступна — лучше устаревший ответ, чем никакого
+            if cached is not None:
+                logger.debug("Serving stale cache entry for %s", key)
+                return json.loads(cached[0])
+            raise
+
+        data = response.json()
+        try:
+            self.store(key, endpoint, response.content, response.headers.get("ETag"),
+                       response.headers.get("Last-Modified"))
+        except CACHE_ERRORS:
+            logger.warning("Failed to store response in metadata cache", exc_info=True)
+        return data
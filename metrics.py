@@ -0,0 +1,214 @@
+""" Метрики загрузки: гистограммы задержек запросов по хостам, объём и скорость
+скачивания, повторы, ошибки, очередь глав, время сборки и обработки страниц.
+Снимок доступен как JSON (snapshot) и в текстовом формате Prometheus
+(prometheus_text); start_metrics_server() отдаёт оба по HTTP """
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Окно, за которое считается скорость скачивания, секунд
+RATE_WINDOW = 10.0
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """ Оценка квантиля по корзинам (верхняя граница корзины) """
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """ Все методы потокобезопасны. Имена и описания метрик — в DESCRIPTIONS """
+    DESCRIPTIONS = {
+        "request_seconds": ("histogram", "Время до ответа сервера (заголовки), по хостам"),
+        "page_seconds": ("histogram", "Полное время загрузки страницы"),
+        "requests_total": ("counter", "Запросы по хостам и кодам ответа"),
+        "connections_total": ("counter", "Новые соединения по хостам (остальные запросы идут по keep-alive)"),
+        "retries_total": ("counter", "Повторы запросов"),
+        "failures_total": ("counter", "Запросы, завершившиеся ошибкой"),
+        "bytes_total": ("counter", "Скачано байт"),
+        "pages_total": ("counter", "Страниц сохранено (source: network, store, manifest)"),
+        "chapters_total": ("counter", "Глав завершено (result: ok, failed)"),
+        "export_seconds": ("histogram", "Время сборки главы по форматам"),
+        "processing_seconds": ("histogram", "Время обработки одной страницы"),
+        "queue_pending": ("gauge", "Глав в очереди"),
+        "queue_running": ("gauge", "Глав загружается"),
+        "progress_pages_done": ("gauge", "Страниц готово в текущей очереди"),
+        "progress_pages_total": ("gauge", "Страниц всего в текущей очереди (с оценкой для глав в ожидании)"),
+        "progress_eta_seconds": ("gauge", "Оценка оставшегося времени"),
+        "bytes_per_second": ("gauge", "Скорость скачивания за последние секунды"),
+        "bandwidth_wait_seconds": ("histogram", "Ожидание блока в планировщике скорости, по классам передач"),
+    }
+
+    def __init__(self, prefix="mangalib_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # [секунда, байт за неё] за последние RATE_WINDOW секунд
+        self.recent_bytes = deque()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[label_key(labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = label_key(labels)
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def prune_bytes(self, now):
+        """ Убирает секунды старше RATE_WINDOW. Вызывается под self.lock """
+        while self.recent_bytes and self.recent_bytes[0][0] < now - RATE_WINDOW:
+            self.recent_bytes.popleft()
+
+    def add_bytes(self, host, count):
+        now = time.monotonic()
+        self.inc("bytes_total", count, host=host)
+        second = int(now)
+        with self.lock:
+            # Байты складываются по секундам: очередь не длиннее RATE_WINDOW записей,
+            # даже если bytes_per_second никто не вызывает
+            if self.recent_bytes and self.recent_bytes[-1][0] == second:
+                self.recent_bytes[-1][1] += count
+            else:
+                self.recent_bytes.append([second, count])
+            self.prune_bytes(now)
+
+    def bytes_per_second(self):
+        now = time.monotonic()
+        with self.lock:
+            self.prune_bytes(now)
+            total = sum(count for _, count in self.recent_bytes)
+        return total / RATE_WINDOW
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.recent_bytes.clear()
+
+    def snapshot(self):
+        """ Все метрики в виде словаря, пригодного для json.dumps """
+        self.set("bytes_per_second", round(self.bytes_per_second(), 1))
+        with self.lock:
+            result = {"time": time.time(), "counters": {}, "gauges": {}, "histograms": {}}
+            for name, series in self.counters.items():
+                result["counters"][name] = [dict(key, value=value) for key, value in series.items()]
+            for name, series in self.gauges.items():
+                result["gauges"][name] = [dict(key, value=value) for key, value in series.items()]
+            for name, series in self.histograms.items():
+                result["histograms"][name] = [
+                    dict(key, count=histogram.count, sum=round(histogram.sum, 6),
+                         p50=histogram.quantile(0.5), p95=histogram.quantile(0.95),
+                         buckets={str(bound): total for bound, total in histogram.cumulative()})
+                    for key, histogram in series.items()
+                ]
+        return result
+
+    def prometheus_text(self):
+        self.set("bytes_per_second", round(self.bytes_per_second(), 1))
+        lines = []
+        with self.lock:
+            for kind, store in (("counter", self.counters), ("gauge", self.gauges), ("histogram", self.histograms)):
+                for name, series in sorted(store.items()):
+                    full_name = self.prefix + name
+                    lines.append(f"# HELP {full_name} {self.DESCRIPTIONS.get(name, (kind, name))[1]}")
+                    lines.append(f"# TYPE {full_name} {kind}")
+                    for key, value in sorted(series.items()):
+                        if kind != "histogram":
+                            lines.append(f"{full_name}{format_labels(key)} {value}")
+                            continue
+                        for bound, total in value.cumulative():
+                            lines.append(f"{full_name}_bucket{format_labels(key, [('le', bound)])} {total}")
+                        lines.append(f"{full_name}_bucket{format_labels(key, [('le', '+Inf')])} {value.count}")
+                        lines.append(f"{full_name}_sum{format_labels(key)} {value.sum}")
+                        lines.append(f"{full_name}_count{format_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode()
+            content_type = "application/json"
+        elif self.path.startswith("/metrics"):
+            body = metrics.prometheus_text().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port, host="127.0.0.1", metrics=None):
+    """ /metrics — формат Prometheus, /metrics.json — снимок JSON. Сервер работает в фоновом потоке """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics or default_metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Общие метрики приложения
+default_metrics = Metrics()
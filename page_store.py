@@ -0,0 +1,138 @@
+""" Общее хранилище страниц по SHA-256 содержимого. Одинаковые страницы (титры,
+реклама, обложки) хранятся на диске один раз, а в папки глав попадают жёсткими
+ссылками (или reflink/копией, если файловая система не поддерживает ссылки).
+
+Файлы в папках глав нельзя изменять на месте — только заменять через os.replace,
+иначе вместе с ними изменится и общий объект. Страница, обработанная профилем
+(image_processing), заменяет ссылку на исходный объект новым файлом, поэтому
+результат обработки тоже кладётся в хранилище — отдельно для каждого профиля """
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+STORE_DIRNAME = ".pages"
+# ioctl FICLONE для reflink на Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def reflink(source, destination):
+    import fcntl
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+class PageStore:
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(root, "index.sqlite3"), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT)")
+        # Страницы после обработки: (URL, ключ профиля) -> SHA-256 результата
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed (url TEXT, profile TEXT, sha256 TEXT, PRIMARY KEY (url, profile))")
+        self.connection.commit()
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def lookup_url(self, url, profile=""):
+        """ SHA-256 страницы (с profile — обработанной этим профилем), если она уже есть в хранилище """
+        with self.lock:
+            if profile:
+                row = self.connection.execute(
+                    "SELECT sha256 FROM processed WHERE url = ? AND profile = ?", (url, profile)).fetchone()
+            else:
+                row = self.connection.execute("SELECT sha256 FROM urls WHERE url = ?", (url,)).fetchone()
+        if row is not None and os.path.exists(self.object_path(row[0])):
+            return row[0]
+        return None
+
+    def remember_url(self, url, sha256, profile=""):
+        with self.lock:
+            if profile:
+                self.connection.execute("INSERT OR REPLACE INTO processed VALUES (?, ?, ?)", (url, profile, sha256))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, sha256))
+            self.connection.commit()
+
+    def link(self, sha256, destination):
+        """ Кладёт объект в destination; возвращает размер или None, если объекта нет """
+        source = self.object_path(sha256)
+        if not os.path.exists(source):
+            return None
+        tmp_path = destination + ".link"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            try:
+                reflink(source, tmp_path)
+            except (OSError, ImportError):
+                shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+        return os.path.getsize(destination)
+
+    def add(self, path, sha256, url=None, profile=""):
+        """ Добавляет скачанный (с profile — обработанный) файл в хранилище. Если такой
+        объект уже есть, файл заменяется ссылкой на него, иначе файл сам становится объектом """
+        object_path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path):
+            self.link(sha256, path)
+        else:
+            try:
+                os.link(path, object_path)
+            except FileExistsError:
+                self.link(sha256, path)
+            except OSError:
+                # Без жёстких ссылок учёт ссылок для gc() невозможен — объект не создаём
+                logger.debug("Hard links are not supported for %s", self.objects_dir)
+                return
+        if url:
+            self.remember_url(url, sha256, profile)
+
+    def gc(self):
+        """ Удаляет объекты, на которые не ссылается ни одна папка главы.
+        Работает по числу жёстких ссылок: у объекта без ссылок из глав оно равно 1.
+        Возвращает (число объектов, освобождено байт) """
+        removed = 0
+        freed = 0
+        for prefix in os.scandir(self.objects_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                # os.stat, а не entry.stat(): на Windows scandir не заполняет st_nlink
+                stat = os.stat(entry.path)
+                if stat.st_nlink > 1:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+                freed += stat.st_size
+        with self.lock:
+            known = self.connection.execute("SELECT url, sha256 FROM urls").fetchall()
+            missing = [(url,) for url, sha256 in known if not os.path.exists(self.object_path(sha256))]
+            self.connection.executemany("DELETE FROM urls WHERE url = ?", missing)
+            known = self.connection.execute("SELECT url, profile, sha256 FROM processed").fetchall()
+            missing = [(url, profile) for url, profile, sha256 in known
+                       if not os.path.exists(self.object_path(sha256))]
+            self.connection.executemany("DELETE FROM processed WHERE url = ? AND profile = ?", missing)
+            self.connection.commit()
+        return removed, freed
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def store_for(save_directory):
+    """ Хранилище по умолчанию: в папке сохранения, чтобы жёсткие ссылки работали """
+    return PageStore(os.path.join(save_directory, STORE_DIRNAME))
@@ -0,0 +1,78 @@
+""" Запись скачиваемых страниц на диск. Страница пишется в .part-файл крупными
+блоками (размер блока зависит от Content-Length) и растёт только по мере записи:
+после сбоя его размер — это число полученных байт, с которого докачка запрашивает
+Range. Под окончательным именем файл появляется только целиком — через os.replace.
+Политика fsync определяет, насколько запись переживает сбой питания:
+
+    none — полагаться на кэш ОС (быстрее всего, по умолчанию)
+    file — fsync каждого файла перед переименованием
+    full — ещё и fsync папки после переименования, чтобы само имя попало на диск """
+import os
+
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_FULL = "full"
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_FULL)
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+def chunk_size_for(length):
+    """ Примерно четверть страницы, но не меньше 64 КБ и не больше 1 МБ:
+    мелкие блоки — лишние вызовы Python, слишком крупные — хуже отклик на отмену """
+    if not length:
+        return MIN_CHUNK_SIZE
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, length // 4))
+
+
+class PartWriter:
+    """ Запись .part-файла с позиции offset. Если запись не дошла до конца, файл
+    обрезается по записанным данным, и следующая попытка докачивает с этого места """
+
+    def __init__(self, path, offset=0, total=None, fsync=FSYNC_NONE):
+        self.path = path
+        self.offset = offset
+        self.total = total
+        self.fsync = fsync
+        self.written = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "r+b" if self.offset else "wb")
+        self.file.seek(self.offset)
+        return self
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.written += len(chunk)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = self.offset + self.written
+        try:
+            if exc_type is not None or (self.total and end != self.total):
+                self.file.truncate(end)
+            elif self.fsync != FSYNC_NONE:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+        return False
+
+
+def fsync_directory(path):
+    """ На Windows папку открыть нельзя — там переименование и так журналируется NTFS """
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit(part_path, target, fsync=FSYNC_NONE):
+    """ Атомарно переносит готовый .part-файл под окончательное имя """
+    os.replace(part_path, target)
+    if fsync == FSYNC_FULL:
+        fsync_directory(os.path.dirname(os.path.abspath(target)))
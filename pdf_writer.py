@@ -0,0 +1,171 @@
+""" PDF из готовых страниц без загрузки всей главы в память. JPEG с маркерами
+SOF0–SOF2 (baseline, extended, progressive) встраиваются как есть через DCTDecode:
+размеры и число компонент читаются из заголовка, без декодирования. Остальные JPEG
+(lossless, арифметические, CMYK) и другие форматы перекодируются в JPEG через Pillow.
+Страницы пишутся по одной во временный файл, под итоговым именем PDF появляется целиком """
+import io
+import os
+import shutil
+
+# Маркеры SOF, которые читатели PDF декодируют в DCTDecode: baseline, extended и progressive
+# с кодами Хаффмана. Lossless, иерархические и арифметические JPEG перекодируются
+SOF_MARKERS = {0xC0, 0xC1, 0xC2}
+# Остальные SOF (0xC0-0xCF, кроме DHT, JPG и DAC)
+OTHER_SOF_MARKERS = {0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+COLOR_SPACES = {1: "/DeviceGray", 3: "/DeviceRGB"}
+# Качество JPEG для страниц, которые приходится перекодировать (PNG, WebP и т.п.)
+CONVERT_QUALITY = 90
+
+
+def read_jpeg_info(path):
+    """ Возвращает (ширина, высота, число компонент) JPEG-файла, читая только заголовки.
+    Для не-JPEG и JPEG, которые нельзя встроить как есть, возвращает None """
+    with open(path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            byte = f.read(1)
+            while byte and byte != b"\xff":
+                byte = f.read(1)
+            while byte == b"\xff":
+                byte = f.read(1)
+            if not byte:
+                return None
+            marker = byte[0]
+            if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+                continue
+            if marker in (0xD9, 0xDA) or marker in OTHER_SOF_MARKERS:
+                return None
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = int.from_bytes(length_bytes, "big")
+            if marker in SOF_MARKERS:
+                header = f.read(6)
+                if len(header) < 6:
+                    return None
+                precision = header[0]
+                height = int.from_bytes(header[1:3], "big")
+                width = int.from_bytes(header[3:5], "big")
+                components = header[5]
+                # 12-битные и CMYK JPEG читатели PDF отображают по-разному — их перекодируем
+                if precision != 8 or components not in COLOR_SPACES or not width or not height:
+                    return None
+                return width, height, components
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+class StreamingPdfWriter:
+    """ Пишет PDF постранично: каждая страница сразу уходит в файл, в памяти
+    остаются только смещения объектов. JPEG встраиваются без перекодирования
+    (DCTDecode), остальные форматы конвертируются в JPEG через Pillow.
+    Файл появляется под итоговым именем только после close() """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.tmp_path = output_path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.offsets = {}
+        self.page_ids = []
+        # 1 — каталог, 2 — дерево страниц; их содержимое пишется в close()
+        self.next_id = 3
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.file.write(data)
+
+    def reserve_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def begin_object(self, obj_id):
+        self.offsets[obj_id] = self.file.tell()
+        self.write(f"{obj_id} 0 obj\n".encode())
+
+    def write_object(self, obj_id, body):
+        self.begin_object(obj_id)
+        self.write(body.encode() + b"\nendobj\n")
+
+    def add_image(self, path):
+        info = read_jpeg_info(path)
+        if info is not None:
+            width, height, components = info
+            self.add_jpeg_stream(width, height, components, os.path.getsize(path), path)
+            return
+
+        # Pillow нужен только для перекодирования, JPEG встраиваются без него
+        from PIL import Image
+
+        with Image.open(path) as image:
+            if image.mode not in ("L", "RGB"):
+                image = image.convert("L" if image.mode in ("1", "LA", "I", "I;16", "F") else "RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=CONVERT_QUALITY)
+            width, height = image.size
+            components = 1 if image.mode == "L" else 3
+        self.add_jpeg_stream(width, height, components, buffer.tell(), buffer)
+
+    def add_jpeg_stream(self, width, height, components, length, source):
+        image_id = self.reserve_id()
+        self.begin_object(image_id)
+        self.write(
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace {COLOR_SPACES[components]} /BitsPerComponent 8 "
+            f"/Filter /DCTDecode /Length {length} >>\nstream\n".encode()
+        )
+        if isinstance(source, io.BytesIO):
+            self.write(source.getbuffer())
+        else:
+            with open(source, "rb") as image_file:
+                shutil.copyfileobj(image_file, self.file, 1024 * 1024)
+        self.write(b"\nendstream\nendobj\n")
+
+        # Страница размером с изображение при 72 dpi, как делал Pillow
+        content = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode()
+        content_id = self.reserve_id()
+        self.begin_object(content_id)
+        self.write(f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream\nendobj\n")
+
+        page_id = self.reserve_id()
+        self.write_object(
+            page_id,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        )
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = " ".join(f"{page_id} 0 R" for page_id in self.page_ids)
+        self.write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>")
+        self.write_object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_offset = self.file.tell()
+        self.write(f"xref\n0 {self.next_id}\n0000000000 65535 f \n".encode())
+        for obj_id in range(1, self.next_id):
+            self.write(f"{self.offsets[obj_id]:010} 00000 n \n".encode())
+        self.write(
+            f"trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+        )
+        self.file.close()
+        os.replace(self.tmp_path, self.output_path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_pdf(image_paths, output_path):
+    with StreamingPdfWriter(output_path) as writer:
+        for path in image_paths:
+            writer.add_image(path)
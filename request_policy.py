@@ -0,0 +1,269 @@
+""" Общие правила для всех HTTP-запросов: ограничение частоты запросов к хостам
+из HOST_RATES (token bucket), повтор с экспоненциальной задержкой и учётом Retry-After и
+число одновременных запросов к хосту, которое подстраивается под ошибки и
+задержки сервера (AIMD: медленно растёт при успехах, вдвое падает при 429/5xx) """
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+from bandwidth import default_bandwidth
+from http_client import default_client
+from metrics import default_metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+RETRY_EXCEPTIONS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+DEFAULT_MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# Запросов в секунду и размер пачки для хостов. У остальных хостов (серверы
+# изображений) частота не ограничена: от перегрузки их бережёт AIMD по 429/5xx и задержкам
+HOST_RATES = {
+    "api.lib.social": (5.0, 10),
+}
+# Одновременных запросов (и соединений в пуле) к хосту, если их нужно меньше общего
+# max_concurrency: API ограничено 5 запросами в секунду, больше соединений ему не нужно
+HOST_CONNECTIONS = {
+    "api.lib.social": 4,
+}
+DEFAULT_MAX_CONCURRENCY = 8
+# Во сколько раз задержка ответа может превысить лучшую, прежде чем считать хост перегруженным
+LATENCY_TOLERANCE = 3.0
+
+
+class RetryableHTTPError(requests.HTTPError):
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}: {response.url}", response=response)
+        self.retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Забирает токен и возвращает, сколько секунд нужно подождать перед запросом """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveLimit:
+    """ Семафор с меняющимся пределом (AIMD) """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.in_use = 0
+        self.best_latency = None
+        self.condition = threading.Condition()
+
+    def acquire(self, cancel_event=None):
+        with self.condition:
+            while self.in_use >= max(self.minimum, int(self.limit)):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled()
+                self.condition.wait(0.2)
+            self.in_use += 1
+
+    def release(self, ok, latency=None):
+        with self.condition:
+            self.in_use -= 1
+            if not ok:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency is not None:
+                if self.best_latency is None or latency < self.best_latency:
+                    self.best_latency = latency
+                if latency > self.best_latency * LATENCY_TOLERANCE:
+                    self.limit = max(self.minimum, self.limit * 0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / max(self.limit, 1))
+            self.condition.notify_all()
+
+    def set_maximum(self, maximum):
+        with self.condition:
+            self.maximum = maximum
+            self.limit = min(self.limit, maximum)
+            self.condition.notify_all()
+
+
+class HostState:
+    def __init__(self, origin, rate, max_connections, max_concurrency):
+        """ rate — (запросов в секунду, пачка) или None без ограничения частоты;
+        max_connections — свой предел хоста или None """
+        self.origin = origin
+        self.bucket = TokenBucket(*rate) if rate is not None else None
+        self.max_connections = max_connections
+        self.concurrency = AdaptiveLimit(self.connections(max_concurrency))
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def connections(self, max_concurrency):
+        return min(max_concurrency, self.max_connections or max_concurrency)
+
+    def block_for(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RequestPolicy:
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, max_concurrency=DEFAULT_MAX_CONCURRENCY, rates=None,
+                 metrics=None, bandwidth=None, client=None, host_connections=None):
+        self.max_retries = max_retries
+        self.metrics = metrics or default_metrics
+        # Распределение скорости между классами передач (bandwidth.py)
+        self.bandwidth = bandwidth or default_bandwidth
+        # Сами запросы выполняет общий клиент с пулами соединений по хостам (http_client.py)
+        self.client = client or default_client
+        self.client.set_pool_size(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.rates = dict(HOST_RATES, **(rates or {}))
+        self.host_connections = dict(HOST_CONNECTIONS, **(host_connections or {}))
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, url):
+        parsed = urlparse(url)
+        name = parsed.netloc
+        with self.lock:
+            state = self.hosts.get(name)
+            if state is not None:
+                return state
+            state = HostState(f"{parsed.scheme}://{name}", self.rates.get(name),
+                              self.host_connections.get(name), self.max_concurrency)
+            self.hosts[name] = state
+        if state.max_connections:
+            self.client.set_pool_size(state.connections(self.max_concurrency), state.origin)
+        return state
+
+    def set_max_concurrency(self, max_concurrency):
+        with self.lock:
+            self.max_concurrency = max_concurrency
+            states = list(self.hosts.values())
+        self.client.set_pool_size(max_concurrency)
+        for state in states:
+            state.concurrency.set_maximum(state.connections(max_concurrency))
+            if state.max_connections:
+                self.client.set_pool_size(state.connections(max_concurrency), state.origin)
+
+    def sleep(self, seconds, cancel_event=None):
+        if seconds <= 0:
+            return
+        if cancel_event is None:
+            time.sleep(seconds)
+        elif cancel_event.wait(seconds):
+            raise RequestCancelled()
+
+    def backoff(self, attempt):
+        # Полный разброс: случайная задержка от 0 до base * 2^attempt
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def call(self, url, func, cancel_event=None):
+        """ Вызывает func() и повторяет его при временных ошибках сети и сервера """
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except RETRY_EXCEPTIONS + (RetryableHTTPError,) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None:
+                    delay = max(delay, min(retry_after, BACKOFF_MAX * 4))
+                    self.host(url).block_for(delay)
+                attempt += 1
+                self.metrics.inc("retries_total", host=urlparse(url).netloc)
+                logger.debug("Retry %d for %s in %.1fs: %s", attempt, url, delay, e)
+                self.sleep(delay, cancel_event)
+
+    @contextmanager
+    def stream(self, url, cancel_event=None, flow=None, **kwargs):
+        """ Один запрос без повторов; слот хоста занят, пока открыт with-блок.
+        Ответы 429/5xx превращаются в RetryableHTTPError. flow — bandwidth.Flow
+        главы, которая сама учитывает прочитанные блоки; без него запрос получает
+        свой Flow, а тело ответа без stream=True учитывается целиком """
+        state = self.host(url)
+        host = urlparse(url).netloc
+        with state.lock:
+            blocked = state.blocked_until - time.monotonic()
+        self.sleep(blocked, cancel_event)
+        state.concurrency.acquire(cancel_event)
+        # Предел снижается только при признаках перегрузки: 429/5xx, обрывы и таймауты
+        ok = True
+        latency = None
+        try:
+            if state.bucket is not None:
+                self.sleep(state.bucket.reserve(), cancel_event)
+            with self.bandwidth.transfer(flow) as transfer:
+                response = self.client.get(url, **kwargs)
+                latency = response.elapsed.total_seconds()
+                self.metrics.observe("request_seconds", latency, host=host)
+                self.metrics.inc("requests_total", host=host, status=response.status_code)
+                if response.status_code in RETRY_STATUSES:
+                    response.close()
+                    raise RetryableHTTPError(response)
+                try:
+                    if flow is None and not kwargs.get("stream"):
+                        transfer.consume(len(response.content), cancel_event)
+                    yield response
+                finally:
+                    response.close()
+        except RETRY_EXCEPTIONS + (RetryableHTTPError,) as e:
+            ok = False
+            latency = None
+            reason = e.response.status_code if isinstance(e, RetryableHTTPError) else type(e).__name__
+            self.metrics.inc("failures_total", host=host, reason=reason)
+            raise
+        finally:
+            state.concurrency.release(ok, latency)
+
+    def get(self, url, cancel_event=None, **kwargs):
+        """ GET с повторами; тело ответа читается целиком """
+        def attempt():
+            with self.stream(url, cancel_event=cancel_event, **kwargs) as response:
+                response.content
+                return response
+
+        return self.call(url, attempt, cancel_event)
+
+
+# Общие правила для всех запросов приложения
+default_policy = RequestPolicy()
@@ -0,0 +1,220 @@
+""" Модель результатов поиска для QTableView: страницы API подгружаются по мере
+прокрутки, обложки рисует делегат и запрашивает только для видимых строк.
+Недавние ответы хранятся в памяти (LRU), поэтому возврат к предыдущему запросу
+при наборе текста не обращается к API """
+import logging
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QThread, QAbstractTableModel, QModelIndex, QRect, QSize, pyqtSignal
+from PyQt6.QtGui import QColor
+from PyQt6.QtWidgets import QStyle, QStyledItemDelegate
+
+from core import search_manga
+
+logger = logging.getLogger(__name__)
+
+COVER_COLUMN = 0
+SLUG_COLUMN = 4
+ROW_HEIGHT = 160
+COVER_URL_ROLE = Qt.ItemDataRole.UserRole + 1
+# Сколько страниц результатов (запрос, номер страницы) хранится в памяти
+SEARCH_CACHE_SIZE = 64
+
+
+class MangaSearchThread(QThread):
+    # поколение, запрос, страница, результаты или None при ошибке
+    search_complete = pyqtSignal(int, str, int, object)
+
+    def __init__(self, search_query, page=1, generation=0):
+        super().__init__()
+        self.search_query = search_query
+        self.page = page
+        self.generation = generation
+
+    def run(self):
+        try:
+            results = search_manga(self.search_query, page=self.page)
+        except Exception as e:
+            logger.error(f"Search error: {str(e)}")
+            results = None
+        self.search_complete.emit(self.generation, self.search_query, self.page, results)
+
+
+def cover_url_of(manga):
+    cover = manga.get('cover')
+    if isinstance(cover, dict):
+        url = cover.get('md') or cover.get('default') or ""
+        if url.startswith(('http://', 'https://')):
+            return url
+    return ""
+
+
+class MangaTableModel(QAbstractTableModel):
+    HEADERS = ["Обложка", "Название", "Тип", "Статус", "Slug URL"]
+    page_loaded = pyqtSignal(int, int)
+    # Номер страницы, которую не удалось загрузить
+    page_failed = pyqtSignal(int)
+
+    def __init__(self, cover_service, parent=None):
+        super().__init__(parent)
+        self.cover_service = cover_service
+        self.cover_service.cover_ready.connect(self.on_cover_ready)
+        self.rows = []
+        self.rows_by_cover = {}  # URL обложки -> строки модели
+        self.query = ""
+        self.page = 0
+        self.has_more = False
+        self.loading = False
+        # Последняя страница не загрузилась
+        self.failed = False
+        # Номер поиска: ответы на предыдущие запросы отбрасываются
+        self.generation = 0
+        self.threads = []
+        # (запрос, страница) -> результаты; и запросы, ответ на которые ещё не пришёл
+        self.cache = OrderedDict()
+        self.in_flight = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        manga = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.UserRole:
+            return manga.get('slug_url')
+        if role == COVER_URL_ROLE:
+            return cover_url_of(manga)
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 1:
+                return manga.get('rus_name') or manga.get('eng_name') or manga.get('name', '')
+            if column == 2:
+                return (manga.get('type') or {}).get('label', 'N/A')
+            if column == 3:
+                return (manga.get('status') or {}).get('label', 'N/A')
+            if column == SLUG_COLUMN:
+                return manga.get('slug_url')
+        return None
+
+    def search(self, query):
+        """ Повторный поиск того же запроса ничего не делает, а после ошибки
+        снова запрашивает страницу, которая не загрузилась """
+        if query == self.query and (self.rows or self.loading):
+            if self.failed:
+                self.fetchMore(QModelIndex())
+            return
+        self.beginResetModel()
+        self.rows = []
+        self.rows_by_cover = {}
+        self.query = query
+        self.page = 0
+        self.has_more = True
+        self.loading = False
+        self.failed = False
+        self.generation += 1
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and bool(self.query) and self.has_more and not self.loading
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self.loading = True
+        self.failed = False
+        key = (self.query, self.page + 1)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.on_page_loaded(self.generation, *key, self.cache[key])
+            return
+        if key in self.in_flight:
+            # Тот же запрос уже выполняется для прежнего поколения — его ответ и будет принят
+            return
+        self.in_flight.add(key)
+        thread = MangaSearchThread(self.query, self.page + 1, self.generation)
+        thread.search_complete.connect(self.on_page_loaded)
+        thread.finished.connect(lambda t=thread: t in self.threads and self.threads.remove(t))
+        self.threads.append(thread)
+        thread.start()
+
+    def remember(self, query, page, manga_list):
+        self.cache[(query, page)] = manga_list
+        self.cache.move_to_end((query, page))
+        while len(self.cache) > SEARCH_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def on_page_loaded(self, generation, query, page, manga_list):
+        self.in_flight.discard((query, page))
+        if manga_list is not None:
+            self.remember(query, page, manga_list)
+        # Ответ устаревшего поколения нужен, только если он совпадает с ожидаемой страницей
+        if not self.loading or (query, page) != (self.query, self.page + 1):
+            return
+        if generation != self.generation:
+            logger.debug("Reusing search response of generation %d for %r", generation, query)
+        self.loading = False
+        if manga_list is None:
+            # Страница и has_more не меняются: прокрутка или повторный поиск запросят её снова
+            self.failed = True
+            self.page_failed.emit(page)
+            return
+        self.page = page
+        if not manga_list:
+            self.has_more = False
+            self.page_loaded.emit(page, len(self.rows))
+            return
+
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(manga_list) - 1)
+        for row, manga in enumerate(manga_list, start=first):
+            self.rows.append(manga)
+            cover_url = cover_url_of(manga)
+            if cover_url:
+                self.rows_by_cover.setdefault(cover_url, []).append(row)
+        self.endInsertRows()
+        self.page_loaded.emit(page, len(self.rows))
+
+    def on_cover_ready(self, cover_url, pixmap):
+        for row in self.rows_by_cover.get(cover_url, []):
+            index = self.index(row, COVER_COLUMN)
+            self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+
+class CoverDelegate(QStyledItemDelegate):
+    """ Рисует обложку прямо в ячейке. Обложка запрашивается при первой отрисовке,
+    поэтому загружаются только обложки строк, которые видны на экране """
+
+    def __init__(self, cover_service, parent=None):
+        super().__init__(parent)
+        self.cover_service = cover_service
+
+    def paint(self, painter, option, index):
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        rect = option.rect.adjusted(4, 4, -4, -4)
+        cover_url = index.data(COVER_URL_ROLE)
+        pixmap = self.cover_service.request(cover_url) if cover_url else None
+        if pixmap is None:
+            painter.fillRect(QRect(rect.center().x() - 50, rect.top(), 100, min(150, rect.height())),
+                             QColor(200, 200, 200))
+            return
+        scaled = pixmap
+        if pixmap.width() > rect.width() or pixmap.height() > rect.height():
+            scaled = pixmap.scaled(rect.size(), Qt.AspectRatioMode.KeepAspectRatio,
+                                   Qt.TransformationMode.SmoothTransformation)
+        x = rect.left() + (rect.width() - scaled.width()) // 2
+        y = rect.top() + (rect.height() - scaled.height()) // 2
+        painter.drawPixmap(x, y, scaled)
+
+    def sizeHint(self, option, index):
+        return QSize(120, ROW_HEIGHT)
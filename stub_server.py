@@ -0,0 +1,213 @@
+""" Локальная замена api.lib.social и img2.imglib.info для замеров и отладки.
+Отдаёт синтетические ответы поиска, списка глав и списка страниц, а также
+изображения страниц и обложек с настраиваемыми задержкой, скоростью, долей
+ошибок и размером страниц.
+
+    python stub_server.py --port 8765 --latency 0.05 --bandwidth 2048 --error-rate 0.02
+    MANGALIB_API_URL=http://127.0.0.1:8765/api/manga MANGALIB_IMAGE_URL=http://127.0.0.1:8765 python app.py
+"""
+import argparse
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Размер блока, которым тело ответа отдаётся при ограничении скорости
+WRITE_CHUNK = 16 * 1024
+# Максимальная длина данных одного сегмента комментария JPEG
+COMMENT_LIMIT = 65533
+
+
+class StubConfig:
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=0, error_rate=0.0, page_size=300 * 1024,
+                 pages=20, volumes=2, chapters=10, search_pages=3, search_page_size=20):
+        self.latency = latency
+        self.jitter = jitter
+        # Байт в секунду на соединение; 0 — без ограничения
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.pages = pages
+        self.volumes = volumes
+        self.chapters = chapters
+        self.search_pages = search_pages
+        self.search_page_size = search_page_size
+
+
+def make_jpeg(width, height, color):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def pad_jpeg(jpeg, size, tag):
+    """ Доводит JPEG до size байт сегментами комментария (COM) сразу после SOI.
+    tag делает каждую страницу уникальной, чтобы одинаковые страницы не склеивались """
+    data = tag.encode()
+    data += b"\0" * max(0, size - len(jpeg) - len(data))
+    segments = [
+        b"\xff\xfe" + (len(chunk) + 2).to_bytes(2, "big") + chunk
+        for chunk in (data[start:start + COMMENT_LIMIT] for start in range(0, len(data), COMMENT_LIMIT))
+    ]
+    return jpeg[:2] + b"".join(segments) + jpeg[2:]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def do_GET(self):
+        self.server.count_request()
+        config = self.config
+        time.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+        if config.error_rate and random.random() < config.error_rate:
+            self.send_body(b"", "text/plain", status=random.choice((429, 503)), extra={"Retry-After": "0"})
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip("/")
+        match = re.fullmatch(r"/api/manga/([^/]+)/(chapters|chapter)", path)
+        if path == "/api/manga":
+            self.send_json(self.search(query))
+        elif match and match.group(2) == "chapters":
+            self.send_json(self.chapters(match.group(1)))
+        elif match:
+            self.send_json(self.chapter(match.group(1), query))
+        elif path.startswith("/manga/"):
+            self.send_body(pad_jpeg(self.server.page_jpeg, config.page_size, path), "image/jpeg")
+        elif path.startswith("/covers/"):
+            self.send_body(self.server.cover_jpeg, "image/jpeg")
+        else:
+            self.send_body(b"Not found", "text/plain", status=404)
+
+    def search(self, query):
+        config = self.config
+        page = int((query.get("page") or ["1"])[0])
+        if page > config.search_pages:
+            return {"data": []}
+        text = (query.get("q") or [""])[0]
+        base = f"http://{self.headers.get('Host')}"
+        data = []
+        for i in range(config.search_page_size):
+            number = (page - 1) * config.search_page_size + i + 1
+            data.append({
+                "slug_url": f"{number}--stub-{number}",
+                "rus_name": f"{text} {number}",
+                "name": f"Stub {number}",
+                "type": {"label": "Манга"},
+                "status": {"label": "Онгоинг"},
+                "cover": {"default": f"{base}/covers/{number}.jpg"},
+            })
+        return {"data": data}
+
+    def chapters(self, slug):
+        config = self.config
+        return {"data": [
+            {"volume": str(volume), "number": str(number), "name": f"Глава {number}"}
+            for volume in range(1, config.volumes + 1)
+            for number in range((volume - 1) * config.chapters + 1, volume * config.chapters + 1)
+        ]}
+
+    def chapter(self, slug, query):
+        volume = (query.get("volume") or ["1"])[0]
+        number = (query.get("number") or ["1"])[0]
+        return {"data": {"pages": [
+            {"url": f"//manga/{slug}/{volume}/{number}/{page:03}.jpg"}
+            for page in range(1, self.config.pages + 1)
+        ]}}
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data, ensure_ascii=False).encode(), "application/json")
+
+    def send_body(self, body, content_type, status=200, extra=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        bandwidth = self.config.bandwidth
+        try:
+            if not bandwidth:
+                self.wfile.write(body)
+                return
+            for start in range(0, len(body), WRITE_CHUNK):
+                chunk = body[start:start + WRITE_CHUNK]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config, host="127.0.0.1", port=0):
+        super().__init__((host, port), StubHandler)
+        self.config = config
+        self.page_jpeg = make_jpeg(800, 1200, (240, 240, 240))
+        self.cover_jpeg = make_jpeg(200, 300, (120, 160, 200))
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(config, host="127.0.0.1", port=0):
+    """ Запускает сервер в фоновом потоке; остановка — server.shutdown() """
+    server = StubServer(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный сервер, имитирующий API mangalib и сервер изображений")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунд")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайный разброс задержки, секунд")
+    parser.add_argument("--bandwidth", type=int, default=0, help="КБ/с на соединение; 0 — без ограничения")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429/503 (0-1)")
+    parser.add_argument("--page-size", type=int, default=300, help="размер страницы, КБ")
+    parser.add_argument("--pages", type=int, default=20, help="страниц в главе")
+    parser.add_argument("--volumes", type=int, default=2)
+    parser.add_argument("--chapters", type=int, default=10, help="глав в томе")
+    args = parser.parse_args(argv)
+
+    config = StubConfig(
+        latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth * 1024, error_rate=args.error_rate,
+        page_size=args.page_size * 1024, pages=args.pages, volumes=args.volumes, chapters=args.chapters
+    )
+    server = StubServer(config, args.host, args.port)
+    print(f"API: {server.base_url}/api/manga")
+    print(f"Изображения: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+""" Проверка сборки мусора в общем хранилище страниц (page_store) для глав,
+страницы которых обработаны профилем. Запуск: python -m pytest test_page_store.py """
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from image_processing import PROFILES, process_image
+from page_store import store_for
+
+URL = "https://img.example/manga/title/chapter/001.png"
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ProcessedPagesGcTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = store_for(self.directory)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def download_processed(self, chapter, profile):
+        """ Как ChapterDownloader: исходная страница в хранилище, затем обработка и результат в хранилище """
+        chapter_dir = os.path.join(self.directory, chapter)
+        os.makedirs(chapter_dir)
+        path = os.path.join(chapter_dir, "001.png")
+        sha256 = self.store.lookup_url(URL)
+        if sha256 is None:
+            Image.new("RGBA", (64, 96), (200, 40, 40, 128)).save(path)
+            self.store.add(path, file_sha256(path), URL)
+        else:
+            self.store.link(sha256, path)
+        path, size, sha256, seconds = process_image(path, profile)
+        self.store.add(path, sha256, URL, profile.key)
+        return path, sha256
+
+    def test_gc_keeps_objects_of_processed_chapters(self):
+        profile = PROFILES["ereader"]
+        first, sha256 = self.download_processed("first", profile)
+        second, _ = self.download_processed("second", profile)
+
+        removed, freed = self.store.gc()
+
+        # Исходный объект больше ни на что не ссылается, обработанный общий для двух глав
+        self.assertEqual(removed, 1)
+        self.assertTrue(os.path.exists(self.store.object_path(sha256)))
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertEqual(self.store.lookup_url(URL, profile.key), sha256)
+        self.assertIsNone(self.store.lookup_url(URL))
+
+    def test_gc_removes_processed_object_without_chapters(self):
+        profile = PROFILES["compact"]
+        path, sha256 = self.download_processed("only", profile)
+        os.remove(path)
+
+        self.store.gc()
+
+        self.assertFalse(os.path.exists(self.store.object_path(sha256)))
+        self.assertIsNone(self.store.lookup_url(URL, profile.key))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,339 @@
+""" Общая очередь для массовой архивации несколькими процессами и машинами.
+Задание раскладывается на главы; глава — единица работы, которую рабочий
+процесс берёт в аренду (lease) на время загрузки и продлевает сердцебиением.
+Если процесс упал или машина пропала, аренда истекает и главу забирает другой
+рабочий. Страницы отдельными единицами не выдаются: внутри главы их докачку
+и проверку уже делает manifest.json, поэтому повторная загрузка главы после
+чужого сбоя скачивает только недостающие страницы.
+
+Очередь — файл SQLite, который может лежать на общем диске рядом с папкой
+сохранения. Для сетевых файловых систем используется обычный журнал, а не WAL
+(WAL требует общей памяти между процессами одной машины). Сроки аренды считаются
+по часам машин, поэтому часы рабочих должны быть синхронизированы (NTP) """
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from bandwidth import BACKGROUND
+from core import DownloadScheduler
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+# Срок аренды и как часто она продлевается, секунд
+DEFAULT_LEASE = 120.0
+HEARTBEAT_FRACTION = 0.25
+# После стольких неудачных попыток глава считается неисправимой
+MAX_ATTEMPTS = 3
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """ Каждый метод — отдельная короткая транзакция; захват глав идёт под
+    BEGIN IMMEDIATE, поэтому две машины не получат одну главу одновременно """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # isolation_level=None — транзакции открываются явно
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, slug_url TEXT, volume TEXT, number TEXT, save_directory TEXT,"
+            " state TEXT, owner TEXT DEFAULT '', lease_until REAL DEFAULT 0, attempts INTEGER DEFAULT 0,"
+            " save_dir TEXT DEFAULT '', error TEXT DEFAULT '', updated_at REAL,"
+            " UNIQUE (slug_url, volume, number, save_directory))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_until)")
+
+    def transaction(self, function):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(self.connection)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        return result
+
+    def submit(self, jobs):
+        """ jobs — [(slug, том, глава, папка)]. Повторная отправка тех же глав ничего
+        не меняет; возвращает число новых глав """
+        now = time.time()
+
+        def insert(connection):
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO units (slug_url, volume, number, save_directory, state, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(slug_url, str(volume), str(number), save_directory, PENDING, now)
+                 for slug_url, volume, number, save_directory in jobs]
+            )
+            return connection.total_changes - before
+        return self.transaction(insert)
+
+    def claim(self, owner, count, lease=DEFAULT_LEASE):
+        """ Берёт в аренду до count глав: свободные и те, чья аренда истекла.
+        Глава, аренда которой истекала уже MAX_ATTEMPTS раз, считается неисправимой """
+        now = time.time()
+
+        def claim(connection):
+            connection.execute(
+                "UPDATE units SET state = ?, error = ?, lease_until = 0, updated_at = ?"
+                " WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, "аренда истекла", now, LEASED, now, MAX_ATTEMPTS)
+            )
+            rows = connection.execute(
+                "SELECT * FROM units WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY id LIMIT ?",
+                (PENDING, LEASED, now, count)
+            ).fetchall()
+            for row in rows:
+                if row["state"] == LEASED:
+                    logger.warning("Lease of %s by %s expired, reclaiming", row["id"], row["owner"])
+                connection.execute(
+                    "UPDATE units SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1,"
+                    " updated_at = ? WHERE id = ?",
+                    (LEASED, owner, now + lease, now, row["id"])
+                )
+            return [dict(row, owner=owner, lease_until=now + lease) for row in rows]
+        return self.transaction(claim)
+
+    def heartbeat(self, owner, unit_ids, lease=DEFAULT_LEASE):
+        """ Продлевает аренду; возвращает id глав, которые всё ещё принадлежат owner """
+        if not unit_ids:
+            return set()
+        now = time.time()
+        marks = ", ".join("?" * len(unit_ids))
+
+        def renew(connection):
+            connection.execute(
+                f"UPDATE units SET lease_until = ?, updated_at = ? WHERE owner = ? AND state = ? AND id IN ({marks})",
+                (now + lease, now, owner, LEASED) + tuple(unit_ids)
+            )
+            rows = connection.execute(
+                f"SELECT id FROM units WHERE owner = ? AND state = ? AND id IN ({marks})",
+                (owner, LEASED) + tuple(unit_ids)
+            ).fetchall()
+            return {row["id"] for row in rows}
+        return self.transaction(renew)
+
+    def complete(self, unit_id, owner, ok, save_dir="", error=""):
+        """ Идемпотентно: готовая глава остаётся готовой, даже если о ней сообщат
+        ещё раз или сообщит рабочий, чья аренда уже истекла (файлы на диске те же).
+        Неудача учитывается, только если глава всё ещё у этого рабочего """
+        now = time.time()
+
+        def finish(connection):
+            if ok:
+                connection.execute(
+                    "UPDATE units SET state = ?, owner = ?, save_dir = ?, error = '', lease_until = 0,"
+                    " updated_at = ? WHERE id = ? AND state != ?",
+                    (DONE, owner, save_dir, now, unit_id, DONE)
+                )
+                return
+            connection.execute(
+                "UPDATE units SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, lease_until = 0,"
+                " updated_at = ? WHERE id = ? AND owner = ? AND state = ?",
+                (MAX_ATTEMPTS, FAILED, PENDING, error, now, unit_id, owner, LEASED)
+            )
+        self.transaction(finish)
+
+    def release(self, owner, unit_ids):
+        """ Возвращает в очередь главы, которые рабочий не успел начать (при остановке) """
+        for unit_id in unit_ids:
+            self.transaction(lambda connection, unit_id=unit_id: connection.execute(
+                "UPDATE units SET state = ?, lease_until = 0, attempts = MAX(attempts - 1, 0)"
+                " WHERE id = ? AND owner = ? AND state = ?", (PENDING, unit_id, owner, LEASED)))
+
+    def counts(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT state, COUNT(*) AS count FROM units GROUP BY state").fetchall()
+        return {row["state"]: row["count"] for row in rows}
+
+    def workers(self):
+        """ Рабочие с живой арендой и число их глав """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT owner, COUNT(*) AS count FROM units WHERE state = ? AND lease_until >= ? GROUP BY owner",
+                (LEASED, time.time())).fetchall()
+        return {row["owner"]: row["count"] for row in rows}
+
+    def failed(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM units WHERE state = ?", (FAILED,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def retry_failed(self):
+        return self.transaction(lambda connection: connection.execute(
+            "UPDATE units SET state = ?, attempts = 0, error = '' WHERE state = ?", (PENDING, FAILED)).rowcount)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ShardWorker:
+    """ Рабочий: берёт главы из WorkQueue в аренду, скачивает их через DownloadScheduler,
+    продлевает аренду, пока главы загружаются, и отмечает результат. Глава, аренду
+    которой забрал другой рабочий, отменяется. С follow=False рабочий завершается,
+    когда в очереди не осталось ни свободных, ни арендованных глав """
+
+    def __init__(self, work_queue, owner=None, lease=DEFAULT_LEASE, follow=False, on_log=None,
+                 **scheduler_options):
+        self.queue = work_queue
+        self.owner = owner or worker_name()
+        self.lease = lease
+        self.follow = follow
+        self.condition = threading.Condition()
+        # id главы -> строка очереди; и (slug, том, глава) -> id
+        self.units = {}
+        self.keys = {}
+        self.finished = 0
+        self.failed = 0
+        # Главы, отменённые из-за потери аренды: это не ошибка рабочего
+        self.lost = set()
+        self.stopping = threading.Event()
+        # Архивация — фоновая передача: уступает интерактивным запросам того же процесса
+        scheduler_options.setdefault("traffic_class", BACKGROUND)
+        self.scheduler = DownloadScheduler(on_log=on_log, on_job_finished=self.on_job_finished,
+                                           **scheduler_options)
+
+    def run(self, poll_interval=5.0):
+        """ Возвращает (готово глав, с ошибкой) """
+        heartbeat = threading.Thread(target=self.heartbeat_loop, name="lease-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while not self.stopping.is_set():
+                with self.condition:
+                    free = self.scheduler.max_jobs - len(self.units)
+                claimed = self.queue.claim(self.owner, free, self.lease) if free > 0 else []
+                for unit in claimed:
+                    self.start_unit(unit)
+                if not claimed and not self.follow and self.is_drained():
+                    break
+                with self.condition:
+                    if free == 0 or len(claimed) < free:
+                        # Ждём, пока освободится место, или проверяем очередь снова через poll_interval
+                        self.condition.wait(poll_interval)
+        finally:
+            self.stop()
+        return self.finished, self.failed
+
+    def is_drained(self):
+        """ Своих глав нет, свободных тоже; чужие аренды могут ещё истечь — тогда ждём """
+        with self.condition:
+            if self.units:
+                return False
+        counts = self.queue.counts()
+        return not counts.get(PENDING) and not counts.get(LEASED)
+
+    def start_unit(self, unit):
+        key = (unit["slug_url"], unit["volume"], unit["number"])
+        with self.condition:
+            self.units[unit["id"]] = unit
+            self.keys[key] = unit["id"]
+        if not self.scheduler.enqueue(unit["slug_url"], unit["volume"], unit["number"], unit["save_directory"]):
+            self.queue.complete(unit["id"], self.owner, False, error="глава уже загружается")
+            self.forget(key)
+
+    def forget(self, key):
+        with self.condition:
+            unit_id = self.keys.pop(key, None)
+            self.units.pop(unit_id, None)
+            self.condition.notify_all()
+        return unit_id
+
+    def on_job_finished(self, downloader, save_dir):
+        unit_id = self.forget((downloader.slug_url, downloader.volume_number, downloader.chapter_number))
+        if unit_id is None:
+            return
+        with self.condition:
+            lost = unit_id in self.lost
+            self.lost.discard(unit_id)
+        if not save_dir and lost:
+            # Глава теперь у другого рабочего (или скоро будет) — ни неудачи, ни записи в очередь
+            return
+        if not save_dir and self.stopping.is_set():
+            # Рабочий остановлен — глава не провалена, её докачает следующий
+            self.queue.release(self.owner, [unit_id])
+            return
+        if save_dir:
+            self.finished += 1
+        else:
+            self.failed += 1
+        error = "" if save_dir else f"страниц с ошибкой: {downloader.failed_pages}"
+        try:
+            self.queue.complete(unit_id, self.owner, bool(save_dir), save_dir, error)
+        except sqlite3.Error as e:
+            # Аренда истечёт, и глава достанется другому рабочему; файлы уже на диске
+            logger.warning("Could not record unit %s: %s", unit_id, e)
+
+    def heartbeat_loop(self):
+        interval = self.lease * HEARTBEAT_FRACTION
+        while not self.stopping.wait(interval):
+            with self.condition:
+                unit_ids = list(self.units)
+            renewed_until = time.time() + self.lease
+            try:
+                owned = self.queue.heartbeat(self.owner, unit_ids, self.lease)
+            except sqlite3.Error as e:
+                logger.warning("Lease heartbeat failed: %s", e)
+                owned = set()
+            else:
+                for unit_id in set(unit_ids) - owned:
+                    logger.warning("Lease of unit %s lost, cancelling", unit_id)
+                    self.abandon(unit_id)
+            with self.condition:
+                for unit_id in owned:
+                    if unit_id in self.units:
+                        self.units[unit_id]["lease_until"] = renewed_until
+                # Очередь недоступна: глава отменяется раньше, чем истечёт аренда и её сможет
+                # забрать другой рабочий, — иначе два рабочих писали бы в одну папку
+                expiring = [unit_id for unit_id, unit in self.units.items()
+                            if unit_id not in owned and unit["lease_until"] - time.time() < interval]
+            for unit_id in expiring:
+                logger.warning("Lease of unit %s is about to expire, cancelling", unit_id)
+                self.abandon(unit_id)
+
+    def abandon(self, unit_id):
+        """ Отменяет главу, которая больше не принадлежит рабочему """
+        with self.condition:
+            unit = self.units.get(unit_id)
+            if unit is None or unit_id in self.lost:
+                return
+            self.lost.add(unit_id)
+        key = (unit["slug_url"], unit["volume"], unit["number"])
+        if self.scheduler.cancel_job(*key):
+            # Глава ещё не начиналась — on_job_finished для неё не будет
+            self.forget(key)
+            with self.condition:
+                self.lost.discard(unit_id)
+
+    def stop(self):
+        """ Отменяет загрузку и возвращает незаконченные главы в очередь """
+        self.stopping.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.scheduler.cancel()
+        self.scheduler.wait()
+        with self.condition:
+            unit_ids = list(self.units)
+            self.units.clear()
+            self.keys.clear()
+        if unit_ids:
+            self.queue.release(self.owner, unit_ids)
+        self.scheduler.close()